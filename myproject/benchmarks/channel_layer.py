@@ -0,0 +1,110 @@
+"""
+Throughput of LocalBrokerChannelLayer with 1, 2, 4 and 8 worker processes.
+
+    python benchmarks/channel_layer.py [--workers 1 2 4 8] [--messages 2000]
+
+Each worker process owns one channel. In the "send" run every worker sends
+--messages point-to-point messages to the next worker's channel. In the
+"group" run every worker is in one group and sends --messages group_sends,
+so each one is delivered to all workers. Reported throughput is messages
+delivered per second across all workers.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from myapp import broker
+from myapp.layers import LocalBrokerChannelLayer
+
+
+def run_broker(path, ready):
+    asyncio.run(broker.serve(path, ready=ready.set, capacity=100000))
+
+
+async def worker_main(path, index, workers, messages, mode, channels, start, results):
+    layer = LocalBrokerChannelLayer(path)
+    channel = f'bench.worker!{index}'
+    group = f'bench-{workers}'
+    if mode == 'group':
+        await layer.group_add(group, channel)
+    channels.put(channel)
+    start.wait()
+
+    expected = messages * workers if mode == 'group' else messages
+    target = f'bench.worker!{(index + 1) % workers}'
+    payload = {'type': 'chat_message', 'text': 'x' * 200}
+
+    async def produce():
+        for _ in range(messages):
+            if mode == 'group':
+                await layer.group_send(group, payload)
+            else:
+                await layer.send(target, payload)
+
+    async def consume():
+        for _ in range(expected):
+            await layer.receive(channel)
+
+    started = time.perf_counter()
+    await asyncio.gather(produce(), consume())
+    results.put((expected, time.perf_counter() - started))
+    await layer.close()
+
+
+def worker(*args):
+    asyncio.run(worker_main(*args))
+
+
+def measure(path, workers, messages, mode):
+    channels, results = multiprocessing.Queue(), multiprocessing.Queue()
+    start = multiprocessing.Event()
+    processes = [
+        multiprocessing.Process(target=worker, args=(path, i, workers, messages, mode, channels, start, results))
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        channels.get()
+    start.set()
+
+    delivered, slowest = 0, 0.0
+    for _ in processes:
+        count, elapsed = results.get()
+        delivered += count
+        slowest = max(slowest, elapsed)
+    for process in processes:
+        process.join()
+    return delivered / slowest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--messages', type=int, default=2000)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+    ready = multiprocessing.Event()
+    broker_process = multiprocessing.Process(target=run_broker, args=(path, ready), daemon=True)
+    broker_process.start()
+    ready.wait()
+
+    print(f"{'workers':>7} {'send msg/s':>12} {'group msg/s':>12}")
+    try:
+        for workers in args.workers:
+            send = measure(path, workers, args.messages, 'send')
+            group = measure(path, workers, args.messages, 'group')
+            print(f'{workers:>7} {send:>12,.0f} {group:>12,.0f}')
+    finally:
+        broker_process.terminate()
+
+
+if __name__ == '__main__':
+    main()
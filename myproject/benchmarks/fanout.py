@@ -0,0 +1,103 @@
+"""
+CPU cost of one group broadcast against group size, before and after
+serialize-once fan-out.
+
+    python benchmarks/fanout.py [--sizes 10 100 1000 5000] [--rounds 20]
+
+"before" is the old path: every recipient rebuilds the event dict and
+json.dumps it. "after" is BroadcastMixin: the sender encodes once and
+each recipient forwards the same text. Both go through the real
+InMemoryChannelLayer's group_send, so the layer's per-recipient copy of
+the event is included. Recipients drain their queues directly rather than
+through receive(), whose expiry sweep over every channel would otherwise
+dominate both sides equally.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from channels.layers import InMemoryChannelLayer
+
+from myapp.broadcast import BroadcastMixin, encode_event
+
+GROUP = 'bench'
+
+
+class Recipient(BroadcastMixin):
+    def __init__(self, channel_layer, channel_name):
+        self.channel_layer = channel_layer
+        self.channel_name = channel_name
+        self.sent = 0
+
+    async def send(self, text_data=None, bytes_data=None, droppable=False):
+        self.sent += 1
+
+    async def legacy_chat_message(self, event):
+        # The per-recipient handler every consumer used to have.
+        message = event['message']
+        username = event['username']
+        time = event['time']
+        message_id = event['message_id']
+
+        await self.send(text_data=json.dumps({
+            'type': 'chat_message',
+            'message': message,
+            'username': username,
+            'time': time,
+            'message_id': message_id
+        }))
+
+
+def payload():
+    return {
+        'type': 'chat_message',
+        'message': 'The quick brown fox jumps over the lazy dog. ' * 4,
+        'username': 'benchmark-user',
+        'time': '12:00:00',
+        'message_id': str(uuid.uuid4())
+    }
+
+
+async def run(size, rounds, encoded):
+    layer = InMemoryChannelLayer(capacity=rounds + 1)
+    recipients = []
+    for _ in range(size):
+        recipient = Recipient(layer, await layer.new_channel())
+        await layer.group_add(GROUP, recipient.channel_name)
+        recipients.append(recipient)
+
+    handler = 'chat_message' if encoded else 'legacy_chat_message'
+    started = time.process_time()
+    for _ in range(rounds):
+        event = encode_event(payload()) if encoded else payload()
+        await layer.group_send(GROUP, event)
+        for recipient in recipients:
+            _, event = layer.channels[recipient.channel_name].get_nowait()
+            await getattr(recipient, handler)(event)
+    elapsed = time.process_time() - started
+
+    assert all(recipient.sent == rounds for recipient in recipients)
+    return elapsed / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 5000])
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'group size':>10} {'before ms':>10} {'after ms':>10} {'speedup':>8}")
+    for size in args.sizes:
+        before = asyncio.run(run(size, args.rounds, encoded=False))
+        after = asyncio.run(run(size, args.rounds, encoded=True))
+        print(f"{size:>10} {before * 1000:>10.2f} {after * 1000:>10.2f} {before / after:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+"""
+Websocket load test: N simulated users against the real ASGI application.
+
+    python benchmarks/load.py [--users 10 50 200] [--duration 10]
+        [--rate 1.0] [--mix chat=0.6,typing=0.3,reaction=0.1]
+        [--rooms 1 | --private] [--json results.json]
+
+Everything runs in this process: each user is a channels
+WebsocketCommunicator on myproject.asgi.application with a real session,
+so the handshake, auth, consumers, rate limits, outbound queues, the
+in-memory channel layer and the write-behind DB path are all exercised.
+Users act at --rate actions per second on average (Poisson), picking
+chat messages, typing bursts and reactions by --mix; with --private they
+are paired by the matchmaker instead of sharing --rooms public rooms.
+
+Reported per user count:
+  connect p50/p95      handshake through the first history frame
+  latency p50/p95/p99  chat message sent -> delivered to each recipient
+  sent/s, frames/s     client actions and frames delivered to clients
+  cpu %                process CPU over the run (all threads)
+  cpu us/frame         CPU per delivered frame
+  rss kb/conn          RSS growth from connecting, per connection
+
+--json writes the configuration, every result and a stats snapshot of
+each run, for comparing runs over time. The database is a throwaway
+SQLite file; rate-limited frames are counted as "throttled".
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myproject.settings')
+
+ACTIONS = ('chat', 'typing', 'reaction')
+MARKER = 'bench '
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ACTIONS:
+            raise argparse.ArgumentTypeError(f'unknown action {name!r}; use {", ".join(ACTIONS)}')
+        mix[name] = float(weight)
+    return mix
+
+
+def rss_kb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except OSError:
+        # Peak rather than current, but better than nothing.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def setup_database():
+    from django.conf import settings
+
+    path = os.path.join(tempfile.mkdtemp(prefix='chat-load-'), 'db.sqlite3')
+    settings.DATABASES['default']['NAME'] = path
+    # Build myapp's tables from the models rather than replaying history.
+    settings.MIGRATION_MODULES = {'myapp': None}
+
+    import django
+    django.setup()
+
+    from django.core.management import call_command
+    from django.db import connection
+
+    from myapp import search
+
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    with connection.cursor() as cursor:
+        for index in search.INDEXES:
+            for statement in index.create_sql():
+                cursor.execute(statement)
+    return path
+
+
+def create_sessions(prefix, count):
+    from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+    from django.contrib.auth.models import User
+    from django.contrib.sessions.backends.db import SessionStore
+
+    users = User.objects.bulk_create([User(username=f'{prefix}{i}') for i in range(count)])
+    users = list(User.objects.filter(username__startswith=prefix).order_by('id'))
+    keys = []
+    for user in users:
+        session = SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        keys.append(session.session_key)
+    return keys
+
+
+class Client:
+    def __init__(self, index, communicator, result):
+        self.index = index
+        self.communicator = communicator
+        self.result = result
+        self.joined = asyncio.Event()
+        self.message_ids = []
+
+    async def read(self):
+        # Straight from the output queue: receive_output() would cancel the
+        # application if it ever timed out.
+        queue = self.communicator.output_queue
+        while True:
+            message = await queue.get()
+            if message['type'] != 'websocket.send':
+                return
+            now = time.perf_counter_ns()
+            self.result['frames'] += 1
+            data = json.loads(message['text'])
+            kind = data.get('type')
+            if kind in ('fetch_messages', 'resync'):
+                self.joined.set()
+            elif kind == 'error':
+                self.result['throttled'] += 1
+            elif kind == 'chat_message':
+                text = data.get('message', '')
+                if data.get('message_id'):
+                    self.message_ids.append(data['message_id'])
+                    del self.message_ids[:-20]
+                if text.startswith(MARKER):
+                    self.result['latencies'].append((now - int(text[len(MARKER):])) / 1e6)
+
+    async def act(self, rng, mix, rate, until):
+        names, weights = zip(*mix.items())
+        while True:
+            await asyncio.sleep(rng.expovariate(rate))
+            if time.perf_counter() >= until:
+                return
+            action = rng.choices(names, weights)[0]
+            if action == 'chat':
+                frame = {'type': 'chat_message', 'message': f'{MARKER}{time.perf_counter_ns()}', 'time': ''}
+            elif action == 'typing':
+                frame = {'type': 'typing'}
+            elif self.message_ids:
+                frame = {'type': 'reaction', 'message_id': rng.choice(self.message_ids), 'reaction': '👍'}
+            else:
+                continue
+            await self.communicator.send_to(text_data=json.dumps(frame))
+            self.result['sent'] += 1
+            if action == 'typing':
+                await self.communicator.send_to(text_data=json.dumps({'type': 'stop_typing'}))
+                self.result['sent'] += 1
+
+
+async def run(users, args, sessions):
+    from channels.testing import WebsocketCommunicator
+
+    from myapp import stats
+    from myapp.persistence import message_writer
+    from myproject.asgi import application
+
+    result = {'users': users, 'frames': 0, 'sent': 0, 'throttled': 0, 'latencies': []}
+    rng = random.Random(args.seed)
+    rss_before = rss_kb()
+
+    clients = []
+    connect_times = []
+
+    async def connect(index):
+        path = '/ws/private-chat/' if args.private else f'/ws/chat/bench-{index % args.rooms}/'
+        communicator = WebsocketCommunicator(
+            application, path, headers=[(b'cookie', f'sessionid={sessions[index]}'.encode())])
+        client = Client(index, communicator, result)
+        started = time.perf_counter()
+        connected, _ = await communicator.connect(timeout=30)
+        if not connected:
+            raise RuntimeError(f'user {index} was refused')
+        client.reader = asyncio.ensure_future(client.read())
+        await client.joined.wait()
+        connect_times.append((time.perf_counter() - started) * 1000)
+        clients.append(client)
+
+    if args.private:
+        # The matchmaker pairs users as they arrive; connect them together.
+        await asyncio.gather(*(connect(index) for index in range(users)))
+    else:
+        for index in range(users):
+            await connect(index)
+    rss_connected = rss_kb()
+
+    # Count only what happens during the run itself.
+    result['frames'] = result['throttled'] = 0
+    cpu_started, started = cpu_seconds(), time.perf_counter()
+    until = started + args.duration
+    await asyncio.gather(*(
+        client.act(random.Random(rng.random()), args.mix, args.rate, until) for client in clients))
+    # Let frames in flight arrive.
+    await asyncio.sleep(args.drain)
+    elapsed = time.perf_counter() - started
+    cpu = cpu_seconds() - cpu_started
+
+    for client in clients:
+        await client.communicator.disconnect()
+        client.reader.cancel()
+    await message_writer.flush()
+
+    latencies = result.pop('latencies')
+    frames = result['frames']
+    result.update({
+        'connect_ms_p50': percentile(connect_times, 0.50),
+        'connect_ms_p95': percentile(connect_times, 0.95),
+        'latency_ms_p50': percentile(latencies, 0.50),
+        'latency_ms_p95': percentile(latencies, 0.95),
+        'latency_ms_p99': percentile(latencies, 0.99),
+        'latency_samples': len(latencies),
+        'sent_per_second': result['sent'] / elapsed,
+        'frames_per_second': frames / elapsed,
+        'cpu_percent': 100 * cpu / elapsed,
+        'cpu_us_per_frame': 1e6 * cpu / frames if frames else None,
+        'rss_kb_per_connection': (rss_connected - rss_before) / users,
+        'stats': stats.snapshot(),
+    })
+    return result
+
+
+def fmt(value, spec):
+    return format(value, spec) if value is not None else format('-', spec.rstrip('f').lstrip('.'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of load per user count.')
+    parser.add_argument('--rate', type=float, default=1.0, help='Actions per user per second.')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('chat=0.6,typing=0.3,reaction=0.1'))
+    parser.add_argument('--rooms', type=int, default=1, help='Public rooms the users are spread over.')
+    parser.add_argument('--private', action='store_true', help='Pair users in private chats instead.')
+    parser.add_argument('--drain', type=float, default=1.0, help='Seconds to wait for frames after the run.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='Write results here.')
+    args = parser.parse_args()
+    if args.private and any(users % 2 for users in args.users):
+        parser.error('--private needs even user counts')
+
+    setup_database()
+    results = []
+    print(f"{'users':>6} {'connect p50':>11} {'p95':>7} {'latency p50':>11} {'p95':>7} {'p99':>7} "
+          f"{'sent/s':>8} {'frames/s':>9} {'cpu %':>6} {'cpu us/frame':>12} {'rss kb/conn':>11} {'throttled':>9}")
+    for run_number, users in enumerate(args.users):
+        sessions = create_sessions(f'load{run_number}-', users)
+        result = asyncio.run(run(users, args, sessions))
+        results.append(result)
+        print(f"{users:>6} {fmt(result['connect_ms_p50'], '11.2f')} {fmt(result['connect_ms_p95'], '7.2f')} "
+              f"{fmt(result['latency_ms_p50'], '11.2f')} {fmt(result['latency_ms_p95'], '7.2f')} "
+              f"{fmt(result['latency_ms_p99'], '7.2f')} {result['sent_per_second']:8.1f} "
+              f"{result['frames_per_second']:9.1f} {result['cpu_percent']:6.1f} "
+              f"{fmt(result['cpu_us_per_frame'], '12.1f')} {result['rss_kb_per_connection']:11.1f} "
+              f"{result['throttled']:9d}")
+
+    if args.json:
+        config = {key: value for key, value in vars(args).items() if key != 'json'}
+        with open(args.json, 'w') as out:
+            json.dump({
+                'benchmark': 'load',
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'config': config,
+                'results': results,
+            }, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
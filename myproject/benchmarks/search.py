@@ -0,0 +1,197 @@
+"""
+Message search latency against table size.
+
+    python benchmarks/search.py [--sizes 1000000 10000000] [--queries 200]
+
+Each size gets its own SQLite file under --dir with synthetic messages
+(word frequencies follow a Zipf distribution, like chat text does),
+indexed the way the migration does it: rows first, then an FTS5
+rebuild. Queries go through myapp.search.search_page, the same code as
+/search/, with and without room/author scope and for second pages via
+the cursor. --baseline also times the content__icontains scan search
+would otherwise be, which gets slow quickly at these sizes.
+
+Building the 10M file takes a while and a few GB; it is kept between
+runs unless --rebuild is given.
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myproject.settings')
+
+VOCABULARY = 50000
+ROOMS = 200
+AUTHORS = 2000
+BATCH = 50000
+
+
+def word(rank):
+    # Deterministic pronounceable words, so queries can name them.
+    letters = 'bcdfghjklmnprstvz'
+    vowels = 'aeiou'
+    out = []
+    while True:
+        out.append(letters[rank % len(letters)] + vowels[(rank // len(letters)) % len(vowels)])
+        rank //= len(letters) * len(vowels)
+        if not rank:
+            return ''.join(out)
+
+
+def generate(cursor, size, seed):
+    rng = random.Random(seed)
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(VOCABULARY)))
+    words = [word(rank) for rank in range(VOCABULARY)]
+    cursor.executemany(
+        'INSERT INTO auth_user (id, password, is_superuser, username, first_name, last_name, email, '
+        "is_staff, is_active, date_joined) VALUES (?, '', 0, ?, '', '', '', 0, 1, '2024-01-01')",
+        [(i, f'user{i}') for i in range(1, AUTHORS + 1)],
+    )
+    written = 0
+    while written < size:
+        count = min(BATCH, size - written)
+        rows = []
+        for i in range(count):
+            text = ' '.join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(3, 20)))
+            rows.append((
+                f'room{rng.randrange(ROOMS)}',
+                rng.randint(1, AUTHORS),
+                text,
+                f'2024-01-01 00:00:{(written + i) % 60:02d}',
+                f'{written + i:032x}',
+            ))
+        cursor.executemany(
+            'INSERT INTO myapp_message (room, author_id, content, timestamp, message_id) VALUES (?, ?, ?, ?, ?)',
+            rows,
+        )
+        written += count
+
+
+def build(path, size, seed):
+    import sqlite3
+
+    from django.contrib.auth.models import User
+    from django.db import connection
+
+    from myapp.models import Message
+    from myapp.search import message_index
+
+    # Create the tables with Django so the schema matches the models.
+    with connection.schema_editor() as editor:
+        editor.create_model(User)
+        editor.create_model(Message)
+    connection.close()
+
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=OFF')
+    started = time.perf_counter()
+    with db:
+        generate(db.cursor(), size, seed)
+    loaded = time.perf_counter()
+    with db:
+        cursor = db.cursor()
+        for statement in message_index.create_sql():
+            cursor.execute(statement)
+        message_index.rebuild(cursor)
+        message_index.optimize(cursor)
+    indexed = time.perf_counter()
+    db.close()
+    print(f'  loaded {size} rows in {loaded - started:.1f}s, indexed in {indexed - loaded:.1f}s')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def timed(fn, queries):
+    latencies = []
+    for args in queries:
+        started = time.perf_counter()
+        fn(*args)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def run(size, args):
+    path = os.path.join(args.dir, f'search-{size}.sqlite3')
+    if args.rebuild and os.path.exists(path):
+        os.remove(path)
+
+    from django.db import connection
+
+    connection.close()
+    connection.settings_dict['NAME'] = path
+    print(f'{size} messages ({path})')
+    if not os.path.exists(path):
+        build(path, size, args.seed)
+
+    from myapp.models import Message
+    from myapp.search import message_index, search_page
+
+    rng = random.Random(args.seed + 1)
+    common = [word(rank) for rank in range(10)]
+    medium = [word(rank) for rank in range(100, 1000)]
+    rare = [word(rank) for rank in range(20000, VOCABULARY)]
+    n = args.queries
+
+    def page(query, scope, cursor=None):
+        return search_page(message_index, Message, query, scope, cursor, args.limit)
+
+    def second_page(query, scope):
+        _, cursor = page(query, scope)
+        if cursor:
+            page(query, scope, cursor)
+
+    cases = {
+        'rare word': (page, [(rng.choice(rare), {}) for _ in range(n)]),
+        'medium word': (page, [(rng.choice(medium), {}) for _ in range(n)]),
+        'common word': (page, [(rng.choice(common), {}) for _ in range(n)]),
+        'two words': (page, [(f'{rng.choice(medium)} {rng.choice(common)}', {}) for _ in range(n)]),
+        'prefix': (page, [(rng.choice(medium)[:3], {}) for _ in range(n)]),
+        'medium, room': (page, [(rng.choice(medium), {'room': f'room{rng.randrange(ROOMS)}'}) for _ in range(n)]),
+        'common, author': (page, [(rng.choice(common), {'author_id': rng.randint(1, AUTHORS)}) for _ in range(n)]),
+        'medium, 2 pages': (second_page, [(rng.choice(medium), {}) for _ in range(n)]),
+    }
+    if args.baseline:
+        def icontains(query, scope):
+            list(Message.objects.filter(content__icontains=query, **scope).order_by('-id')[:args.limit])
+        # Rare words: a frequent one lets the scan stop after a few pages.
+        cases['icontains (scan)'] = (icontains, [(rng.choice(rare), {}) for _ in range(max(1, n // 20))])
+
+    print(f"  {'query':<18} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+    for name, (fn, queries) in cases.items():
+        # One untimed pass per case to load pages into the OS cache.
+        fn(*queries[0])
+        latencies = timed(fn, queries)
+        print(f'  {name:<18} {percentile(latencies, 0.5):9.2f} {percentile(latencies, 0.95):9.2f} {max(latencies):9.2f}')
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000000, 10000000])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--dir', default=os.path.join(tempfile.gettempdir(), 'chat-search-bench'))
+    parser.add_argument('--rebuild', action='store_true', help='Regenerate the databases.')
+    parser.add_argument('--baseline', action='store_true', help='Also time an icontains scan.')
+    args = parser.parse_args()
+    os.makedirs(args.dir, exist_ok=True)
+
+    import django
+
+    django.setup()
+    for size in args.sizes:
+        run(size, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import asyncio
+import uuid
+
+from channels.layers import get_channel_layer
+
+from . import stats
+from .broadcast import encode_event
+from .conf import chat_setting
+
+DEFAULTS = {
+    # Seconds joins and leaves are collected for before a room hears of them.
+    'WINDOW': 1.0,
+    # Names spelled out in an announcement; the rest are "N others".
+    'MAX_NAMES': 3,
+}
+
+JOINED = 1
+LEFT = -1
+
+
+class JoinAnnouncer:
+    """
+    Per-room "has connected"/"has disconnected" notices, one per window.
+
+    A join or leave only updates a dict, so a connection costs O(1) no
+    matter how many are in the room; each room gets at most one System
+    chat_message per WINDOW naming who came and went, with the full lists
+    in `joined` and `left`. A reconnect inside one window (leave, then
+    join) cancels out and announces nothing. Each worker announces its own
+    connections; with several workers a user may be announced by each.
+    """
+
+    def __init__(self, window, max_names):
+        self.window = window
+        self.max_names = max_names
+        self.events = 0
+        self.cancelled = 0
+        self.announcements = 0
+        # group -> {username: JOINED or LEFT} not yet announced
+        self._pending = {}
+        self._task = None
+
+    def joined(self, group, username):
+        self._add(group, username, JOINED)
+
+    def left(self, group, username):
+        self._add(group, username, LEFT)
+
+    def stats(self):
+        return {
+            'events': self.events,
+            'cancelled': self.cancelled,
+            'announcements': self.announcements,
+            'rooms': len(self._pending),
+        }
+
+    def _add(self, group, username, change):
+        self.events += 1
+        room = self._pending.setdefault(group, {})
+        if room.get(username) == -change:
+            del room[username]
+            self.cancelled += 2
+        else:
+            room[username] = change
+        self._ensure_running()
+
+    def _ensure_running(self):
+        if (self._task is None or self._task.done()
+                or self._task.get_loop() is not asyncio.get_running_loop()):
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        channel_layer = get_channel_layer()
+        while self._pending:
+            await asyncio.sleep(self.window)
+            pending, self._pending = self._pending, {}
+            for group, changes in pending.items():
+                joined = [username for username, change in changes.items() if change == JOINED]
+                left = [username for username, change in changes.items() if change == LEFT]
+                if not (joined or left):
+                    continue
+                self.announcements += 1
+                await channel_layer.group_send(group, encode_event({
+                    'type': 'chat_message',
+                    'message': self.describe(joined, left),
+                    'username': 'System',
+                    'time': '',
+                    'message_id': str(uuid.uuid4()),
+                    'joined': joined,
+                    'left': left
+                }))
+
+    def describe(self, joined, left):
+        parts = []
+        if joined:
+            parts.append(f"{self._names(joined)} {'has' if len(joined) == 1 else 'have'} connected.")
+        if left:
+            parts.append(f"{self._names(left)} {'has' if len(left) == 1 else 'have'} disconnected.")
+        return ' '.join(parts)
+
+    def _names(self, usernames):
+        if len(usernames) <= self.max_names:
+            shown, others = usernames, ''
+        else:
+            shown = usernames[:self.max_names]
+            others = f'{len(usernames) - self.max_names} others'
+        if others:
+            return f"{', '.join(shown)} and {others}"
+        if len(shown) == 1:
+            return shown[0]
+        return f"{', '.join(shown[:-1])} and {shown[-1]}"
+
+
+def _build_announcer():
+    config = chat_setting('CHAT_ANNOUNCEMENTS', DEFAULTS)
+    return JoinAnnouncer(window=config['WINDOW'], max_names=config['MAX_NAMES'])
+
+
+join_announcer = _build_announcer()
+stats.register('announcements', join_announcer.stats)
@@ -0,0 +1,527 @@
+import bisect
+import calendar
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from . import stats
+from .conf import chat_setting
+from .pagination import decode_cursor, encode_cursor
+
+DEFAULTS = {
+    # Messages older than this many days are moved out of the database.
+    'MAX_AGE_DAYS': 90,
+    # Where segment files go; None means BASE_DIR/archive.
+    'DIR': None,
+    # Messages per compressed block. The sparse index has one entry per
+    # block, so a read decompresses at most this many extra messages.
+    'BLOCK_MESSAGES': 256,
+    # Largest segment written by archiving and compaction.
+    'SEGMENT_MESSAGES': 50000,
+    # Segments kept mapped, and decompressed blocks kept, per process.
+    'OPEN_SEGMENTS': 64,
+    'CACHED_BLOCKS': 256,
+}
+
+PUBLIC = 'public'
+PRIVATE = 'private'
+
+MAGIC = b'CHATSEG1'
+# index offset, index length, magic
+FOOTER = struct.Struct('<QQ8s')
+
+_SEGMENT_NAME = re.compile(r'^(\d{17}-\d{12})_(\d{17}-\d{12})\.seg$')
+LISTING_SETTLE_NS = 2 * 1000000000
+
+_SAFE_ROOM = re.compile(r'^[-\w]{1,50}$', re.ASCII)
+
+
+def message_key(message_json):
+    """(timestamp, id) of an archived message, the order segments are kept in."""
+    return datetime.fromisoformat(message_json['time']), message_json['id']
+
+
+def _bound(key):
+    # Cursors built from a message without a pk mean "strictly older than
+    # this timestamp"; ids start at 1, so (timestamp, -1) sorts below all.
+    timestamp, pk = key
+    return timestamp, -1 if pk is None else pk
+
+
+def _key_token(key):
+    timestamp, pk = key
+    micros = calendar.timegm(timestamp.utctimetuple()) * 1000000 + timestamp.microsecond
+    return f'{micros:017d}-{pk:012d}'
+
+
+def room_key(room):
+    """Directory name for a public room name or a private room id."""
+    room = str(room)
+    return room if _SAFE_ROOM.match(room) else 'x' + room.encode().hex()
+
+
+class ArchivedMessage:
+    """A message read back from a segment; quacks like Message for history."""
+
+    __slots__ = ('timestamp', 'pk', '_json')
+
+    def __init__(self, key, message_json):
+        self.timestamp, self.pk = key
+        self._json = message_json
+
+    def to_json(self):
+        return dict(self._json)
+
+
+class Segment:
+    """
+    One immutable segment file, memory mapped.
+
+    Layout: MAGIC, zlib-compressed blocks of newline-separated JSON
+    messages in (timestamp, id) order, a JSON index with one entry per
+    block (first and last key, offset, length, count, crc32), and FOOTER.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.inode = os.fstat(file.fileno()).st_ino
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            index_offset, index_length, magic = FOOTER.unpack_from(self._map, len(self._map) - FOOTER.size)
+            if magic != MAGIC or self._map[:len(MAGIC)] != MAGIC:
+                raise ValueError(f'{path} is not an archive segment')
+            index = json.loads(self._map[index_offset:index_offset + index_length])
+        except (struct.error, ValueError):
+            self._map.close()
+            raise
+        self.count = index['count']
+        self.blocks = index['blocks']
+        self.firsts = [(datetime.fromisoformat(block['first'][0]), block['first'][1]) for block in self.blocks]
+        last = self.blocks[-1]['last']
+        self.last = datetime.fromisoformat(last[0]), last[1]
+
+    def read_block(self, number, verify=False):
+        block = self.blocks[number]
+        data = self._map[block['offset']:block['offset'] + block['length']]
+        if verify and zlib.crc32(data) != block['crc']:
+            raise ValueError(f'{self.path}: block {number} fails its checksum')
+        return [json.loads(line) for line in zlib.decompress(data).decode().split('\n')]
+
+    def close(self):
+        self._map.close()
+
+
+def write_segment(directory, messages, block_messages):
+    """
+    Write `messages` (to_json() dicts plus 'id', oldest first) as a new
+    segment in `directory` and return its path. The file is written under
+    a temporary name, fsynced and renamed, so it is complete or absent.
+    """
+    first, last = message_key(messages[0]), message_key(messages[-1])
+    path = os.path.join(directory, f'{_key_token(first)}_{_key_token(last)}.seg')
+    os.makedirs(directory, exist_ok=True)
+
+    partial = f'{path}.tmp'
+    blocks = []
+    with open(partial, 'wb') as out:
+        out.write(MAGIC)
+        for start in range(0, len(messages), block_messages):
+            block = messages[start:start + block_messages]
+            data = zlib.compress('\n'.join(json.dumps(message) for message in block).encode())
+            blocks.append({
+                'first': [block[0]['time'], block[0]['id']],
+                'last': [block[-1]['time'], block[-1]['id']],
+                'offset': out.tell(),
+                'length': len(data),
+                'count': len(block),
+                'crc': zlib.crc32(data),
+            })
+            out.write(data)
+        index = json.dumps({'count': len(messages), 'blocks': blocks}).encode()
+        index_offset = out.tell()
+        out.write(index)
+        out.write(FOOTER.pack(index_offset, len(index), MAGIC))
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(partial, path)
+    _fsync_directory(directory)
+    return path
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def segment_ranges(directory):
+    """
+    (first, last, path) for every segment in `directory`, oldest first.
+    first and last are key tokens, which sort like the keys themselves.
+    A segment whose range lies inside another's is superseded and left
+    out: merges write the new segment before removing the old ones.
+    Returns (current, superseded).
+    """
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return [], []
+    ranges = []
+    for name in names:
+        match = _SEGMENT_NAME.match(name)
+        if match:
+            ranges.append((match.group(1), match.group(2), os.path.join(directory, name)))
+    # Oldest first; of two starting together, the longer one first.
+    ranges.sort(key=lambda entry: entry[1], reverse=True)
+    ranges.sort(key=lambda entry: entry[0])
+    current, superseded = [], []
+    for entry in ranges:
+        if current and entry[1] <= current[-1][1]:
+            superseded.append(entry)
+        else:
+            current.append(entry)
+    return current, superseded
+
+
+def list_segments(directory):
+    """Paths of the current segments in `directory`, oldest first."""
+    return [path for _, _, path in segment_ranges(directory)[0]]
+
+
+class MessageArchive:
+    """
+    Read side of the archive: history older than what the database holds.
+
+    Each room has a directory of segments. Segments are mapped on first
+    use and kept in an LRU, as are decompressed blocks, so scrolling back
+    through a room decompresses each block once. Directory listings are
+    cached until the directory's mtime changes (a new or compacted
+    segment).
+    """
+
+    def __init__(self, directory, open_segments, cached_blocks):
+        self.directory = directory
+        self.open_segments = open_segments
+        self.cached_blocks = cached_blocks
+        self.reads = 0
+        self.block_hits = 0
+        self.block_misses = 0
+        # Reads come from the db_read pool's threads.
+        self._lock = threading.Lock()
+        self._listings = {}
+        self._segments = OrderedDict()
+        self._blocks = OrderedDict()
+
+    def room_directory(self, kind, room):
+        return os.path.join(self.directory, kind, room_key(room))
+
+    def before(self, kind, room, key, limit):
+        """
+        Up to `limit` archived messages of `room`, newest first, strictly
+        older than `key` (a (timestamp, id) pair; id may be None), or the
+        newest archived ones if key is None.
+        """
+        bound = None if key is None else _bound(key)
+        result = []
+        with self._lock:
+            self.reads += 1
+            for path in reversed(self._paths(kind, room)):
+                segment = self._segment(path)
+                if segment is None or (bound is not None and segment.firsts[0] >= bound):
+                    continue
+                end = len(segment.blocks) if bound is None else bisect.bisect_left(segment.firsts, bound)
+                for number in range(end - 1, -1, -1):
+                    for found, message_json in reversed(self._block(segment, number)):
+                        if bound is None or found < bound:
+                            result.append(ArchivedMessage(found, message_json))
+                            if len(result) == limit:
+                                return result
+        return result
+
+    def newest_key(self, kind, room):
+        """Key of the newest archived message of `room`, or None."""
+        with self._lock:
+            for path in reversed(self._paths(kind, room)):
+                segment = self._segment(path)
+                if segment is not None:
+                    return segment.last
+        return None
+
+    def _paths(self, kind, room):
+        directory = self.room_directory(kind, room)
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        cached = self._listings.get(directory)
+        # mtimes are only as fine as the filesystem's clock tick, so a
+        # listing taken right after a change may already be out of date.
+        if cached is None or cached[0] != mtime or time.time_ns() - mtime < LISTING_SETTLE_NS:
+            cached = self._listings[directory] = (mtime, list_segments(directory))
+        return cached[1]
+
+    def _segment(self, path):
+        try:
+            inode = os.stat(path).st_ino
+        except FileNotFoundError:
+            # Replaced by compaction since the listing was read.
+            return None
+        segment = self._segments.get(path)
+        if segment is not None and segment.inode == inode:
+            self._segments.move_to_end(path)
+            return segment
+        if segment is not None:
+            # Rewritten under the same name by a merge.
+            del self._segments[path]
+            segment.close()
+            for cache_key in [cache_key for cache_key in self._blocks if cache_key[0] == path]:
+                del self._blocks[cache_key]
+        try:
+            segment = Segment(path)
+        except FileNotFoundError:
+            return None
+        self._segments[path] = segment
+        while len(self._segments) > self.open_segments:
+            _, evicted = self._segments.popitem(last=False)
+            evicted.close()
+        return segment
+
+    def _block(self, segment, number):
+        cache_key = (segment.path, number)
+        block = self._blocks.get(cache_key)
+        if block is not None:
+            self.block_hits += 1
+            self._blocks.move_to_end(cache_key)
+            return block
+        self.block_misses += 1
+        block = [(message_key(message_json), message_json) for message_json in segment.read_block(number)]
+        self._blocks[cache_key] = block
+        while len(self._blocks) > self.cached_blocks:
+            self._blocks.popitem(last=False)
+        return block
+
+    def stats(self):
+        return {
+            'reads': self.reads,
+            'open_segments': len(self._segments),
+            'cached_blocks': len(self._blocks),
+            'block_hits': self.block_hits,
+            'block_misses': self.block_misses,
+        }
+
+
+def extend_page(kind, room, rows, next_cursor, cursor, limit):
+    """
+    Complete a history page from the database with archived messages once
+    the database has nothing older. Archived messages are always older
+    than every row still in the database, so they simply follow.
+    """
+    if next_cursor is not None:
+        return rows, next_cursor
+    if rows:
+        key = (rows[-1].timestamp, rows[-1].pk)
+    elif cursor:
+        key = decode_cursor(cursor)
+    else:
+        key = None
+    rows = list(rows) + message_archive.before(kind, room, key, limit - len(rows) + 1)
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].timestamp, rows[-1].pk)
+
+
+def extend_latest(kind, room, rows, count):
+    """The newest `count` messages when the database holds fewer than that."""
+    rows = list(rows)
+    if len(rows) < count:
+        key = (rows[-1].timestamp, rows[-1].pk) if rows else None
+        rows += message_archive.before(kind, room, key, count - len(rows))
+    return rows
+
+
+def _sources():
+    from .models import Message, PrivateMessage
+    return ((PUBLIC, Message, 'room'), (PRIVATE, PrivateMessage, 'room_id'))
+
+
+def archive_messages(cutoff, rooms=None):
+    """
+    Move messages older than `cutoff` from the database into segments and
+    return how many were moved. Safe to rerun after a crash: rows at or
+    before a room's newest archived key are already in a segment and are
+    only deleted.
+    """
+    moved = 0
+    for kind, model, room_field in _sources():
+        old = model.objects.filter(timestamp__lt=cutoff)
+        for room in old.values_list(room_field, flat=True).distinct().order_by():
+            if rooms is None or str(room) in rooms:
+                moved += _archive_room(kind, model, room_field, room, cutoff)
+    return moved
+
+
+def _archive_room(kind, model, room_field, room, cutoff):
+    rows = model.objects.filter(**{room_field: room}, timestamp__lt=cutoff)
+    directory = message_archive.room_directory(kind, room)
+    moved = 0
+    newest = message_archive.newest_key(kind, room)
+    if newest is not None:
+        timestamp, pk = newest
+        after = Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk)
+        older = list(rows.exclude(after).select_related('author').order_by('timestamp', 'id'))
+        if older:
+            moved += _merge_older(directory, model, older)
+        rows = rows.filter(after)
+
+    while True:
+        batch = list(rows.select_related('author').order_by('timestamp', 'id')[:config['SEGMENT_MESSAGES']])
+        if not batch:
+            return moved
+        write_segment(directory, [dict(row.to_json(), id=row.pk) for row in batch], config['BLOCK_MESSAGES'])
+        _delete(model, [row.pk for row in batch])
+        moved += len(batch)
+
+
+def _merge_older(directory, model, rows):
+    """
+    Archive `rows`, which sort at or before the newest archived message.
+    After an interrupted run they are already in a segment and are only
+    deleted; anything else (rows stored with an old timestamp) is merged
+    into one new segment spanning the segments it overlaps, which
+    supersedes them. Returns how many rows were newly archived.
+    """
+    first, last = _key_token((rows[0].timestamp, rows[0].pk)), _key_token((rows[-1].timestamp, rows[-1].pk))
+    overlapping = [path for start, end, path in segment_ranges(directory)[0] if start <= last and end >= first]
+    archived = []
+    for path in overlapping:
+        archived += _read_all(path)
+    archived_ids = {message['id'] for message in archived}
+    missing = [dict(row.to_json(), id=row.pk) for row in rows if row.pk not in archived_ids]
+    if missing:
+        write_segment(directory, sorted(archived + missing, key=message_key), config['BLOCK_MESSAGES'])
+    _delete(model, [row.pk for row in rows])
+    return len(missing)
+
+
+def _delete(model, ids, batch_size=500):
+    ids = list(ids)
+    with transaction.atomic():
+        for start in range(0, len(ids), batch_size):
+            model.objects.filter(id__in=ids[start:start + batch_size]).delete()
+
+
+def _read_all(path):
+    segment = Segment(path)
+    try:
+        messages = []
+        for number in range(len(segment.blocks)):
+            messages += segment.read_block(number, verify=True)
+        return messages
+    finally:
+        segment.close()
+
+
+def compact(directory=None):
+    """
+    Merge runs of small segments in every room into segments of up to
+    SEGMENT_MESSAGES and delete superseded ones. Returns the number of
+    segment files removed.
+    """
+    removed = 0
+    for room_directory in _room_directories(directory):
+        for _, _, path in segment_ranges(room_directory)[1]:
+            os.remove(path)
+            removed += 1
+        run, run_count = [], 0
+        for path in list_segments(room_directory) + [None]:
+            count = None
+            if path is not None:
+                segment = Segment(path)
+                count = segment.count
+                segment.close()
+            if path is not None and run_count + count <= config['SEGMENT_MESSAGES']:
+                run.append(path)
+                run_count += count
+                continue
+            if len(run) > 1:
+                messages = []
+                for run_path in run:
+                    messages += _read_all(run_path)
+                # Written before the old ones go, so readers never miss messages.
+                write_segment(room_directory, messages, config['BLOCK_MESSAGES'])
+                for run_path in run:
+                    os.remove(run_path)
+                removed += len(run)
+            run, run_count = ([path], count) if path is not None else ([], 0)
+    return removed
+
+
+def verify(directory=None):
+    """Check every segment end to end; returns a list of problems found."""
+    problems = []
+    for room_directory in _room_directories(directory):
+        for name in os.listdir(room_directory):
+            if name.endswith('.tmp'):
+                problems.append(f'{os.path.join(room_directory, name)}: unfinished write')
+        previous = None
+        for path in list_segments(room_directory):
+            try:
+                segment = Segment(path)
+            except (OSError, ValueError) as exc:
+                problems.append(f'{path}: {exc}')
+                continue
+            try:
+                count = 0
+                for number, block in enumerate(segment.blocks):
+                    messages = segment.read_block(number, verify=True)
+                    keys = [message_key(message) for message in messages]
+                    if len(messages) != block['count']:
+                        problems.append(f'{path}: block {number} holds {len(messages)} messages, index says {block["count"]}')
+                    if keys != sorted(keys) or keys[0] != segment.firsts[number] or (previous is not None and keys[0] <= previous):
+                        problems.append(f'{path}: block {number} is out of order')
+                    previous = keys[-1]
+                    count += len(messages)
+                if count != segment.count:
+                    problems.append(f'{path}: holds {count} messages, index says {segment.count}')
+            except (ValueError, zlib.error) as exc:
+                problems.append(f'{path}: {exc}')
+            finally:
+                segment.close()
+    return problems
+
+
+def _room_directories(directory=None):
+    directory = directory or message_archive.directory
+    for kind in (PUBLIC, PRIVATE):
+        kind_directory = os.path.join(directory, kind)
+        if os.path.isdir(kind_directory):
+            for name in sorted(os.listdir(kind_directory)):
+                yield os.path.join(kind_directory, name)
+
+
+def _build_archive():
+    return MessageArchive(
+        directory=str(config['DIR'] or os.path.join(settings.BASE_DIR, 'archive')),
+        open_segments=config['OPEN_SEGMENTS'],
+        cached_blocks=config['CACHED_BLOCKS'],
+    )
+
+
+config = chat_setting('CHAT_ARCHIVE', DEFAULTS)
+message_archive = _build_archive()
+stats.register('archive', message_archive.stats)
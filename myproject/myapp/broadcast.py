@@ -0,0 +1,56 @@
+import json
+import time
+
+# Event types a client can live without; a backed-up connection drops these first.
+# Not reactions: their frames carry deltas, and a dropped one leaves the count wrong.
+DROPPABLE_TYPES = frozenset({'typing', 'stop_typing'})
+
+# event type -> receive_to_send_seconds child
+_latency_by_type = {}
+
+
+def encode_event(payload):
+    """
+    Channel-layer event carrying `payload` already serialized.
+
+    The sender encodes the frame once; every recipient forwards the same
+    text instead of rebuilding and re-encoding the dict.
+    """
+    return {'type': payload['type'], 'text': json.dumps(payload)}
+
+
+class BroadcastMixin:
+    # metrics, presence and profiling read settings when imported, so they
+    # are imported on first use: this module has to stay importable without
+    # Django settings (benchmarks/fanout.py).
+
+    async def broadcast(self, group, payload):
+        from .metrics import broadcast_local_recipients
+        from .presence import presence
+        from .profiling import stage
+
+        event = encode_event(payload)
+        received_at = getattr(self, 'received_at', None)
+        if received_at is not None:
+            # Sent while handling a client frame (see MetricsMixin).
+            event['received_at'] = received_at
+        broadcast_local_recipients.observe(presence.occupancy(group))
+        with stage('group_send'):
+            await self.channel_layer.group_send(group, event)
+
+    async def forward(self, event):
+        received_at = event.get('received_at')
+        if received_at is not None:
+            latency = _latency_by_type.get(event['type'])
+            if latency is None:
+                from .metrics import receive_to_send_seconds
+                latency = _latency_by_type[event['type']] = receive_to_send_seconds.labels(event['type'])
+            latency.observe(time.time() - received_at)
+        await self.send(text_data=event['text'], droppable=event['type'] in DROPPABLE_TYPES)
+
+    # Channels dispatches an event to the method named after its type.
+    chat_message = forward
+    typing = forward
+    file_message = forward
+    file_preview = forward
+    reaction = forward
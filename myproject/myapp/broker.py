@@ -0,0 +1,234 @@
+"""
+Local channel-layer broker.
+
+A single asyncio process that owns every channel queue and group for the
+host, and the private chat queue. Worker processes talk to it over a Unix
+domain socket through myapp.layers.LocalBrokerChannelLayer, so groups
+and matchmaking span all workers with no external service. Start it with
+`manage.py runbroker`.
+
+Wire format: each frame is a 4-byte big-endian length followed by a JSON
+object. Requests carry an integer `id` that the response echoes back.
+"""
+import asyncio
+import json
+import logging
+import os
+import struct
+import time
+from collections import deque
+
+from .matchmaking import Matchmaker
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('!I')
+MAX_FRAME = 16 * 1024 * 1024
+SWEEP_INTERVAL = 1.0
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(HEADER.size)
+    (length,) = HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise ValueError(f'Frame of {length} bytes exceeds the {MAX_FRAME} byte limit')
+    return json.loads(await reader.readexactly(length))
+
+
+def encode_frame(obj):
+    body = json.dumps(obj, separators=(',', ':')).encode()
+    return HEADER.pack(len(body)) + body
+
+
+class Broker:
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None):
+        self.expiry = expiry
+        self.group_expiry = group_expiry
+        self.capacity = capacity
+        self.channel_capacity = channel_capacity or {}
+        # channel -> deque of (expires_at, message)
+        self.channels = {}
+        # group -> {channel: joined_at}
+        self.groups = {}
+        # channel -> deque of (writer, request id) parked in receive
+        self.waiters = {}
+        # Private chat queue for every worker.
+        self.matchmaker = Matchmaker()
+
+    def get_capacity(self, channel):
+        for pattern, capacity in self.channel_capacity.items():
+            if channel.startswith(pattern):
+                return capacity
+        return self.capacity
+
+    # Operations; each returns the response body, or None to reply later.
+
+    def op_send(self, writer, request):
+        if not self._deliver(request['channel'], request['message']):
+            return {'error': 'full'}
+        return {}
+
+    def op_receive(self, writer, request):
+        channel = request['channel']
+        now = time.time()
+        queue = self.channels.get(channel)
+        while queue:
+            expires_at, message = queue.popleft()
+            if expires_at >= now:
+                if not queue:
+                    del self.channels[channel]
+                return {'channel': channel, 'message': message}
+        self.channels.pop(channel, None)
+        self.waiters.setdefault(channel, deque()).append((writer, request['id']))
+        return None
+
+    def op_cancel(self, writer, request):
+        waiters = self.waiters.get(request['channel'])
+        if waiters:
+            try:
+                waiters.remove((writer, request['cancel']))
+            except ValueError:
+                pass
+            if not waiters:
+                del self.waiters[request['channel']]
+        return None
+
+    def op_group_add(self, writer, request):
+        self.groups.setdefault(request['group'], {})[request['channel']] = time.time()
+        return {}
+
+    def op_group_discard(self, writer, request):
+        members = self.groups.get(request['group'])
+        if members is not None:
+            members.pop(request['channel'], None)
+            if not members:
+                del self.groups[request['group']]
+        return {}
+
+    def op_group_send(self, writer, request):
+        message = request['message']
+        for channel in list(self.groups.get(request['group'], ())):
+            # A full channel just misses this message, as with the other layers.
+            self._deliver(channel, message)
+        return {}
+
+    def op_match_pair(self, writer, request):
+        try:
+            partner, _ = self.matchmaker.pair(request['user_id'], request['channel'])
+        except ValueError as exc:
+            return {'error': str(exc)}
+        if partner is None:
+            return {'partner': None}
+        return {'partner': {
+            'user_id': partner.user_id,
+            'channel_name': partner.channel_name,
+            'room_name': partner.room_name,
+        }}
+
+    def op_match_confirm(self, writer, request):
+        return {'confirmed': self.matchmaker.confirm(request['channel'])}
+
+    def op_match_joined(self, writer, request):
+        self.matchmaker.joined(request['channel'])
+        return {}
+
+    def op_match_leave(self, writer, request):
+        return {'room_name': self.matchmaker.leave(request['channel'])}
+
+    def op_flush(self, writer, request):
+        self.channels.clear()
+        self.groups.clear()
+        self.matchmaker = Matchmaker()
+        return {}
+
+    def _deliver(self, channel, message):
+        waiters = self.waiters.get(channel)
+        while waiters:
+            writer, request_id = waiters.popleft()
+            if not waiters:
+                del self.waiters[channel]
+            if not writer.is_closing():
+                writer.write(encode_frame({'id': request_id, 'channel': channel, 'message': message}))
+                return True
+
+        queue = self.channels.setdefault(channel, deque())
+        if len(queue) >= self.get_capacity(channel):
+            return False
+        queue.append((time.time() + self.expiry, message))
+        return True
+
+    def sweep(self):
+        now = time.time()
+        for channel, queue in list(self.channels.items()):
+            expired = False
+            while queue and queue[0][0] < now:
+                queue.popleft()
+                expired = True
+            if expired:
+                # Like InMemoryChannelLayer: a channel that lets a message
+                # expire is presumed dead and leaves all its groups.
+                for members in self.groups.values():
+                    members.pop(channel, None)
+            if not queue:
+                del self.channels[channel]
+
+        cutoff = now - self.group_expiry
+        for group, members in list(self.groups.items()):
+            for channel, joined_at in list(members.items()):
+                if joined_at < cutoff:
+                    del members[channel]
+            if not members:
+                del self.groups[group]
+
+    def forget(self, writer):
+        for channel, waiters in list(self.waiters.items()):
+            remaining = deque(waiter for waiter in waiters if waiter[0] is not writer)
+            if remaining:
+                self.waiters[channel] = remaining
+            else:
+                del self.waiters[channel]
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await read_frame(reader)
+                handler = getattr(self, 'op_' + request.get('op', ''), None)
+                if handler is None:
+                    response = {'error': f"unknown op {request.get('op')!r}"}
+                else:
+                    response = handler(writer, request)
+                if response is not None:
+                    response['id'] = request['id']
+                    writer.write(encode_frame(response))
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        except Exception:
+            logger.exception('Dropping broker client after a protocol error')
+        finally:
+            self.forget(writer)
+            writer.close()
+
+    async def sweeper(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            self.sweep()
+
+
+async def serve(path, ready=None, **config):
+    if os.path.exists(path):
+        os.unlink(path)
+    broker = Broker(**config)
+    server = await asyncio.start_unix_server(broker.handle, path=path)
+    # Only processes running as the same user may join the layer.
+    os.chmod(path, 0o600)
+    sweeper = asyncio.ensure_future(broker.sweeper())
+    if ready is not None:
+        ready()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        sweeper.cancel()
+        if os.path.exists(path):
+            os.unlink(path)
@@ -0,0 +1,9 @@
+from django.conf import settings
+
+
+def chat_setting(name, defaults):
+    # Subsystem settings live in one dict per feature (like CHANNEL_LAYERS),
+    # so a project only has to override the keys it cares about.
+    config = dict(defaults)
+    config.update(getattr(settings, name, {}))
+    return config
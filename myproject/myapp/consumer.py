@@ -1,66 +1,108 @@
 import json
-from channels.db import database_sync_to_async
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from .models import PrivateRoomConnection, PrivateChatRoom, Message, PrivateMessage
-from django.db.models import Count
-from django.contrib.auth.models import User
-from asgiref.sync import sync_to_async
+from .announcements import join_announcer
+from .models import DEFAULT_ROOM, PrivateChatRoom, Message, PrivateMessage
+from .broadcast import BroadcastMixin
+from .db import db_read, db_write
+from .heartbeat import HeartbeatMixin
+from .history import history_cache
+from . import matchmaking
+from .metrics import MetricsMixin
+from .outbound import OutboundQueueMixin
+from .persistence import message_writer
+from .presence import presence
+from .profiling import TracingMixin, stage
+from .ratelimit import RateLimitMixin
+from .rooms import RoomMessagesMixin
+from .sharding import shard_router
+from .typing_indicators import typing_coalescer
 import uuid
 
-class ChatConsumer(AsyncWebsocketConsumer):
+ROOM_NAME_MAX = Message._meta.get_field('room').max_length
+
+
+def last_seen_id(scope):
+    """The message_id a reconnecting client last saw (?last_seen=...), if valid."""
+    values = parse_qs(scope.get('query_string', b'').decode()).get('last_seen')
+    try:
+        return str(uuid.UUID(values[-1])) if values else None
+    except ValueError:
+        return None
+
+
+class ChatConsumer(TracingMixin, MetricsMixin, BroadcastMixin, RateLimitMixin, OutboundQueueMixin, HeartbeatMixin, RoomMessagesMixin, AsyncWebsocketConsumer):
+    metrics_name = 'chat'
+
+    @property
+    def group(self):
+        return self.roomGroupName
 
     async def connect(self):
-        self.roomGroupName = 'group-chat'
+        # Resolved once at the handshake; the client's "username" is ignored.
+        self.user = self.scope['user']
+        self.room_name = self.scope['url_route']['kwargs'].get('room_name', DEFAULT_ROOM)
+        self.roomGroupName = None
+        if not self.user.is_authenticated or len(self.room_name) > ROOM_NAME_MAX:
+            await self.close()
+            return
+        if not shard_router.is_local(self.room_name):
+            # The room lives on another shard; tell the client where to go.
+            shard_router.rejected += 1
+            await self.accept()
+            await self.send(text_data=json.dumps({
+                'type': 'redirect',
+                'url': shard_router.socket_url(self.room_name)
+            }))
+            await self.close(code=4001)
+            return
+
+        self.roomGroupName = f'chat-{self.room_name}'
         await self.channel_layer.group_add(
             self.roomGroupName,
             self.channel_name
         )
+        first = presence.join(self.channel_name, self.user.id, self.roomGroupName)
         await self.accept()
 
-        await self.fetch_messages()
+        if not await self.resync(last_seen_id(self.scope)):
+            await self.fetch_messages()
 
-        await self.channel_layer.group_send(
-            self.roomGroupName,
-            {
-                'type': 'chat_message',
-                'message': f"{self.scope['user'].username} has connected.",
-                'username': 'System',
-                'time' : '',
-                'message_id': str(uuid.uuid4())
-            }
-        )
+        # Announced in batches; only a user's first connection to the room counts.
+        if first:
+            join_announcer.joined(self.roomGroupName, self.user.username)
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_send(
-            self.roomGroupName,
-            {
-                'type': 'chat_message',
-                'message': f"{self.scope['user'].username} has disconnected.",
-                'username': 'System',
-                'time' : '',
-                'message_id': str(uuid.uuid4())
-            }
-        )
+        if self.roomGroupName is None:
+            return
 
+        left = presence.leave(self.channel_name)
+        if left is not None and left[2]:
+            join_announcer.left(self.roomGroupName, self.user.username)
+
+        typing_coalescer.leave(self.roomGroupName, self.user.username)
         await self.channel_layer.group_discard(
             self.roomGroupName,
             self.channel_name
         )
 
     async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+        with stage('parse'):
+            text_data_json = json.loads(text_data)
         message_type = text_data_json['type']
+        if message_type != self.charged_type:
+            # json.loads keeps the last "type" key; the rate limit charged the first.
+            return
 
         if message_type == 'chat_message':
             message = text_data_json['message']
-            username = text_data_json['username']
+            username = self.user.username
             time = text_data_json['time']
             message_id = str(uuid.uuid4())
 
-            author_user = await self.get_user(username)
-            await self.save_message(author_user, message)
+            await self.save_message(self.user, message, message_id)
 
-            await self.channel_layer.group_send(
+            await self.broadcast(
                 self.roomGroupName,
                 {
                     'type': 'chat_message',
@@ -71,173 +113,97 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 }
             )
         elif message_type == 'typing':
-            username = text_data_json['username']
-            await self.channel_layer.group_send(
-                self.roomGroupName,
-                {
-                    'type': 'typing',
-                    'username': username
-                }
-            )
+            username = self.user.username
+            typing_coalescer.typing(self.roomGroupName, username)
         elif message_type == 'stop_typing':
-            username = text_data_json['username']
-            await self.channel_layer.group_send(
-                self.roomGroupName,
-                {
-                    'type': 'stop_typing',
-                    'username': username
-                }
-            )
+            username = self.user.username
+            typing_coalescer.stop_typing(self.roomGroupName, username)
         elif message_type == 'file_message':
-            file_name = text_data_json['file_name']
-            file_url = text_data_json['file_url']
-            username = text_data_json['username']
-            message_id = str(uuid.uuid4())
-
-            await self.channel_layer.group_send(
-                self.roomGroupName,
-                {
-                    'type': 'file_message',
-                    'file_name': file_name,
-                    'file_url': file_url,
-                    'username': username,
-                    'message_id': message_id
-                }
-            )
+            await self.share_file(text_data_json)
+        elif message_type == 'fetch_older':
+            await self.fetch_older(text_data_json.get('before'), text_data_json.get('limit'))
         elif message_type == 'reaction':
-            reaction = text_data_json['reaction']
-            message_id = text_data_json['message_id']
-            username = text_data_json['username']
+            await self.react(text_data_json['message_id'], text_data_json['reaction'])
 
-            await self.channel_layer.group_send(
-                self.roomGroupName,
-                {
-                    'type': 'reaction',
-                    'reaction': reaction,
-                    'message_id': message_id,
-                    'username': username
-                }
-            )
+    @db_read
+    def get_history_page(self, before, limit):
+        messages, next_cursor = Message.history_page(self.room_name, before, limit)
+        return self.messages_to_json(messages), next_cursor
 
-    async def fetch_messages(self):
-        messages = await self.get_last_10_messages()
-        messages_json = await sync_to_async(self.messages_to_json)(messages)
-        print(messages_json)
-        content = {
-            'type' : 'fetch_messages',
-            'messages' : messages_json
-        }
-        
-        await self.send(text_data=json.dumps(content))
-
-    @database_sync_to_async
-    def get_last_10_messages(self):
-        return list(Message.last_10_messages())
-
-    
-    def messages_to_json(self, messages):
-        result = []
-        for message in messages:
-            result.append(self.message_to_json(message))
-        return result
-
-    
-    def message_to_json(self, message):
-        return {
-            'username': message.author.username,
-            'message': message.content,
-            'time': str(message.timestamp)
-        }
-
-    @database_sync_to_async
-    def save_message(self, author, content):
-        Message.objects.create(author=author, content=content)
-
-    @database_sync_to_async
-    def get_user(self, username):
-        return User.objects.get(username=username)
-
-    async def chat_message(self, event):
-        message = event['message']
-        username = event['username']
-        time = event['time']
-        message_id = event['message_id']
-
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': message,
-            'username': username,
-            'time': time,
-            'message_id': message_id
-        }))
-
-    async def typing(self, event):
-        username = event['username']
-
-        await self.send(text_data=json.dumps({
-            'type': 'typing',
-            'username': username
-        }))
-
-    async def stop_typing(self, event):
-        username = event['username']
-
-        await self.send(text_data=json.dumps({
-            'type': 'stop_typing',
-            'username': username
-        }))
-
-    async def file_message(self, event):
-        file_name = event['file_name']
-        file_url = event['file_url']
-        username = event['username']
-        message_id = event['message_id']
-
-        await self.send(text_data=json.dumps({
-            'type': 'file_message',
-            'file_name': file_name,
-            'file_url': file_url,
-            'username': username,
-            'message_id': message_id
-        }))
-
-    async def reaction(self, event):
-        reaction = event['reaction']
-        message_id = event['message_id']
-        username = event['username']
-
-        await self.send(text_data=json.dumps({
-            'type': 'reaction',
-            'reaction': reaction,
-            'message_id': message_id,
-            'username': username
-        }))
-
-
-
-
-class PrivateChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        self.user = self.scope['user']
+    @db_read
+    def get_last_messages(self):
+        return self.messages_to_json(Message.last_messages(self.room_name, history_cache.depth))
+
+    @db_read
+    def get_resync_anchor(self, message_id):
+        return Message.resync_anchor(self.room_name, message_id)
+
+    @db_read
+    def get_messages_after(self, anchor, limit):
+        messages, next_anchor = Message.messages_after(self.room_name, anchor, limit)
+        return self.messages_to_json(messages), next_anchor
 
-        self.room_name = await self.find_or_create_room(self.user)
+    async def save_message(self, author, content, message_id):
+        message = Message(room=self.room_name, author=author, content=content, message_id=message_id)
+        message_json = self.message_to_json(message)
+        history_cache.append(self.roomGroupName, message_json)
+        await message_writer.save(message, message_json, room=self.roomGroupName)
 
-        room, created = await database_sync_to_async(PrivateChatRoom.objects.get_or_create)(name=self.room_name)
 
-        connection_count = await database_sync_to_async(PrivateRoomConnection.objects.filter(room=room).count)()
+class PrivateChatConsumer(TracingMixin, MetricsMixin, BroadcastMixin, RateLimitMixin, OutboundQueueMixin, HeartbeatMixin, RoomMessagesMixin, AsyncWebsocketConsumer):
+    metrics_name = 'private'
 
-        if connection_count >= 2:
+    @property
+    def group(self):
+        return self.room_name
+
+    async def connect(self):
+        self.user = self.scope['user']
+        self.room_name = None
+        self.room = None
+        self.last_seen = last_seen_id(self.scope)
+
+        if not self.user.is_authenticated:
             await self.close()
-        else:
-            await self.add_connection(room, self.user)
-            await self.channel_layer.group_add(self.room_name, self.channel_name)
-            await self.accept()
+            return
+
+        await self.accept()
+
+        while True:
+            partner = await matchmaking.pair(self.channel_layer, self.user.id, self.channel_name)
+            if partner is None:
+                await self.send(text_data=json.dumps({'type': 'waiting'}))
+                return
+            await self.get_or_create_room(partner.room_name)
+            # The partner may have disconnected while the room was created.
+            if await matchmaking.confirm(self.channel_layer, partner.channel_name):
+                break
+
+        await self.channel_layer.send(
+            partner.channel_name,
+            {
+                'type': 'match_found',
+                'room_name': partner.room_name
+            }
+        )
+        await self.join_room(partner.room_name)
+
+    async def match_found(self, event):
+        await matchmaking.joined(self.channel_layer, self.channel_name)
+        await self.join_room(event['room_name'])
+
+    async def join_room(self, room_name):
+        self.room = await self.get_room(room_name)
+        self.room_name = room_name
+        presence.join(self.channel_name, self.user.id, self.room_name)
+        await self.channel_layer.group_add(self.room_name, self.channel_name)
+        if not await self.resync(self.last_seen):
             await self.fetch_messages()
-            await self.channel_layer.group_send(
+        await self.broadcast(
             self.room_name,
             {
                 'type': 'chat_message',
-                'message': f"{self.scope['user'].username} has connected.",
+                'message': f"{self.user.username} has connected.",
                 'username': 'System',
                 'time' : '',
                 'message_id': str(uuid.uuid4())
@@ -246,36 +212,50 @@ class PrivateChatConsumer(AsyncWebsocketConsumer):
         )
 
     async def disconnect(self, close_code):
-
-        await self.channel_layer.group_send(
+        joined = self.room_name is not None
+        if not joined:
+            # Paired, but gone before joining the room: still tell the partner.
+            self.room_name = await matchmaking.leave(self.channel_layer, self.channel_name)
+            if self.room_name is None:
+                return
+
+        await self.broadcast(
             self.room_name,
             {
                 'type': 'chat_message',
-                'message': f"{self.scope['user'].username} has disconnected.",
+                'message': f"{self.user.username} has disconnected.",
                 'username': 'System',
                 'time' : '',
                 'message_id': str(uuid.uuid4())
             }
         )
 
-        await self.remove_connection(self.room_name, self.user)
-        await self.channel_layer.group_discard(self.room_name, self.channel_name)
+        if joined:
+            typing_coalescer.leave(self.room_name, self.user.username)
+            presence.leave(self.channel_name)
+            await self.channel_layer.group_discard(self.room_name, self.channel_name)
 
     async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+        if self.room_name is None:
+            # Still waiting for a partner.
+            return
+
+        with stage('parse'):
+            text_data_json = json.loads(text_data)
         message_type = text_data_json['type']
+        if message_type != self.charged_type:
+            # json.loads keeps the last "type" key; the rate limit charged the first.
+            return
         if message_type == 'chat_message':
             message = text_data_json['message']
-            username = text_data_json['username']
+            username = self.user.username
             time = text_data_json['time']
             message_id = str(uuid.uuid4())
 
-            author_user = await self.get_user(username)
-            room = await self.get_room(self.room_name)
-            await self.save_message(room, author_user, message)
+            await self.save_message(self.room, self.user, message, message_id)
 
 
-            await self.channel_layer.group_send(
+            await self.broadcast(
                 self.room_name,
                 {
                     'type': 'chat_message',
@@ -286,141 +266,45 @@ class PrivateChatConsumer(AsyncWebsocketConsumer):
                 }
             )
         elif message_type == 'typing':
-            username = text_data_json['username']
-            await self.channel_layer.group_send(
-                self.room_name,
-                {
-                    'type': 'typing',
-                    'username': username
-                }
-            )
+            username = self.user.username
+            typing_coalescer.typing(self.room_name, username)
         elif message_type == 'stop_typing':
-            username = text_data_json['username']
-            await self.channel_layer.group_send(
-                self.room_name,
-                {
-                    'type': 'stop_typing',
-                    'username': username
-                }
-            )
+            username = self.user.username
+            typing_coalescer.stop_typing(self.room_name, username)
 
         elif message_type == 'file_message':
-            file_name = text_data_json['file_name']
-            file_url = text_data_json['file_url']
-            username = text_data_json['username']
-            message_id = str(uuid.uuid4())
-            await self.channel_layer.group_send(
-                self.room_name,
-                {
-                    'type': 'file_message',
-                    'file_name': file_name,
-                    'file_url': file_url,
-                    'username': username,
-                    'message_id' : message_id
-                }
-            )
+            await self.share_file(text_data_json)
 
+        elif message_type == 'fetch_older':
+            await self.fetch_older(text_data_json.get('before'), text_data_json.get('limit'))
         elif message_type == 'reaction':
-            reaction = text_data_json['reaction']
-            message_id = text_data_json['message_id']
-            username = text_data_json['username']
-            
-            await self.channel_layer.group_send(
-                self.room_name,
-                {
-                    'type': 'reaction',
-                    'reaction': reaction,
-                    'message_id': message_id,
-                    'username': username
-                }
-            )
+            await self.react(text_data_json['message_id'], text_data_json['reaction'])
+
+    @db_read
+    def get_history_page(self, before, limit):
+        messages, next_cursor = PrivateMessage.history_page(self.room, before, limit)
+        return self.messages_to_json(messages), next_cursor
+
+    @db_read
+    def get_last_messages(self):
+        return self.messages_to_json(PrivateMessage.last_messages(self.room, history_cache.depth))
+
+    @db_read
+    def get_resync_anchor(self, message_id):
+        return PrivateMessage.resync_anchor(self.room, message_id)
+
+    @db_read
+    def get_messages_after(self, anchor, limit):
+        messages, next_anchor = PrivateMessage.messages_after(self.room, anchor, limit)
+        return self.messages_to_json(messages), next_anchor
+
+    async def save_message(self, room, author, content, message_id):
+        message = PrivateMessage(room=room, author=author, content=content, message_id=message_id)
+        message_json = self.message_to_json(message)
+        history_cache.append(self.room_name, message_json)
+        await message_writer.save(message, message_json, room=self.room_name)
 
-    async def chat_message(self, event):
-        message = event['message']
-        username = event['username']
-        time = event['time']
-        message_id = event['message_id']
-
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': message,
-            'username': username,
-            'time': time,
-            'message_id': message_id
-        }))
-
-    async def typing(self, event):
-        username = event['username']
-
-        await self.send(text_data=json.dumps({
-            'type': 'typing',
-            'username': username
-        }))
-
-    async def stop_typing(self, event):
-        username = event['username']
-
-        await self.send(text_data=json.dumps({
-            'type': 'stop_typing',
-            'username': username
-        }))
-
-    async def file_message(self, event):
-        file_name = event['file_name']
-        file_url = event['file_url']
-        username = event['username']
-        message_id = event['message_id']
-
-        await self.send(text_data=json.dumps({
-            'type': 'file_message',
-            'file_name': file_name,
-            'file_url': file_url,
-            'username': username,
-            'message_id' : message_id
-        }))
-
-    async def reaction(self, event):
-        reaction = event['reaction']
-        message_id = event['message_id']
-        username = event['username']
-        
-        await self.send(text_data=json.dumps({
-            'type': 'reaction',
-            'reaction': reaction,
-            'message_id': message_id,
-            'username': username
-        }))
-
-    async def fetch_messages(self):
-        room = await self.get_room(self.room_name)
-        messages = await self.get_last_10_messages(room)
-        messages_json = await sync_to_async(self.messages_to_json)(messages)
-
-        content = {
-
-            'type' : 'fetch_messages',
-            'messages' : messages_json
-
-        }
-
-        await self.send(text_data=json.dumps(content))
-
-    @database_sync_to_async
-    def get_last_10_messages(self, room):
-        return list(PrivateMessage.last_10_messages(room))
-    
-    def messages_to_json(self, messages):
-        return [{'username': msg.author.username, 'message': msg.content, 'time': str(msg.timestamp)} for msg in messages]
-    
-    @database_sync_to_async
-    def save_message(self, room, author, content):
-        PrivateMessage.objects.create(room=room, author=author, content=content)
-
-    @database_sync_to_async
-    def get_user(self, username):
-        return User.objects.get(username=username)
-
-    @database_sync_to_async
+    @db_read
     def get_room(self, room_name):
         return PrivateChatRoom.objects.get(name=room_name)
 
@@ -431,27 +315,10 @@ class PrivateChatConsumer(AsyncWebsocketConsumer):
         time = event["time"]
         await self.send(text_data=json.dumps({"message": message, "username": username, "time": time}))
 
-    @database_sync_to_async
-    def find_or_create_room(self, user):
-        
-        available_room = PrivateChatRoom.objects.annotate(num_connections=Count('privateroomconnection')).filter(num_connections=1).first()
-        if available_room:
-            return available_room.name
-        else:
-            
-            room_name = f"private_chat_{user.id}_{User.objects.order_by('?').first().id}"
-            room, created = PrivateChatRoom.objects.get_or_create(name=room_name)
-            return room.name
-
-    @database_sync_to_async
-    def add_connection(self, room, user):
-        if PrivateRoomConnection.objects.filter(room=room).count() < 2:
-            PrivateRoomConnection.objects.create(room=room, user=user)
-
-    @database_sync_to_async
-    def remove_connection(self, room_name, user):
-        room = PrivateChatRoom.objects.get(name=room_name)
-        PrivateRoomConnection.objects.filter(room=room, user=user).delete()
+    @db_write
+    def get_or_create_room(self, room_name):
+        room, created = PrivateChatRoom.objects.get_or_create(name=room_name)
+        return room
 
 
 
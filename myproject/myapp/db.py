@@ -0,0 +1,133 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections, connection
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from . import metrics, stats
+from .profiling import stage
+from .conf import chat_setting
+
+DEFAULTS = {
+    # Threads for queries that only read; these run in parallel.
+    'READ_WORKERS': 4,
+    # Threads for queries that write. None means one thread on SQLite,
+    # which allows a single writer at a time, and READ_WORKERS elsewhere.
+    'WRITE_WORKERS': None,
+}
+
+
+class DatabaseExecutor:
+    """
+    Bounded thread pool for ORM calls made from consumers.
+
+    Each thread keeps its own Django connection between calls (subject to
+    CONN_MAX_AGE), so a busy pool does not reconnect per query. Queue depth,
+    wait time (submitted -> started) and run time are tracked per pool.
+    """
+
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self.calls = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self._queued = 0
+        self._lock = threading.Lock()
+        self._wait_seconds = metrics.db_wait_seconds.labels(name)
+        self._run_seconds = metrics.db_run_seconds.labels(name)
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix=f'db-{name}')
+
+    async def run(self, func, *args, **kwargs):
+        submitted = time.perf_counter()
+        timings = []
+
+        def call():
+            started = time.perf_counter()
+            with self._lock:
+                self._queued -= 1
+            timings.append(started - submitted)
+            close_old_connections()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                close_old_connections()
+                timings.append(time.perf_counter() - started)
+
+        with self._lock:
+            self._queued += 1
+        try:
+            with stage('db'):
+                return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            if len(timings) == 2:
+                wait, run = timings
+                self.calls += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                self.run_total += run
+                self._wait_seconds.observe(wait)
+                self._run_seconds.observe(run)
+
+    @property
+    def queued(self):
+        return self._queued
+
+    def stats(self):
+        return {
+            'workers': self.max_workers,
+            'queued': self.queued,
+            'calls': self.calls,
+            'errors': self.errors,
+            'wait_avg': self.wait_total / self.calls if self.calls else None,
+            'wait_max': self.wait_max,
+            'run_avg': self.run_total / self.calls if self.calls else None,
+        }
+
+
+def db_read(func):
+    """Like database_sync_to_async, for calls that only read."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await read_executor.run(func, *args, **kwargs)
+    return wrapper
+
+
+def db_write(func):
+    """Like database_sync_to_async, for calls that write."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await write_executor.run(func, *args, **kwargs)
+    return wrapper
+
+
+@receiver(connection_created)
+def enable_wal(sender, connection, **kwargs):
+    # WAL lets the read pool keep reading while the write thread commits.
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+
+
+def _build_executors():
+    config = chat_setting('CHAT_DB_EXECUTOR', DEFAULTS)
+    write_workers = config['WRITE_WORKERS']
+    if write_workers is None:
+        write_workers = 1 if connection.vendor == 'sqlite' else config['READ_WORKERS']
+    return (
+        DatabaseExecutor('read', config['READ_WORKERS']),
+        DatabaseExecutor('write', write_workers),
+    )
+
+
+read_executor, write_executor = _build_executors()
+stats.register('db', lambda: {'read': read_executor.stats(), 'write': write_executor.stats()})
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import logging
+import time
+import weakref
+
+from channels.exceptions import StopConsumer
+
+from . import stats
+from .conf import chat_setting
+from .presence import presence
+from .ratelimit import peek_type
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    # Seconds without a frame from the client before it is sent a ping
+    # (the templates answer with a pong); also how often the reaper runs.
+    'INTERVAL': 20,
+    # Seconds without any frame, pongs included, before the connection is
+    # considered dead and reaped.
+    'IDLE_TIMEOUT': 60,
+}
+
+IDLE_CLOSE_CODE = 4009
+
+PING = json.dumps({'type': 'ping'})
+
+_connections = weakref.WeakSet()
+
+
+class HeartbeatMixin:
+    """
+    Application-level ping/pong, so half-open connections are noticed.
+
+    Any frame from the client counts as a sign of life. A connection that
+    has been quiet for INTERVAL gets a ping; one quiet for IDLE_TIMEOUT is
+    reaped: its disconnect() runs at once, which leaves its groups and
+    presence, and it is closed with IDLE_CLOSE_CODE. The server's own
+    disconnect, whenever it comes, does not run the cleanup again.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.heard_at = time.monotonic()
+        self.reaped = False
+
+    async def websocket_connect(self, message):
+        self.heard_at = time.monotonic()
+        _connections.add(self)
+        reaper.ensure_running()
+        await super().websocket_connect(message)
+
+    async def websocket_receive(self, message):
+        if self.reaped:
+            return
+        self.heard_at = time.monotonic()
+        presence.touch(self.channel_name)
+        text = message.get('text')
+        if text is not None and peek_type(text) == 'pong':
+            reaper.pongs += 1
+            return
+        await super().websocket_receive(message)
+
+    async def websocket_disconnect(self, message):
+        _connections.discard(self)
+        if self.reaped:
+            # reap() already ran disconnect().
+            raise StopConsumer()
+        await super().websocket_disconnect(message)
+
+    async def reap(self):
+        self.reaped = True
+        _connections.discard(self)
+        try:
+            await self.disconnect(IDLE_CLOSE_CODE)
+        finally:
+            await self.close(IDLE_CLOSE_CODE)
+
+
+class Reaper:
+    """Pings quiet connections and reaps dead ones, every INTERVAL seconds."""
+
+    def __init__(self, interval, idle_timeout):
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.pings = 0
+        self.pongs = 0
+        self.reaped = 0
+        self.failed = 0
+        self._task = None
+
+    def ensure_running(self):
+        if (self._task is None or self._task.done()
+                or self._task.get_loop() is not asyncio.get_running_loop()):
+            self._task = asyncio.ensure_future(self._run())
+
+    async def sweep(self):
+        now = time.monotonic()
+        for consumer in list(_connections):
+            idle = now - consumer.heard_at
+            if idle >= self.idle_timeout:
+                self.reaped += 1
+                try:
+                    await consumer.reap()
+                except Exception:
+                    self.failed += 1
+                    logger.exception('Failed to clean up reaped connection %s', consumer.channel_name)
+            elif idle >= self.interval:
+                self.pings += 1
+                await consumer.send(text_data=PING, droppable=True)
+
+    def stats(self):
+        return {
+            'connections': len(_connections),
+            'pings': self.pings,
+            'pongs': self.pongs,
+            'reaped': self.reaped,
+            'reap_failures': self.failed,
+        }
+
+    async def _run(self):
+        while _connections:
+            await asyncio.sleep(self.interval)
+            await self.sweep()
+
+
+def _build_reaper():
+    config = chat_setting('CHAT_HEARTBEAT', DEFAULTS)
+    return Reaper(interval=config['INTERVAL'], idle_timeout=config['IDLE_TIMEOUT'])
+
+
+reaper = _build_reaper()
+stats.register('heartbeat', reaper.stats)
@@ -0,0 +1,126 @@
+import asyncio
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+from . import stats
+from .conf import chat_setting
+from .persistence import message_writer
+
+DEFAULTS = {
+    # Messages kept per room and sent to a client on connect.
+    'DEPTH': 10,
+    # Rooms kept in memory; the least recently used one is evicted first.
+    'MAX_ROOMS': 1000,
+    # None: cache only with the in-memory channel layer. With several
+    # workers sharing a layer, each worker's cache would miss the messages
+    # written by the others, so every get() reads the database instead.
+    'ENABLED': None,
+}
+
+IN_MEMORY_LAYER = 'channels.layers.InMemoryChannelLayer'
+
+
+class HistoryCache:
+    """
+    Bounded, per-room ring buffers of already-serialized recent messages.
+
+    A room is warmed from the database the first time it is asked for and
+    from then on is kept current by append() on every write. When disabled,
+    get() always reads through to the database and append() does nothing.
+    """
+
+    def __init__(self, depth, max_rooms, enabled=True):
+        self.depth = depth
+        self.max_rooms = max_rooms
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._rooms = OrderedDict()
+        self._loading = {}
+        self._appended = {}
+
+    async def get(self, key, loader):
+        """
+        Return the room's recent messages, newest first. `loader` is an
+        async callable returning up to `depth` serialized messages from the
+        database, newest first; it only runs on a miss.
+        """
+        if not self.enabled:
+            self.misses += 1
+            # This worker's queued messages for the room at least; other
+            # workers flush theirs within FLUSH_INTERVAL.
+            await message_writer.flush_unsaved(room=key)
+            return await loader()
+
+        room = self._rooms.get(key)
+        if room is not None:
+            self.hits += 1
+            self._rooms.move_to_end(key)
+            return list(reversed(room))
+
+        self.misses += 1
+        loading = self._loading.get(key)
+        if loading is None:
+            # Concurrent connects to a cold room share one database read.
+            loading = asyncio.ensure_future(self._warm(key, loader))
+            self._loading[key] = loading
+        room = await asyncio.shield(loading)
+        return list(reversed(room))
+
+    def append(self, key, message_json):
+        """
+        Record a message for the room. Call this in the same step that
+        queues the message with message_writer, with no await in between.
+        """
+        if not self.enabled:
+            return
+        room = self._rooms.get(key)
+        if room is not None:
+            room.append(message_json)
+            self._rooms.move_to_end(key)
+        elif key in self._appended:
+            self._appended[key].append(message_json)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'rooms': len(self._rooms),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    async def _warm(self, key, loader):
+        # drained() writes whatever is queued right now and holds back every
+        # later write until the read is done. Messages queued from this point
+        # on are therefore not in `rows` and are collected by append().
+        self._appended[key] = []
+        try:
+            async with message_writer.drained():
+                rows = await loader()
+        finally:
+            appended = self._appended.pop(key)
+            self._loading.pop(key, None)
+
+        room = deque(reversed(rows), maxlen=self.depth)
+        room.extend(appended)
+        self._rooms[key] = room
+
+        while len(self._rooms) > self.max_rooms:
+            self._rooms.popitem(last=False)
+            self.evictions += 1
+        return room
+
+
+def _build_cache():
+    config = chat_setting('CHAT_HISTORY', DEFAULTS)
+    enabled = config['ENABLED']
+    if enabled is None:
+        enabled = settings.CHANNEL_LAYERS['default']['BACKEND'] == IN_MEMORY_LAYER
+    return HistoryCache(depth=config['DEPTH'], max_rooms=config['MAX_ROOMS'], enabled=enabled)
+
+
+history_cache = _build_cache()
+stats.register('history', history_cache.stats)
@@ -0,0 +1,90 @@
+import time
+from collections import OrderedDict
+
+from channels.auth import AuthMiddleware, get_user
+from channels.sessions import CookieMiddleware, SessionMiddleware
+
+from . import stats
+from .conf import chat_setting
+
+DEFAULTS = {
+    # Seconds a session -> user resolution is reused for new connections.
+    'TTL': 60,
+    # Sessions remembered; the least recently used are forgotten first.
+    'MAX_SESSIONS': 10000,
+}
+
+
+class SessionUserCache:
+    """
+    Bounded TTL cache of session key -> authenticated user.
+
+    A websocket handshake through AuthMiddlewareStack loads the session and
+    then the user, two queries per connection. Reconnects and extra tabs
+    reuse the same session, so they are answered from here instead. Only
+    authenticated users are cached; logout_view invalidates the session's
+    entry in this process, other processes drop it within TTL.
+    """
+
+    def __init__(self, ttl, max_sessions):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.hits = 0
+        self.misses = 0
+        self._users = OrderedDict()
+
+    def get(self, session_key):
+        entry = self._users.get(session_key)
+        if entry is None:
+            self.misses += 1
+            return None
+        user, expires = entry
+        if expires <= time.monotonic():
+            del self._users[session_key]
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._users.move_to_end(session_key)
+        return user
+
+    def put(self, session_key, user):
+        self._users[session_key] = (user, time.monotonic() + self.ttl)
+        self._users.move_to_end(session_key)
+        while len(self._users) > self.max_sessions:
+            self._users.popitem(last=False)
+
+    def invalidate(self, session_key):
+        self._users.pop(session_key, None)
+
+    def stats(self):
+        return {
+            'sessions': len(self._users),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    """AuthMiddleware that resolves scope['user'] through session_users."""
+
+    async def resolve_scope(self, scope):
+        session_key = scope['session'].session_key
+        user = session_users.get(session_key) if session_key else None
+        if user is None:
+            user = await get_user(scope)
+            if session_key and user.is_authenticated:
+                session_users.put(session_key, user)
+        scope['user']._wrapped = user
+
+
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
+
+
+def _build_cache():
+    config = chat_setting('CHAT_IDENTITY', DEFAULTS)
+    return SessionUserCache(ttl=config['TTL'], max_sessions=config['MAX_SESSIONS'])
+
+
+session_users = _build_cache()
+stats.register('identity', session_users.stats)
@@ -0,0 +1,181 @@
+import asyncio
+import itertools
+import random
+import string
+from collections import deque
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+from .broker import encode_frame, read_frame
+from .matchmaking import Ticket
+
+
+class BrokerConnection:
+    """One socket to the broker, shared by every consumer on an event loop."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}
+        self.ids = itertools.count(1)
+        # Messages the broker handed over for a receive() that was cancelled
+        # in the meantime; the next receive() on that channel gets them.
+        self.stranded = {}
+        self.reader_task = asyncio.ensure_future(self.read_responses())
+
+    async def request(self, op, **fields):
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(encode_frame(dict(fields, op=op, id=request_id)))
+        try:
+            await self.writer.drain()
+            return await future
+        except asyncio.CancelledError:
+            if self.pending.pop(request_id, None) is not None and op == 'receive':
+                self.notify('cancel', channel=fields['channel'], cancel=request_id)
+            raise
+
+    def notify(self, op, **fields):
+        if not self.writer.is_closing():
+            self.writer.write(encode_frame(dict(fields, op=op, id=next(self.ids))))
+
+    async def read_responses(self):
+        try:
+            while True:
+                response = await read_frame(self.reader)
+                future = self.pending.pop(response['id'], None)
+                if future is None:
+                    if 'message' in response:
+                        # Whoever asked stopped waiting; keep it for the channel.
+                        self.stranded.setdefault(response['channel'], deque()).append(response['message'])
+                    continue
+                if not future.done():
+                    future.set_result(response)
+        except (asyncio.IncompleteReadError, ConnectionError) as exc:
+            error = ConnectionError('Lost connection to the channel layer broker')
+            error.__cause__ = exc
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.pending.clear()
+        finally:
+            self.writer.close()
+
+    @property
+    def closed(self):
+        return self.reader_task.done()
+
+    async def close(self):
+        self.reader_task.cancel()
+        try:
+            await self.reader_task
+        except asyncio.CancelledError:
+            pass
+
+
+class LocalBrokerChannelLayer(BaseChannelLayer):
+    """
+    Channel layer backed by the local broker (myapp.broker), letting
+    several worker processes on one host share channels and groups.
+
+    Messages travel as JSON, so they must be JSON-serializable. Capacity,
+    message expiry and group expiry are enforced by the broker, which
+    takes them from the same CONFIG. The broker also keeps the private chat
+    queue, so users on different workers are paired (myapp.matchmaking).
+    """
+
+    extensions = ['groups', 'flush', 'matchmaking']
+
+    def __init__(self, path, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.path = path
+        self.group_expiry = group_expiry
+        self._connections = {}
+
+    async def _connection(self):
+        loop = asyncio.get_running_loop()
+        connection = self._connections.get(loop)
+        if connection is None or connection.closed:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+            connection = BrokerConnection(reader, writer)
+            self._connections[loop] = connection
+        return connection
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        connection = await self._connection()
+        response = await connection.request('send', channel=channel, message=message)
+        if response.get('error') == 'full':
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        connection = await self._connection()
+        stranded = connection.stranded.get(channel)
+        if stranded:
+            message = stranded.popleft()
+            if not stranded:
+                del connection.stranded[channel]
+            return message
+        response = await connection.request('receive', channel=channel)
+        return response['message']
+
+    async def new_channel(self, prefix='specific.'):
+        suffix = ''.join(random.choice(string.ascii_letters) for _ in range(12))
+        return f'{prefix}.localbroker!{suffix}'
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        connection = await self._connection()
+        await connection.request('group_add', group=group, channel=channel)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        connection = await self._connection()
+        await connection.request('group_discard', group=group, channel=channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_group_name(group)
+        connection = await self._connection()
+        await connection.request('group_send', group=group, message=message)
+
+    async def match_pair(self, user_id, channel_name):
+        connection = await self._connection()
+        response = await connection.request('match_pair', user_id=user_id, channel=channel_name)
+        if 'error' in response:
+            raise ValueError(response['error'])
+        partner = response['partner']
+        if partner is None:
+            return None
+        ticket = Ticket(partner['user_id'], partner['channel_name'])
+        ticket.room_name = partner['room_name']
+        return ticket
+
+    async def match_confirm(self, channel_name):
+        connection = await self._connection()
+        response = await connection.request('match_confirm', channel=channel_name)
+        return response['confirmed']
+
+    async def match_joined(self, channel_name):
+        connection = await self._connection()
+        await connection.request('match_joined', channel=channel_name)
+
+    async def match_leave(self, channel_name):
+        connection = await self._connection()
+        response = await connection.request('match_leave', channel=channel_name)
+        return response['room_name']
+
+    async def flush(self):
+        connection = await self._connection()
+        await connection.request('flush')
+
+    async def close(self):
+        connection = self._connections.pop(asyncio.get_running_loop(), None)
+        if connection is not None:
+            await connection.close()
@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from myapp import archive
+
+
+class Command(BaseCommand):
+    help = ('Move chat messages older than CHAT_ARCHIVE MAX_AGE_DAYS into compressed archive segments '
+            '(move), merge small segments (compact), or check every segment (verify).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', nargs='?', default='move', choices=('move', 'compact', 'verify'))
+        parser.add_argument('--days', type=int, help='Archive messages older than this instead of MAX_AGE_DAYS.')
+        parser.add_argument('--room', action='append', dest='rooms',
+                            help='Only this room (public room name or private room id); may be repeated.')
+
+    def handle(self, *args, **options):
+        action = options['action']
+        if action == 'move':
+            days = options['days'] if options['days'] is not None else archive.config['MAX_AGE_DAYS']
+            cutoff = timezone.now() - timedelta(days=days)
+            moved = archive.archive_messages(cutoff, options['rooms'])
+            self.stdout.write(f'Archived {moved} messages older than {cutoff:%Y-%m-%d %H:%M}')
+        elif action == 'compact':
+            removed = archive.compact()
+            self.stdout.write(f'Compaction removed {removed} segments')
+        else:
+            problems = archive.verify()
+            for problem in problems:
+                self.stderr.write(problem)
+            if problems:
+                raise CommandError(f'{len(problems)} problems found')
+            self.stdout.write('All segments verified')
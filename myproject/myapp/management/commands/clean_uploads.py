@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from myapp import uploads
+
+
+class Command(BaseCommand):
+    help = ('Delete chunked uploads that have not received a chunk for CHAT_UPLOADS ABANDONED_AFTER_HOURS, '
+            'with their partial files under uploads/partial/. Meant to be run from cron.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, help='Treat uploads idle for this long as abandoned instead.')
+
+    def handle(self, *args, **options):
+        hours = options['hours'] if options['hours'] is not None else uploads.config['ABANDONED_AFTER_HOURS']
+        removed = uploads.clean_partials(hours * 3600)
+        self.stdout.write(f'Removed {removed} abandoned uploads idle for over {hours:g} hours')
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from myapp import search
+
+
+class Command(BaseCommand):
+    help = 'Re-index all chat messages for search, e.g. after rows were loaded with the triggers off.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-optimize', action='store_true', help='Skip merging the index afterwards.')
+
+    def handle(self, *args, **options):
+        if not search.available():
+            raise CommandError('Message search needs SQLite (FTS5).')
+
+        for index in search.INDEXES:
+            with transaction.atomic(), connection.cursor() as cursor:
+                index.rebuild(cursor)
+                if not options['no_optimize']:
+                    index.optimize(cursor)
+            self.stdout.write(f'Rebuilt {index.fts_table}')
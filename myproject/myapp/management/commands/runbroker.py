@@ -0,0 +1,28 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp import broker
+
+BACKEND = 'myapp.layers.LocalBrokerChannelLayer'
+
+
+class Command(BaseCommand):
+    help = 'Run the local channel layer broker shared by all Daphne workers on this host.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--alias', default='default', help='CHANNEL_LAYERS entry to serve.')
+
+    def handle(self, *args, **options):
+        layer = settings.CHANNEL_LAYERS.get(options['alias'])
+        if layer is None or layer.get('BACKEND') != BACKEND:
+            raise CommandError(f"CHANNEL_LAYERS[{options['alias']!r}] does not use {BACKEND}.")
+
+        config = dict(layer.get('CONFIG', {}))
+        path = config.pop('path')
+        self.stdout.write(f'Channel layer broker listening on {path}')
+        try:
+            asyncio.run(broker.serve(path, **config))
+        except KeyboardInterrupt:
+            pass
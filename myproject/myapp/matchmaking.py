@@ -0,0 +1,156 @@
+import time
+from collections import OrderedDict, deque
+
+from . import stats
+
+# How many recent time-to-match samples the percentiles are computed over.
+WAIT_SAMPLES = 1000
+
+
+class Ticket:
+    def __init__(self, user_id, channel_name):
+        self.user_id = user_id
+        self.channel_name = channel_name
+        self.enqueued_at = time.monotonic()
+        # Set when a partner picks this ticket up.
+        self.room_name = None
+        # Set once that partner has created the room (confirm()).
+        self.confirmed = False
+
+
+def room_name_for(user_id, other_user_id):
+    # The same two users always land in the same room, and so see their history.
+    low, high = sorted((user_id, other_user_id))
+    return f"private_chat_{low}_{high}"
+
+
+class Matchmaker:
+    """
+    FIFO queue of users waiting for a private chat partner.
+
+    pair() and leave() never await, so on the event loop each call is
+    atomic with respect to every other connect and disconnect. Consumers go
+    through the module functions below, which use this process's queue, or
+    the one the broker keeps for every worker when the channel layer has it
+    (CHAT_CHANNEL_BROKER); the broker's counters are not in these stats.
+    """
+
+    def __init__(self):
+        self.matches = 0
+        self.cancelled = 0
+        self._waiting = OrderedDict()
+        # channel -> ticket taken by a partner, until match_found arrives
+        self._matched = {}
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+
+    def pair(self, user_id, channel_name):
+        """
+        Pair with the longest-waiting other user, or join the queue.
+
+        Returns (partner_ticket, None) when a pair forms; the partner's
+        ticket carries the new room name. Otherwise returns (None, ticket)
+        for the caller's own place in the queue.
+        """
+        if user_id is None:
+            raise ValueError('Anonymous users cannot be matched')
+        for waiting_channel, ticket in self._waiting.items():
+            if ticket.user_id != user_id:
+                # Everything that can fail happens before the ticket is taken.
+                room_name = room_name_for(user_id, ticket.user_id)
+                del self._waiting[waiting_channel]
+                ticket.room_name = room_name
+                self._matched[waiting_channel] = ticket
+                self.matches += 1
+                self._waits.append(time.monotonic() - ticket.enqueued_at)
+                return ticket, None
+
+        ticket = Ticket(user_id, channel_name)
+        self._waiting[channel_name] = ticket
+        return None, ticket
+
+    def confirm(self, channel_name):
+        """
+        Called by the partner once the room exists. False if this ticket's
+        user left in the meantime; the partner should pair() again.
+        """
+        ticket = self._matched.get(channel_name)
+        if ticket is None:
+            return False
+        ticket.confirmed = True
+        return True
+
+    def joined(self, channel_name):
+        """The paired user got match_found and is joining the room."""
+        self._matched.pop(channel_name, None)
+
+    def leave(self, channel_name):
+        """
+        Leave the queue. Returns the room name if a partner had already
+        paired with this ticket and confirmed it, so the partner can be
+        told; an unconfirmed partner finds the ticket gone and pairs again.
+        """
+        if self._waiting.pop(channel_name, None) is not None:
+            self.cancelled += 1
+            return None
+        ticket = self._matched.pop(channel_name, None)
+        if ticket is None:
+            return None
+        if not ticket.confirmed:
+            self.cancelled += 1
+            return None
+        return ticket.room_name
+
+    @property
+    def depth(self):
+        return len(self._waiting)
+
+    def stats(self):
+        waits = sorted(self._waits)
+        return {
+            'queue_depth': self.depth,
+            'matches': self.matches,
+            'cancelled': self.cancelled,
+            'time_to_match_p50': _percentile(waits, 0.50),
+            'time_to_match_p95': _percentile(waits, 0.95),
+            'time_to_match_max': waits[-1] if waits else None,
+        }
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def _shared(layer):
+    return 'matchmaking' in getattr(layer, 'extensions', ())
+
+
+async def pair(layer, user_id, channel_name):
+    """The partner's ticket, or None when the caller is queued instead."""
+    if _shared(layer):
+        return await layer.match_pair(user_id, channel_name)
+    return matchmaker.pair(user_id, channel_name)[0]
+
+
+async def confirm(layer, channel_name):
+    if _shared(layer):
+        return await layer.match_confirm(channel_name)
+    return matchmaker.confirm(channel_name)
+
+
+async def joined(layer, channel_name):
+    if _shared(layer):
+        await layer.match_joined(channel_name)
+    else:
+        matchmaker.joined(channel_name)
+
+
+async def leave(layer, channel_name):
+    if _shared(layer):
+        return await layer.match_leave(channel_name)
+    return matchmaker.leave(channel_name)
+
+
+matchmaker = Matchmaker()
+stats.register('matchmaking', matchmaker.stats)
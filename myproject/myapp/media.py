@@ -0,0 +1,175 @@
+import asyncio
+import mimetypes
+import os
+import re
+import stat
+
+from django.conf import settings
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+
+from .conf import chat_setting
+from .uploads import CAS_DIR, PARTIAL_DIR
+
+DEFAULTS = {
+    # Bytes read per body message when the server has no zero-copy send.
+    'CHUNK_SIZE': 64 * 1024,
+    # Cache lifetime for content-addressed files, which never change.
+    'IMMUTABLE_MAX_AGE': 365 * 24 * 60 * 60,
+}
+
+IMMUTABLE_PREFIXES = (f'{CAS_DIR}/',)
+# Never served: chunked uploads still being written.
+PRIVATE_PREFIXES = (f'{PARTIAL_DIR}/',)
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class MediaApplication:
+    """
+    ASGI app serving MEDIA_ROOT ahead of Django, for every other path it
+    hands the request on to `application`.
+
+    Files go out with the server's zero-copy extension when it offers one
+    (http.response.zerocopysend, or pathsend for whole files), otherwise
+    in CHUNK_SIZE reads off the event loop. Single byte ranges, ETag /
+    Last-Modified revalidation and immutable caching for cas/ are
+    supported.
+    """
+
+    def __init__(self, application, root=None, url=None):
+        self.application = application
+        self.root = os.path.realpath(root or settings.MEDIA_ROOT)
+        self.prefix = '/' + (url or settings.MEDIA_URL).strip('/') + '/'
+        config = chat_setting('CHAT_MEDIA', DEFAULTS)
+        self.chunk_size = config['CHUNK_SIZE']
+        self.immutable = f'public, max-age={config["IMMUTABLE_MAX_AGE"]}, immutable'.encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(self.prefix):
+            return await self.application(scope, receive, send)
+        await self.serve(scope, send)
+
+    def resolve(self, name):
+        if any(part in ('.', '..') for part in name.split('/')):
+            return None
+        path = os.path.realpath(os.path.join(self.root, name))
+        if not path.startswith(self.root + os.sep):
+            return None
+        # Checked on the resolved name, so // or a symlink can't dodge it.
+        if os.path.relpath(path, self.root).replace(os.sep, '/').startswith(PRIVATE_PREFIXES):
+            return None
+        return path
+
+    async def serve(self, scope, send):
+        if scope['method'] not in ('GET', 'HEAD'):
+            return await respond(send, 405, [(b'allow', b'GET, HEAD')])
+
+        name = scope['path'][len(self.prefix):]
+        path = self.resolve(name)
+        try:
+            info = os.stat(path) if path else None
+        except OSError:
+            info = None
+        if info is None or not stat.S_ISREG(info.st_mode):
+            return await respond(send, 404)
+
+        request_headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']}
+        etag = f'"{info.st_mtime_ns:x}-{info.st_size:x}"'
+        headers = [
+            (b'etag', etag.encode()),
+            (b'last-modified', http_date(info.st_mtime).encode()),
+            (b'cache-control', self.immutable if name.startswith(IMMUTABLE_PREFIXES) else b'no-cache'),
+        ]
+        if not_modified(request_headers, etag, info.st_mtime):
+            return await respond(send, 304, headers)
+
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        headers += [
+            (b'content-type', content_type.encode()),
+            (b'accept-ranges', b'bytes'),
+            (b'x-content-type-options', b'nosniff'),
+        ]
+
+        size = info.st_size
+        start, end, status = 0, size - 1, 200
+        if 'range' in request_headers and if_range_matches(request_headers.get('if-range'), etag, info.st_mtime):
+            byte_range = parse_range(request_headers['range'], size)
+            if byte_range is False:
+                return await respond(send, 416, headers + [(b'content-range', f'bytes */{size}'.encode())])
+            if byte_range is not None:
+                start, end = byte_range
+                status = 206
+                headers.append((b'content-range', f'bytes {start}-{end}/{size}'.encode()))
+        count = end - start + 1
+
+        headers.append((b'content-length', str(count).encode()))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        if scope['method'] == 'HEAD' or count <= 0:
+            return await send({'type': 'http.response.body', 'body': b''})
+
+        extensions = scope.get('extensions') or {}
+        if 'http.response.pathsend' in extensions and status == 200:
+            return await send({'type': 'http.response.pathsend', 'path': path})
+
+        loop = asyncio.get_running_loop()
+        with open(path, 'rb') as file:
+            if 'http.response.zerocopysend' in extensions:
+                return await send({'type': 'http.response.zerocopysend', 'file': file, 'offset': start, 'count': count})
+            file.seek(start)
+            while count:
+                chunk = await loop.run_in_executor(None, file.read, min(self.chunk_size, count))
+                if not chunk:
+                    break
+                count -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': count > 0})
+            if count:
+                # The file shrank under us; end the response.
+                await send({'type': 'http.response.body', 'body': b''})
+
+
+def not_modified(request_headers, etag, mtime):
+    if 'if-none-match' in request_headers:
+        etags = parse_etags(request_headers['if-none-match'])
+        return '*' in etags or etag in etags or f'W/{etag}' in etags
+    since = parse_http_date_safe(request_headers.get('if-modified-since', ''))
+    return since is not None and int(mtime) <= since
+
+
+def if_range_matches(if_range, etag, mtime):
+    if if_range is None:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    since = parse_http_date_safe(if_range)
+    return since is not None and int(mtime) <= since
+
+
+def parse_range(header, size):
+    """
+    (start, end) for a single `bytes=` range, None to ignore the header
+    (multiple or malformed ranges: send the whole file), or False if the
+    range can't be satisfied.
+    """
+    match = _RANGE.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        length = int(last)
+        if length == 0:
+            return False
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        return False
+    return start, end
+
+
+async def respond(send, status, headers=()):
+    await send({'type': 'http.response.start', 'status': status, 'headers': list(headers) + [(b'content-length', b'0')]})
+    await send({'type': 'http.response.body', 'body': b''})
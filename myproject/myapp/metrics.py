@@ -0,0 +1,300 @@
+import bisect
+import math
+import re
+import threading
+import time
+
+from channels.layers import get_channel_layer
+
+from . import stats
+from .conf import chat_setting
+from .ratelimit import peek_type
+
+DEFAULTS = {
+    # Bearer token that may read /metrics/ without logging in (for a
+    # Prometheus scraper). Staff users can always read it.
+    'TOKEN': None,
+}
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# Frame types counted by name; anything else a client sends is "other".
+FRAME_TYPES = (
+    'chat_message', 'file_message', 'typing', 'stop_typing', 'reaction', 'fetch_older', 'pong', 'other',
+)
+
+_NAME = re.compile(r'[^a-zA-Z0-9_]')
+
+_families = []
+
+
+class _Cells:
+    """
+    Per-thread slots of `size` numbers, summed when scraped.
+
+    Each thread only ever writes its own list, so recording needs no lock
+    and allocates nothing once the thread has its slots.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()
+
+    def cell(self):
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = [0] * self.size
+            with self._lock:
+                self._cells.append(cell)
+            return cell
+
+    def totals(self):
+        with self._lock:
+            cells = list(self._cells)
+        totals = [0] * self.size
+        for cell in cells:
+            for i, value in enumerate(cell):
+                totals[i] += value
+        return totals
+
+
+class _Family:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        _families.append(self)
+
+    def labels(self, *values):
+        """The child for these label values; hot paths should keep it."""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            for suffix, extra, value in child.samples():
+                yield suffix, dict(zip(self.labelnames, values), **extra), value
+
+
+class _CounterChild:
+    def __init__(self):
+        self._cells = _Cells(1)
+
+    def inc(self, amount=1):
+        self._cells.cell()[0] += amount
+
+    def samples(self):
+        yield '', {}, self._cells.totals()[0]
+
+
+class Counter(_Family):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One slot per bucket, +Inf, then the sum and the count.
+        self._cells = _Cells(len(buckets) + 3)
+
+    def observe(self, value):
+        cell = self._cells.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def samples(self):
+        totals = self._cells.totals()
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), totals):
+            cumulative += count
+            yield '_bucket', {'le': _format(bound)}, cumulative
+        yield '_sum', {}, totals[-2]
+        yield '_count', {}, totals[-1]
+
+
+class Histogram(_Family):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class Gauge(_Family):
+    """A value read when scraped. `collect` returns a number, or (label values, number) pairs."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, collect, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def samples(self):
+        collected = self.collect()
+        if not self.labelnames:
+            collected = [((), collected)]
+        for values, value in collected:
+            if value is not None:
+                yield '', dict(zip(self.labelnames, values)), value
+
+
+def _format(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _stat_samples(prefix, value):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _stat_samples(f'{prefix}_{_NAME.sub("_", str(key))}', item)
+    elif isinstance(value, (int, float)):
+        yield prefix, value
+
+
+def render():
+    """Every metric, plus the numeric stats providers, in Prometheus text format."""
+    lines = []
+    for family in _families:
+        lines.append(f'# HELP {family.name} {family.documentation}')
+        lines.append(f'# TYPE {family.name} {family.kind}')
+        for suffix, labels, value in family.samples():
+            label_text = ','.join(f'{key}="{_escape(item)}"' for key, item in labels.items())
+            lines.append(f'{family.name}{suffix}{{{label_text}}} {_format(value)}' if label_text
+                         else f'{family.name}{suffix} {_format(value)}')
+    # Everything StatsView shows that is a number, as chat_stats_<provider>_<key>.
+    for name, value in _stat_samples('chat_stats', stats.snapshot()):
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {_format(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+connections_opened = Counter('chat_connections_opened_total', 'Websocket connections accepted.', ('consumer',))
+connections_closed = Counter('chat_connections_closed_total', 'Websocket connections closed.', ('consumer',))
+frames_received = Counter('chat_frames_received_total', 'Frames received from clients, by type.', ('type',))
+receive_seconds = Histogram(
+    'chat_receive_seconds', 'Time spent handling one client frame, by type.', ('type',))
+receive_to_send_seconds = Histogram(
+    'chat_receive_to_send_seconds',
+    'From receiving a client frame to forwarding the resulting broadcast to a recipient.', ('type',))
+# Observed from presence.occupancy(), which counts distinct users: a user
+# with several tabs open is one recipient. Presence is per process, so only
+# users connected to the worker that sent the broadcast are counted.
+broadcast_local_recipients = Histogram(
+    'chat_broadcast_local_recipients',
+    'Distinct users (not connections) on this worker in the group a broadcast goes to.',
+    buckets=SIZE_BUCKETS)
+db_wait_seconds = Histogram('chat_db_wait_seconds', 'Time a DB call waited for a thread.', ('pool',))
+db_run_seconds = Histogram('chat_db_run_seconds', 'Time a DB call ran for.', ('pool',))
+http_requests = Counter('chat_http_requests_total', 'HTTP requests, by URL name and status.', ('view', 'status'))
+http_seconds = Histogram('chat_http_request_seconds', 'HTTP request handling time, by URL name.', ('view',))
+
+_received_by_type = {kind: frames_received.labels(kind) for kind in FRAME_TYPES}
+_receive_seconds_by_type = {kind: receive_seconds.labels(kind) for kind in FRAME_TYPES}
+
+
+def _channel_layer_queued():
+    # InMemoryChannelLayer keeps one asyncio.Queue per channel; other
+    # layers don't expose their backlog.
+    channels = getattr(get_channel_layer(), 'channels', None)
+    if not isinstance(channels, dict):
+        return None
+    return sum(queue.qsize() for queue in channels.values())
+
+
+Gauge('chat_channel_layer_queued', 'Messages waiting in channel-layer queues (in-memory layer only).',
+      _channel_layer_queued)
+
+
+class MetricsMixin:
+    """
+    Counts connections and frames and times receive handling.
+
+    Comes right after TracingMixin in the consumer's bases, so frame
+    timing covers rate limiting and everything after it, though not the
+    tracing itself. While a frame is handled,
+    `received_at` is set; BroadcastMixin stamps it on the events it sends
+    so recipients can record receive -> send latency.
+    """
+
+    metrics_name = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received_at = None
+        name = self.metrics_name or type(self).__name__
+        self._opened = connections_opened.labels(name)
+        self._closed = connections_closed.labels(name)
+
+    async def websocket_connect(self, message):
+        self._opened.inc()
+        await super().websocket_connect(message)
+
+    async def websocket_receive(self, message):
+        text = message.get('text')
+        kind = peek_type(text) if text is not None else None
+        if kind not in _received_by_type:
+            kind = 'other'
+        _received_by_type[kind].inc()
+        started = time.perf_counter()
+        self.received_at = time.time()
+        try:
+            await super().websocket_receive(message)
+        finally:
+            self.received_at = None
+            _receive_seconds_by_type[kind].observe(time.perf_counter() - started)
+
+    async def websocket_disconnect(self, message):
+        self._closed.inc()
+        await super().websocket_disconnect(message)
+
+
+class MetricsMiddleware:
+    """Counts and times Django requests by URL name."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name if match is not None else None) or 'other'
+        http_seconds.labels(view).observe(time.perf_counter() - started)
+        http_requests.labels(view, str(response.status_code)).inc()
+        return response
+
+
+config = chat_setting('CHAT_METRICS', DEFAULTS)
@@ -10,5 +10,5 @@ class Migration(migrations.Migration):
     ]
 
     operations = [
-        migrations.RunSQL('DROP TABLE myapp_privatemessage;'),
+        migrations.RunSQL('DROP TABLE IF EXISTS myapp_privatemessage;'),
     ]
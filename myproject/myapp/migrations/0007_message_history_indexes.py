@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:10
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0006_message_timestamp_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['timestamp', 'id'], name='message_timestamp_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(fields=['room', 'timestamp', 'id'], name='privmsg_room_timestamp_id_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0008_messagereaction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='message_id',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='privatemessage',
+            name='message_id',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+    ]
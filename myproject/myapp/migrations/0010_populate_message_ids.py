@@ -0,0 +1,24 @@
+import uuid
+
+from django.db import migrations
+
+
+def populate_message_ids(apps, schema_editor):
+    # Existing rows never had their broadcast id stored; give each its own.
+    for model_name in ('Message', 'PrivateMessage'):
+        model = apps.get_model('myapp', model_name)
+        rows = list(model.objects.filter(message_id__isnull=True).only('id'))
+        for row in rows:
+            row.message_id = uuid.uuid4()
+        model.objects.bulk_update(rows, ['message_id'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0009_message_message_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_message_ids, migrations.RunPython.noop),
+    ]
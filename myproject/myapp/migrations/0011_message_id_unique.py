@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:02
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0010_populate_message_ids'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='message_id',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='privatemessage',
+            name='message_id',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+    ]
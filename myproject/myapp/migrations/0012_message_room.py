@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:28
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0011_message_id_unique'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_timestamp_id_idx',
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='room',
+            field=models.CharField(default='general', max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'timestamp', 'id'], name='message_room_timestamp_id_idx'),
+        ),
+    ]
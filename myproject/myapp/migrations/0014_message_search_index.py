@@ -0,0 +1,77 @@
+from django.db import migrations
+
+# A snapshot of myapp.search's SQL as of this migration; later changes to
+# the index go in new migrations.
+CREATE_SQL = [
+    "CREATE VIRTUAL TABLE myapp_message_fts USING fts5(content, room, author_id, "
+    "content='myapp_message', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER myapp_message_fts_insert AFTER INSERT ON myapp_message BEGIN "
+    "INSERT INTO myapp_message_fts(rowid, content, room, author_id) "
+    "VALUES (new.id, new.content, new.room, new.author_id); END",
+    "CREATE TRIGGER myapp_message_fts_delete AFTER DELETE ON myapp_message BEGIN "
+    "INSERT INTO myapp_message_fts(myapp_message_fts, rowid, content, room, author_id) "
+    "VALUES ('delete', old.id, old.content, old.room, old.author_id); END",
+    "CREATE TRIGGER myapp_message_fts_update AFTER UPDATE OF content, room, author_id ON myapp_message BEGIN "
+    "INSERT INTO myapp_message_fts(myapp_message_fts, rowid, content, room, author_id) "
+    "VALUES ('delete', old.id, old.content, old.room, old.author_id); "
+    "INSERT INTO myapp_message_fts(rowid, content, room, author_id) "
+    "VALUES (new.id, new.content, new.room, new.author_id); END",
+
+    "CREATE VIRTUAL TABLE myapp_privatemessage_fts USING fts5(content, room_id, author_id, "
+    "content='myapp_privatemessage', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER myapp_privatemessage_fts_insert AFTER INSERT ON myapp_privatemessage BEGIN "
+    "INSERT INTO myapp_privatemessage_fts(rowid, content, room_id, author_id) "
+    "VALUES (new.id, new.content, new.room_id, new.author_id); END",
+    "CREATE TRIGGER myapp_privatemessage_fts_delete AFTER DELETE ON myapp_privatemessage BEGIN "
+    "INSERT INTO myapp_privatemessage_fts(myapp_privatemessage_fts, rowid, content, room_id, author_id) "
+    "VALUES ('delete', old.id, old.content, old.room_id, old.author_id); END",
+    "CREATE TRIGGER myapp_privatemessage_fts_update AFTER UPDATE OF content, room_id, author_id "
+    "ON myapp_privatemessage BEGIN "
+    "INSERT INTO myapp_privatemessage_fts(myapp_privatemessage_fts, rowid, content, room_id, author_id) "
+    "VALUES ('delete', old.id, old.content, old.room_id, old.author_id); "
+    "INSERT INTO myapp_privatemessage_fts(rowid, content, room_id, author_id) "
+    "VALUES (new.id, new.content, new.room_id, new.author_id); END",
+
+    # Index the messages that already exist.
+    "INSERT INTO myapp_message_fts(myapp_message_fts) VALUES ('rebuild')",
+    "INSERT INTO myapp_privatemessage_fts(myapp_privatemessage_fts) VALUES ('rebuild')",
+]
+
+DROP_SQL = [
+    'DROP TRIGGER IF EXISTS myapp_message_fts_insert',
+    'DROP TRIGGER IF EXISTS myapp_message_fts_delete',
+    'DROP TRIGGER IF EXISTS myapp_message_fts_update',
+    'DROP TABLE IF EXISTS myapp_message_fts',
+    'DROP TRIGGER IF EXISTS myapp_privatemessage_fts_insert',
+    'DROP TRIGGER IF EXISTS myapp_privatemessage_fts_delete',
+    'DROP TRIGGER IF EXISTS myapp_privatemessage_fts_update',
+    'DROP TABLE IF EXISTS myapp_privatemessage_fts',
+]
+
+
+def create_search_indexes(apps, schema_editor):
+    # FTS5 is SQLite only; other databases go without search.
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for statement in CREATE_SQL:
+            cursor.execute(statement)
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for statement in DROP_SQL:
+            cursor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0013_chunkedupload'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
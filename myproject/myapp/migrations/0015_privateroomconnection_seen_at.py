@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:11
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0014_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='privateroomconnection',
+            name='seen_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+    ]
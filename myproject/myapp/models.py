@@ -1,13 +1,31 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
+from .pagination import page_after, page_before
+from .uploads import cas_url
+from . import archive
+from .presence import presence
+import uuid
+
+# Public room that /ws/chat/ (without a room name) joins.
+DEFAULT_ROOM = 'general'
 
 class PrivateChatRoom(models.Model):
     name = models.CharField(max_length=255, unique=True)
 
+    def has_member(self, user):
+        # Connected here, connected elsewhere (per the last presence
+        # snapshot), or has written in the room before.
+        return (presence.is_member(self.name, user.id)
+                or self.privateroomconnection_set.filter(user=user, seen_at__gte=presence.stale_before()).exists()
+                or self.messages.filter(author=user).exists())
+
 class PrivateRoomConnection(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     room = models.ForeignKey(PrivateChatRoom, on_delete=models.CASCADE)
     connected_at = models.DateTimeField(auto_now_add=True)
+    # Refreshed by each presence snapshot while the user stays connected.
+    seen_at = models.DateTimeField(default=timezone.now, db_index=True)
 
 
     class Meta:
@@ -15,30 +33,150 @@ class PrivateRoomConnection(models.Model):
 
 
 class Message(models.Model):
+    room = models.CharField(max_length=50, default=DEFAULT_ROOM)
     author = models.ForeignKey(User, related_name='author_messages', on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)
+    message_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'timestamp', 'id'], name='message_room_timestamp_id_idx'),
+        ]
 
     def __str__(self):
         return f'{self.author.username}: {self.content}'
 
+    def to_json(self):
+        return {
+            'username': self.author.username,
+            'message': self.content,
+            'time': str(self.timestamp),
+            'message_id': str(self.message_id),
+            # None until message_writer has saved it (then filled in).
+            'id': self.pk
+        }
+
+    @staticmethod
+    def history_page(room, cursor, limit):
+        rows, next_cursor = page_before(Message.objects.filter(room=room).select_related('author'), cursor, limit)
+        return archive.extend_page(archive.PUBLIC, room, rows, next_cursor, cursor, limit)
+
+    @staticmethod
+    def resync_anchor(room, message_id):
+        return Message.objects.filter(room=room, message_id=message_id).values_list('timestamp', 'id').first()
+
+    @staticmethod
+    def messages_after(room, anchor, limit):
+        return page_after(Message.objects.filter(room=room).select_related('author'), anchor, limit)
+
+    @staticmethod
+    def last_10_messages(room=DEFAULT_ROOM):
+        return Message.last_messages(room, 10)
+
     @staticmethod
-    def last_10_messages():
-        return Message.objects.order_by('-timestamp').all()[:10]
+    def last_messages(room, count):
+        rows = Message.objects.filter(room=room).select_related('author').order_by('-timestamp', '-id')[:count]
+        return archive.extend_latest(archive.PUBLIC, room, rows, count)
     
 class PrivateMessage(models.Model):
     room = models.ForeignKey(PrivateChatRoom, related_name='messages', on_delete=models.CASCADE)
     author = models.ForeignKey(User, related_name='private_messages', on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)
+    message_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'timestamp', 'id'], name='privmsg_room_timestamp_id_idx'),
+        ]
 
     def __str__(self):
         return f'{self.author.username}: {self.content}'
+
+    def to_json(self):
+        return {
+            'username': self.author.username,
+            'message': self.content,
+            'time': str(self.timestamp),
+            'message_id': str(self.message_id),
+            # None until message_writer has saved it (then filled in).
+            'id': self.pk
+        }
+
+    @staticmethod
+    def history_page(room, cursor, limit):
+        rows, next_cursor = page_before(PrivateMessage.objects.filter(room=room).select_related('author'), cursor, limit)
+        return archive.extend_page(archive.PRIVATE, room.pk, rows, next_cursor, cursor, limit)
+
+    @staticmethod
+    def resync_anchor(room, message_id):
+        return PrivateMessage.objects.filter(room=room, message_id=message_id).values_list('timestamp', 'id').first()
+
+    @staticmethod
+    def messages_after(room, anchor, limit):
+        return page_after(PrivateMessage.objects.filter(room=room).select_related('author'), anchor, limit)
     
     @staticmethod
     def last_10_messages(room):
-        return PrivateMessage.objects.filter(room=room).order_by('-timestamp').all()[:10]
+        return PrivateMessage.last_messages(room, 10)
 
+    @staticmethod
+    def last_messages(room, count):
+        rows = PrivateMessage.objects.filter(room=room).select_related('author').order_by('-timestamp', '-id')[:count]
+        return archive.extend_latest(archive.PRIVATE, room.pk, rows, count)
 
-    
 
+class MessageReaction(models.Model):
+    # Keyed by the broadcast message_id, so it works for public and private
+    # messages alike.
+    message_id = models.CharField(max_length=36)
+    emoji = models.CharField(max_length=32)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('message_id', 'emoji')
+
+    @staticmethod
+    def counts_for(message_ids):
+        counts = {}
+        for reaction in MessageReaction.objects.filter(message_id__in=message_ids, count__gt=0):
+            counts.setdefault(reaction.message_id, {})[reaction.emoji] = reaction.count
+        return counts
+
+
+class UserReaction(models.Model):
+    # Who reacted with what; reacting again with the same emoji takes it back.
+    message_id = models.CharField(max_length=36)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    emoji = models.CharField(max_length=32)
+
+    class Meta:
+        unique_together = ('message_id', 'user', 'emoji')
+
+    @staticmethod
+    def has_reacted(message_id, user_id, emoji):
+        return UserReaction.objects.filter(message_id=message_id, user_id=user_id, emoji=emoji).exists()
+
+
+class ChunkedUpload(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    # Bytes received and acknowledged so far; the next chunk starts here.
+    offset = models.BigIntegerField(default=0)
+    # Declared by the client up front (optional), verified on completion.
+    sha256 = models.CharField(max_length=64, blank=True)
+    # Storage name under cas/ once the upload is complete.
+    file = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def to_json(self):
+        return {
+            'upload_id': str(self.id),
+            'offset': self.offset,
+            'size': self.size,
+            'complete': bool(self.file),
+            'file_url': cas_url(self.file) if self.file else None
+        }
@@ -0,0 +1,147 @@
+import asyncio
+import time
+import weakref
+from collections import deque
+
+from . import stats
+from .conf import chat_setting
+from .profiling import stage
+
+DEFAULTS = {
+    # Frames buffered per connection before anything is dropped.
+    'MAX_FRAMES': 256,
+    # A connection that stays above this many buffered frames for
+    # EVICT_AFTER seconds is disconnected.
+    'HIGH_WATER': 192,
+    'EVICT_AFTER': 5.0,
+}
+
+EVICTED_CLOSE_CODE = 4008
+
+_CLOSE = object()
+
+_config = chat_setting('CHAT_OUTBOUND', DEFAULTS)
+_connections = weakref.WeakSet()
+_totals = {'dropped': 0, 'evicted': 0}
+
+
+class OutboundQueueMixin:
+    """
+    Sends websocket frames through a bounded per-connection queue.
+
+    Handlers no longer wait on a slow client: send() only queues, and a
+    writer task per connection hands frames to the server in order. When
+    the queue is full, droppable frames (broadcast.DROPPABLE_TYPES) go
+    first; if there is nothing left to drop, or the queue stays over
+    HIGH_WATER for EVICT_AFTER seconds, the connection is closed with
+    EVICTED_CLOSE_CODE.
+
+    The queue only backs up when the server's send waits for the client.
+    Daphne's does not: it hands the frame to Twisted, which buffers it
+    without limit, so under Daphne the queue drains as fast as it fills
+    and these limits never apply. They do under servers whose send waits
+    for the transport to drain, such as uvicorn.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbound = deque()
+        self.outbound_dropped = 0
+        self.outbound_evicted = False
+        self._outbound_task = None
+        self._over_since = None
+        _connections.add(self)
+
+    async def send(self, text_data=None, bytes_data=None, close=False, droppable=False):
+        frame = {'text_data': text_data, 'bytes_data': bytes_data}
+        with stage('send'):
+            self._enqueue(frame, droppable)
+        if close:
+            await self.close(close)
+
+    async def close(self, code=None, reason=None):
+        self._enqueue((_CLOSE, code, reason), False)
+
+    async def websocket_disconnect(self, message):
+        try:
+            await super().websocket_disconnect(message)
+        finally:
+            if self._outbound_task is not None:
+                self._outbound_task.cancel()
+            self.outbound.clear()
+
+    def _enqueue(self, frame, droppable):
+        if self.outbound_evicted:
+            return
+        queue = self.outbound
+        if len(queue) >= _config['MAX_FRAMES']:
+            if droppable:
+                self._drop()
+                return
+            victim = next((i for i, (_, low) in enumerate(queue) if low), None)
+            if victim is None:
+                self._evict()
+                return
+            del queue[victim]
+            self._drop()
+
+        queue.append((frame, droppable))
+        if len(queue) > _config['HIGH_WATER']:
+            now = time.monotonic()
+            if self._over_since is None:
+                self._over_since = now
+            elif now - self._over_since > _config['EVICT_AFTER']:
+                self._evict()
+                return
+        self._ensure_writer()
+
+    def _drop(self):
+        self.outbound_dropped += 1
+        _totals['dropped'] += 1
+
+    def _evict(self):
+        self.outbound_evicted = True
+        _totals['evicted'] += 1
+        self.outbound.clear()
+        self.outbound.append(((_CLOSE, EVICTED_CLOSE_CODE, None), False))
+        self._ensure_writer()
+
+    def _ensure_writer(self):
+        if self._outbound_task is None or self._outbound_task.done():
+            self._outbound_task = asyncio.ensure_future(self._write_outbound())
+
+    async def _write_outbound(self):
+        queue = self.outbound
+        while queue:
+            frame, _ = queue.popleft()
+            if isinstance(frame, tuple):
+                _, code, reason = frame
+                await super().close(code, reason)
+                queue.clear()
+                return
+            await super().send(**frame)
+            if len(queue) <= _config['HIGH_WATER']:
+                self._over_since = None
+
+
+def outbound_stats():
+    connections = list(_connections)
+    deepest = sorted(connections, key=lambda c: len(c.outbound), reverse=True)[:10]
+    return {
+        'connections': len(connections),
+        'queued': sum(len(c.outbound) for c in connections),
+        'dropped': _totals['dropped'],
+        'evicted': _totals['evicted'],
+        'deepest': [
+            {
+                'channel': getattr(c, 'channel_name', None),
+                'user': getattr(getattr(c, 'scope', {}).get('user'), 'username', None),
+                'depth': len(c.outbound),
+                'dropped': c.outbound_dropped,
+            }
+            for c in deepest if c.outbound
+        ],
+    }
+
+
+stats.register('outbound', outbound_stats)
@@ -0,0 +1,97 @@
+import base64
+from datetime import datetime
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# A client that reconnects further behind than this many pages is not
+# replayed; it gets the latest page after a resync_gap marker.
+MAX_RESYNC_PAGES = 5
+
+
+def encode_cursor(timestamp, pk=None):
+    raw = f"{timestamp.isoformat()}|{'' if pk is None else pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Return (timestamp, pk) for a cursor made by encode_cursor. pk is None
+    for cursors built from a message that has not been assigned one yet.
+    Raises ValueError for anything malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, pk = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(pk) if pk else None
+    except (AttributeError, TypeError, UnicodeError, ValueError) as exc:
+        raise ValueError('Invalid cursor') from exc
+
+
+def clamp_page_size(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def page_before(queryset, cursor, limit):
+    """
+    Keyset page of `queryset`, newest first, strictly older than `cursor`.
+
+    Rows are ordered by (timestamp, id); the filter is a range on the
+    leading index column, so each page costs O(limit) regardless of how
+    far back it is. Returns (rows, next_cursor); next_cursor is None on
+    the last page.
+    """
+    queryset = queryset.order_by('-timestamp', '-id')
+    if cursor:
+        timestamp, pk = decode_cursor(cursor)
+        if pk is None:
+            queryset = queryset.filter(timestamp__lt=timestamp)
+        else:
+            queryset = queryset.filter(timestamp__lte=timestamp).exclude(timestamp=timestamp, id__gte=pk)
+
+    rows = list(queryset[:limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].timestamp, rows[-1].pk)
+
+
+def page_after(queryset, anchor, limit):
+    """
+    Keyset page of `queryset`, oldest first, strictly newer than `anchor`
+    (a (timestamp, id) pair). Returns (rows, next_anchor); next_anchor is
+    None once there is nothing newer.
+    """
+    timestamp, pk = anchor
+    queryset = (
+        queryset.order_by('timestamp', 'id')
+        .filter(timestamp__gte=timestamp)
+        .exclude(timestamp=timestamp, id__lte=pk)
+    )
+
+    rows = list(queryset[:limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, (rows[-1].timestamp, rows[-1].pk)
+
+
+def cursor_before(messages_json, page_size):
+    """
+    Cursor for scrolling back past a list of serialized messages (newest
+    first), or None if the list is known to hold all remaining history.
+
+    The cursor is the (timestamp, id) of the oldest message that has been
+    saved, so rows sharing its timestamp are not skipped. Messages newer
+    than it may come again on the next page; clients dedupe by message_id.
+    """
+    if len(messages_json) < page_size:
+        return None
+    for message in reversed(messages_json):
+        if message.get('id') is not None:
+            return encode_cursor(datetime.fromisoformat(message['time']), message['id'])
+    # Nothing here was ever written (the writer failed); older than all of it.
+    return encode_cursor(datetime.fromisoformat(messages_json[-1]['time']))
@@ -0,0 +1,213 @@
+import asyncio
+import atexit
+import logging
+from collections import Counter
+from contextlib import asynccontextmanager
+
+from django.db import transaction
+
+from . import stats
+from .conf import chat_setting
+from .db import write_executor
+
+logger = logging.getLogger(__name__)
+
+DURABILITY_ACK = 'ack'
+DURABILITY_NONE = 'none'
+
+DEFAULTS = {
+    # Flush as soon as this many messages are queued...
+    'BATCH_SIZE': 100,
+    # ...or once the oldest queued message has waited this long (seconds).
+    'FLUSH_INTERVAL': 0.1,
+    # 'ack': save() returns once the batch holding the message is committed.
+    # 'none': save() returns immediately (fire and forget).
+    'DURABILITY': DURABILITY_NONE,
+}
+
+
+class MessageWriter:
+    """
+    Write-behind queue for chat messages.
+
+    Unsaved model instances are queued in memory and written with one
+    bulk_create per model inside a single transaction.
+    """
+
+    def __init__(self, batch_size, flush_interval, durability):
+        if durability not in (DURABILITY_ACK, DURABILITY_NONE):
+            raise ValueError(f'Unknown durability mode: {durability!r}')
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.flushed_batches = 0
+        self.flushed_messages = 0
+        self.failed_messages = 0
+        self._pending = []
+        # Queued or being written: by message_id, and a count per room.
+        self._unsaved_ids = set()
+        self._unsaved_rooms = Counter()
+        self._loop = None
+        self._lock = None
+        self._timer = None
+        self._tasks = set()
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    async def save(self, instance, serialized=None, room=None):
+        """
+        Queue `instance`. `serialized` is its to_json() dict, if one is kept
+        (e.g. in history_cache); its 'id' is filled in once the row exists.
+        `room` is the key flush_unsaved(room=...) finds it by.
+        """
+        self._bind_loop()
+        waiter = None
+        if self.durability == DURABILITY_ACK:
+            waiter = self._loop.create_future()
+        self._pending.append((instance, waiter, serialized, room))
+        self._unsaved_ids.add(str(instance.message_id))
+        if room is not None:
+            self._unsaved_rooms[room] += 1
+
+        if len(self._pending) >= self.batch_size:
+            self._spawn_flush()
+        elif self._timer is None:
+            self._timer = self._loop.call_later(self.flush_interval, self._flush_soon)
+
+        if waiter is not None:
+            await waiter
+        return instance
+
+    async def flush(self):
+        self._bind_loop()
+        self._cancel_timer()
+        batch, self._pending = self._pending, []
+
+        # Flushes are serialized so batches commit in the order they were
+        # taken; an empty flush still waits for a batch being written.
+        async with self._lock:
+            if batch:
+                await self._write_batch(batch)
+
+    async def flush_unsaved(self, message_id=None, room=None):
+        """
+        Flush if the message `message_id`, or any message saved for `room`,
+        is not written yet; otherwise return at once. Returns whether it
+        had to wait.
+        """
+        if message_id not in self._unsaved_ids and (room is None or room not in self._unsaved_rooms):
+            return False
+        await self.flush()
+        return True
+
+    @asynccontextmanager
+    async def drained(self):
+        """
+        Flush everything queued so far and hold back later flushes until
+        the block exits, so a read inside it sees every message saved
+        before it and none saved after.
+        """
+        self._bind_loop()
+        self._cancel_timer()
+        batch, self._pending = self._pending, []
+        async with self._lock:
+            if batch:
+                await self._write_batch(batch)
+            yield
+
+    async def _write_batch(self, batch):
+        try:
+            await write_executor.run(self._write, [instance for instance, _, _, _ in batch])
+        except Exception as exc:
+            self.failed_messages += len(batch)
+            logger.exception('Failed to persist %d chat messages', len(batch))
+            for _, waiter, _, _ in batch:
+                if waiter is not None and not waiter.done():
+                    waiter.set_exception(exc)
+        else:
+            self.flushed_batches += 1
+            self.flushed_messages += len(batch)
+            for instance, waiter, serialized, _ in batch:
+                if serialized is not None:
+                    serialized['id'] = instance.pk
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(None)
+        finally:
+            self._settled(batch)
+
+    def flush_sync(self):
+        # Used at interpreter shutdown, when the event loop is already gone.
+        self._cancel_timer()
+        batch, self._pending = self._pending, []
+        if batch:
+            try:
+                self._write([instance for instance, _, _, _ in batch])
+            except Exception:
+                logger.exception('Failed to persist %d chat messages on shutdown', len(batch))
+            self._settled(batch)
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'flushed_batches': self.flushed_batches,
+            'flushed_messages': self.flushed_messages,
+            'failed_messages': self.failed_messages,
+            'durability': self.durability,
+        }
+
+    def _write(self, instances):
+        by_model = {}
+        for instance in instances:
+            by_model.setdefault(type(instance), []).append(instance)
+        with transaction.atomic():
+            for model, objs in by_model.items():
+                model.objects.bulk_create(objs)
+
+    def _settled(self, batch):
+        # Written or failed: either way there is nothing left to wait for.
+        for instance, _, _, room in batch:
+            self._unsaved_ids.discard(str(instance.message_id))
+            if room is not None:
+                self._unsaved_rooms[room] -= 1
+                if not self._unsaved_rooms[room]:
+                    del self._unsaved_rooms[room]
+
+    def _flush_soon(self):
+        self._timer = None
+        self._spawn_flush()
+
+    def _spawn_flush(self):
+        task = self._loop.create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Waiters left over from a loop that has gone away can't be
+            # resolved any more; their messages are still written.
+            self._pending = [(instance, None, serialized, room) for instance, _, serialized, room in self._pending]
+            self._loop = loop
+            self._lock = asyncio.Lock()
+            self._timer = None
+
+
+def _build_writer():
+    config = chat_setting('CHAT_PERSISTENCE', DEFAULTS)
+    return MessageWriter(
+        batch_size=config['BATCH_SIZE'],
+        flush_interval=config['FLUSH_INTERVAL'],
+        durability=config['DURABILITY'],
+    )
+
+
+message_writer = _build_writer()
+atexit.register(message_writer.flush_sync)
+stats.register('persistence', message_writer.stats)
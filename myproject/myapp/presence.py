@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import stats
+from .conf import chat_setting
+from .db import write_executor
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    # Seconds a connection stays registered without being refreshed (any
+    # frame from the client refreshes it). Snapshot rows not refreshed for
+    # this long are deleted, which cleans up after crashed workers.
+    'TTL': 300,
+    # Seconds between sweeps of expired connections (and snapshots).
+    'SWEEP_INTERVAL': 30,
+    # Write private room members to PrivateRoomConnection on every sweep,
+    # so other processes can see them. Never done on the connect path.
+    'SNAPSHOT': True,
+}
+
+
+class PresenceRegistry:
+    """
+    Who is connected where, in this process.
+
+    Keeps channel -> (user, room) leases plus per-user and per-room
+    indexes, so membership and occupancy checks are dict lookups and
+    connecting or disconnecting costs no queries. Rooms are group names,
+    public or private. Leases that are not refreshed within TTL are swept,
+    so a consumer whose disconnect never ran does not stay present.
+    """
+
+    def __init__(self, ttl, sweep_interval, snapshot):
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.snapshot = snapshot
+        self.expired = 0
+        self.snapshots = 0
+        self.snapshot_rows = 0
+        self.stale_rows = 0
+        # channel_name -> [user_id, room, expires]
+        self._channels = {}
+        # user_id -> {channel_name}
+        self._users = {}
+        # room -> {user_id: connections}
+        self._rooms = {}
+        self._task = None
+
+    def join(self, channel_name, user_id, room):
+        """Register a connection; True if it is the user's first in the room."""
+        if channel_name in self._channels:
+            self.leave(channel_name)
+        self._channels[channel_name] = [user_id, room, time.monotonic() + self.ttl]
+        self._users.setdefault(user_id, set()).add(channel_name)
+        members = self._rooms.setdefault(room, {})
+        members[user_id] = members.get(user_id, 0) + 1
+        self._ensure_running()
+        return members[user_id] == 1
+
+    def leave(self, channel_name):
+        """
+        Forget a connection. Returns (user_id, room, last) where last says
+        the user has no other connection to the room, or None if the
+        connection was not registered.
+        """
+        entry = self._channels.pop(channel_name, None)
+        if entry is None:
+            return None
+        user_id, room, _ = entry
+        channels = self._users[user_id]
+        channels.discard(channel_name)
+        if not channels:
+            del self._users[user_id]
+        members = self._rooms[room]
+        members[user_id] -= 1
+        last = not members[user_id]
+        if last:
+            del members[user_id]
+            if not members:
+                del self._rooms[room]
+        return user_id, room, last
+
+    def touch(self, channel_name):
+        entry = self._channels.get(channel_name)
+        if entry is not None:
+            entry[2] = time.monotonic() + self.ttl
+
+    def is_member(self, room, user_id):
+        return user_id in self._rooms.get(room, ())
+
+    def occupancy(self, room):
+        return len(self._rooms.get(room, ()))
+
+    def members(self, room):
+        return set(self._rooms.get(room, ()))
+
+    def connections(self, user_id):
+        return len(self._users.get(user_id, ()))
+
+    def stale_before(self):
+        """Snapshot rows last refreshed before this belong to no live connection."""
+        return timezone.now() - timedelta(seconds=self.ttl)
+
+    def expire(self):
+        """Drop connections whose lease ran out; returns how many."""
+        now = time.monotonic()
+        stale = [channel_name for channel_name, entry in self._channels.items() if entry[2] <= now]
+        for channel_name in stale:
+            self.leave(channel_name)
+        self.expired += len(stale)
+        return len(stale)
+
+    def stats(self):
+        return {
+            'connections': len(self._channels),
+            'users': len(self._users),
+            'rooms': len(self._rooms),
+            'expired': self.expired,
+            'snapshots': self.snapshots,
+            'snapshot_rows': self.snapshot_rows,
+            'stale_rows_deleted': self.stale_rows,
+        }
+
+    def _ensure_running(self):
+        if (self._task is None or self._task.done()
+                or self._task.get_loop() is not asyncio.get_running_loop()):
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while self._channels:
+            await asyncio.sleep(self.sweep_interval)
+            self.expire()
+            if not self.snapshot:
+                continue
+            pairs = {(room, user_id) for room, members in self._rooms.items() for user_id in members}
+            try:
+                written, deleted = await write_executor.run(_write_snapshot, pairs, self.stale_before())
+            except Exception:
+                logger.exception('Failed to snapshot presence of %d members', len(pairs))
+            else:
+                self.snapshots += 1
+                self.snapshot_rows += written
+                self.stale_rows += deleted
+
+
+def _write_snapshot(pairs, stale_before):
+    from .models import PrivateChatRoom, PrivateRoomConnection
+
+    # Public rooms have no PrivateChatRoom and simply drop out here.
+    room_ids = dict(PrivateChatRoom.objects.filter(
+        name__in={room for room, _ in pairs}).values_list('name', 'id'))
+    now = timezone.now()
+    rows = [
+        PrivateRoomConnection(room_id=room_ids[room], user_id=user_id, seen_at=now)
+        for room, user_id in pairs if room in room_ids
+    ]
+    with transaction.atomic():
+        PrivateRoomConnection.objects.bulk_create(
+            rows, update_conflicts=True, unique_fields=['user', 'room'], update_fields=['seen_at'])
+        deleted, _ = PrivateRoomConnection.objects.filter(seen_at__lt=stale_before).delete()
+    return len(rows), deleted
+
+
+def _build_registry():
+    config = chat_setting('CHAT_PRESENCE', DEFAULTS)
+    return PresenceRegistry(
+        ttl=config['TTL'],
+        sweep_interval=config['SWEEP_INTERVAL'],
+        snapshot=config['SNAPSHOT'],
+    )
+
+
+presence = _build_registry()
+stats.register('presence', presence.stats)
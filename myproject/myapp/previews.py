@@ -0,0 +1,202 @@
+import asyncio
+import atexit
+import logging
+import mimetypes
+import multiprocessing
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from . import stats
+from .conf import chat_setting
+from . import uploads
+from .uploads import CAS_DIR
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    # Worker processes for decoding and resizing images.
+    'WORKERS': 2,
+    # Longest side of a thumbnail, in pixels.
+    'MAX_SIZE': 320,
+    # Previews kept in memory for file_messages that reuse a file.
+    'CACHE_SIZE': 1000,
+}
+
+THUMBNAIL_DIR = f'{CAS_DIR}/thumbs'
+
+# How many recent job latencies the percentiles are computed over.
+LATENCY_SAMPLES = 1000
+
+_CAS_NAME = re.compile(rf'^{CAS_DIR}/[0-9a-f]{{2}}/[0-9a-f]{{64}}(\.[a-z0-9]{{1,10}})?$')
+
+
+def render_preview(source, thumbnail, max_size):
+    """
+    Runs in a worker process: metadata for the file at `source` and, for
+    images, a JPEG thumbnail written to `thumbnail`. Pillow is optional;
+    without it only size and MIME type are reported.
+    """
+    mime_type = mimetypes.guess_type(source)[0] or 'application/octet-stream'
+    preview = {
+        'size': os.path.getsize(source),
+        'mime_type': mime_type,
+        'width': None,
+        'height': None,
+        'thumbnail': None,
+    }
+    if not mime_type.startswith('image/'):
+        return preview
+    try:
+        from PIL import Image
+    except ImportError:
+        return preview
+
+    with Image.open(source) as image:
+        preview['width'], preview['height'] = image.size
+        if not os.path.exists(thumbnail):
+            image.thumbnail((max_size, max_size))
+            if image.mode in ('RGBA', 'LA', 'P'):
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, 'white')
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            elif image.mode != 'RGB':
+                image = image.convert('RGB')
+            os.makedirs(os.path.dirname(thumbnail), exist_ok=True)
+            partial = f'{thumbnail}.{os.getpid()}.tmp'
+            image.save(partial, 'JPEG', quality=80)
+            os.replace(partial, thumbnail)
+    preview['thumbnail'] = thumbnail
+    return preview
+
+
+class PreviewPipeline:
+    """
+    Thumbnails and metadata for uploaded files, built in a process pool.
+
+    Uploads are submitted as soon as they are stored; consumers look the
+    file up when its file_message arrives and either get the finished
+    preview or wait for it without blocking the event loop. Files are
+    content addressed, so a preview is made once per content.
+    """
+
+    def __init__(self, workers, max_size, cache_size):
+        self.workers = workers
+        self.max_size = max_size
+        self.cache_size = cache_size
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self._executor = None
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._done = OrderedDict()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def submit(self, name):
+        """Start building the preview for storage name `name` (if not already)."""
+        # Called from upload views (threads) as well as from the event loop.
+        with self._lock:
+            if name in self._done or name in self._jobs:
+                return
+            if self._executor is None:
+                # Not fork: the server process has DB and executor threads.
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('forkserver'))
+                atexit.register(self._executor.shutdown, cancel_futures=True)
+            sha256 = os.path.basename(name).split('.')[0]
+            thumbnail = uploads.storage.path(f'{THUMBNAIL_DIR}/{sha256[:2]}/{sha256}-{self.max_size}.jpg')
+            started = time.monotonic()
+            try:
+                job = self._executor.submit(render_preview, uploads.storage.path(name), thumbnail, self.max_size)
+            except Exception:
+                # A preview is never worth failing the upload over.
+                logger.exception('Could not start a preview for %s', name)
+                self.failed += 1
+                return
+            self._jobs[name] = job
+            self.submitted += 1
+        job.add_done_callback(lambda job: self._finish(name, job, started))
+
+    def _finish(self, name, job, started):
+        # Runs on the executor's management thread, before any waiter in
+        # wait() is woken (that callback is registered later).
+        self._latencies.append(time.monotonic() - started)
+        try:
+            preview = job.result()
+        except Exception:
+            self.failed += 1
+            preview = None
+        else:
+            self.completed += 1
+        if preview is not None and preview['thumbnail']:
+            preview['thumbnail_url'] = uploads.storage.url(os.path.relpath(preview['thumbnail'], uploads.storage.location))
+        elif preview is not None:
+            preview['thumbnail_url'] = None
+        if preview is not None:
+            del preview['thumbnail']
+        self._done[name] = preview
+        while len(self._done) > self.cache_size:
+            self._done.popitem(last=False)
+        self._jobs.pop(name, None)
+
+    def name_for_url(self, file_url):
+        """Storage name behind a cas/ file URL sent by a client, or None."""
+        base_url = uploads.storage.base_url
+        if not isinstance(file_url, str) or not file_url.startswith(base_url):
+            return None
+        name = file_url[len(base_url):]
+        if not _CAS_NAME.match(name) or not uploads.storage.exists(name):
+            return None
+        return name
+
+    def get(self, name):
+        """The finished preview for `name`, or None if it isn't ready yet."""
+        return self._done.get(name)
+
+    async def wait(self, name):
+        """The preview for `name` (None if it failed), starting it if needed."""
+        if name in self._done:
+            return self._done[name]
+        self.submit(name)
+        job = self._jobs.get(name)
+        if job is not None:
+            try:
+                await asyncio.wrap_future(job)
+            except Exception:
+                pass
+        return self._done.get(name)
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+        return {
+            'queue_depth': len(self._jobs),
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'latency_p50': _percentile(latencies, 0.50),
+            'latency_p95': _percentile(latencies, 0.95),
+            'latency_max': latencies[-1] if latencies else None,
+        }
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def _build_pipeline():
+    config = chat_setting('CHAT_PREVIEWS', DEFAULTS)
+    return PreviewPipeline(
+        workers=config['WORKERS'],
+        max_size=config['MAX_SIZE'],
+        cache_size=config['CACHE_SIZE'],
+    )
+
+
+preview_pipeline = _build_pipeline()
+stats.register('previews', preview_pipeline.stats)
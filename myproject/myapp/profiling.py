@@ -0,0 +1,269 @@
+import contextvars
+import logging
+import re
+import sys
+import threading
+import time
+from collections import deque
+
+from . import stats
+from .conf import chat_setting
+from .ratelimit import peek_type
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    # Seconds between stack samples while the profiler runs.
+    'SAMPLE_INTERVAL': 0.005,
+    # A started profiler stops by itself after this many seconds.
+    'MAX_SECONDS': 300,
+    # Distinct stacks kept; samples of further new stacks are only counted.
+    'MAX_STACKS': 20000,
+    # Record handlers slower than THRESHOLD_MS from startup (also
+    # switchable at runtime through /profiling/).
+    'SLOW_LOG': False,
+    'THRESHOLD_MS': 100,
+    # Slow handlers kept for /profiling/; the oldest are dropped first.
+    'SLOW_LOG_SIZE': 200,
+}
+
+# Pool threads are named db-read_0, db-read_1, ...; one frame per pool.
+_THREAD_SUFFIX = re.compile(r'_\d+$')
+
+
+class SamplingProfiler:
+    """
+    Samples every thread's Python stack from a background thread.
+
+    Samples are folded into "thread;module:function;... count" lines, the
+    input format of flamegraph.pl, speedscope and similar tools. Nothing
+    runs while the profiler is stopped, and it stops by itself after
+    MAX_SECONDS. It sees the process it runs in, that is, the worker that
+    served the request which started it.
+    """
+
+    def __init__(self, interval, max_seconds, max_stacks):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.max_stacks = max_stacks
+        self.samples = 0
+        self.dropped = 0
+        self.started_at = None
+        self.stopped_at = None
+        self._stacks = {}
+        self._labels = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=None, seconds=None):
+        """Start a new profile, discarding the previous one; False if already running."""
+        with self._lock:
+            if self.running:
+                return False
+            if interval is not None:
+                self.interval = interval
+            self.samples = self.dropped = 0
+            self._stacks = {}
+            self.started_at, self.stopped_at = time.time(), None
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, args=(min(seconds or self.max_seconds, self.max_seconds),),
+                name='chat-profiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        thread = self._thread
+        self._stop.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def folded(self):
+        with self._lock:
+            stacks = sorted(self._stacks.items(), key=lambda item: item[1], reverse=True)
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks)
+
+    def status(self):
+        return {
+            'running': self.running,
+            'interval': self.interval,
+            'started_at': self.started_at,
+            'stopped_at': self.stopped_at,
+            'samples': self.samples,
+            'stacks': len(self._stacks),
+            'dropped': self.dropped,
+        }
+
+    def _run(self, seconds):
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        try:
+            while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+                names = {thread.ident: _THREAD_SUFFIX.sub('', thread.name) for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident != me:
+                        self._record(names.get(ident, str(ident)), frame)
+        finally:
+            self.stopped_at = time.time()
+
+    def _record(self, thread_name, frame):
+        labels = self._labels
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = f"{frame.f_globals.get('__name__', '?')}:{code.co_name}"
+            parts.append(label)
+            frame = frame.f_back
+        parts.append(thread_name)
+        stack = ';'.join(reversed(parts))
+        self.samples += 1
+        with self._lock:
+            count = self._stacks.get(stack)
+            if count is not None:
+                self._stacks[stack] = count + 1
+            elif len(self._stacks) < self.max_stacks:
+                self._stacks[stack] = 1
+            else:
+                self.dropped += 1
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.add(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class Trace:
+    """Time spent per stage while one websocket event is handled."""
+
+    def __init__(self, event):
+        self.event = event
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+
+_current = contextvars.ContextVar('chat_trace', default=None)
+
+
+def stage(name):
+    """
+    Context manager timing one stage (parse, db, group_send, send) of the
+    event being traced; does nothing when the slow log is off.
+    """
+    trace = _current.get()
+    if trace is None:
+        return _NULL_STAGE
+    return _Stage(trace, name)
+
+
+class SlowLog:
+    """Websocket handlers that took longer than threshold_ms, with per-stage timings."""
+
+    def __init__(self, enabled, threshold_ms, size):
+        self.enabled = enabled
+        self.threshold_ms = threshold_ms
+        self.traced = 0
+        self.recorded = 0
+        self.entries = deque(maxlen=size)
+
+    def begin(self, event):
+        """Start tracing `event`; returns a token for finish(), or None when off."""
+        if not self.enabled:
+            return None
+        self.traced += 1
+        return _current.set(Trace(event))
+
+    def finish(self, token, **details):
+        if token is None:
+            return
+        trace = _current.get()
+        _current.reset(token)
+        total_ms = (time.perf_counter() - trace.started) * 1000
+        if total_ms < self.threshold_ms:
+            return
+        stages = {name: round(seconds * 1000, 3) for name, seconds in trace.stages.items()}
+        stages['other'] = round(max(0.0, total_ms - sum(stages.values())), 3)
+        entry = dict(details, at=time.time(), event=trace.event, total_ms=round(total_ms, 3), stages=stages)
+        self.recorded += 1
+        self.entries.append(entry)
+        logger.warning('Slow %s: %.1f ms %s', trace.event, total_ms, stages)
+
+    def status(self):
+        return {
+            'enabled': self.enabled,
+            'threshold_ms': self.threshold_ms,
+            'traced': self.traced,
+            'recorded': self.recorded,
+            'entries': list(self.entries),
+        }
+
+
+class TracingMixin:
+    """Traces connect and every received frame through slow_log."""
+
+    async def websocket_connect(self, message):
+        token = slow_log.begin('connect')
+        try:
+            await super().websocket_connect(message)
+        finally:
+            slow_log.finish(token, consumer=type(self).__name__, path=self.scope.get('path'))
+
+    async def websocket_receive(self, message):
+        token = slow_log.begin('receive')
+        try:
+            await super().websocket_receive(message)
+        finally:
+            if token is not None:
+                text = message.get('text') or ''
+                slow_log.finish(token, consumer=type(self).__name__, path=self.scope.get('path'),
+                                type=peek_type(text), size=len(text))
+
+
+def _build():
+    config = chat_setting('CHAT_PROFILING', DEFAULTS)
+    return (
+        SamplingProfiler(
+            interval=config['SAMPLE_INTERVAL'],
+            max_seconds=config['MAX_SECONDS'],
+            max_stacks=config['MAX_STACKS'],
+        ),
+        SlowLog(enabled=config['SLOW_LOG'], threshold_ms=config['THRESHOLD_MS'], size=config['SLOW_LOG_SIZE']),
+    )
+
+
+profiler, slow_log = _build()
+stats.register('profiling', lambda: {
+    'profiler_running': profiler.running,
+    'profiler_samples': profiler.samples,
+    'slow_log_enabled': slow_log.enabled,
+    'slow_events': slow_log.recorded,
+})
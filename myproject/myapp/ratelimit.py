@@ -0,0 +1,168 @@
+import json
+import re
+import time
+from collections import Counter, OrderedDict
+
+from . import stats
+from .conf import chat_setting
+
+DEFAULTS = {
+    # Message type -> [tokens per second, burst]. '*' covers every type
+    # not listed (and frames whose type can't be read).
+    'CONNECTION': {
+        'chat_message': [2, 10],
+        'file_message': [0.5, 3],
+        'reaction': [5, 20],
+        'typing': [2, 10],
+        'stop_typing': [2, 10],
+        'fetch_older': [2, 5],
+        '*': [10, 20],
+    },
+    # The same, shared by all of a user's connections in this process.
+    'USER': {
+        'chat_message': [5, 20],
+        'file_message': [1, 5],
+        'reaction': [10, 40],
+        'typing': [4, 20],
+        'stop_typing': [4, 20],
+        'fetch_older': [4, 10],
+        '*': [20, 40],
+    },
+    # Per-user buckets kept; the least recently used are forgotten first.
+    'MAX_USERS': 10000,
+}
+
+# The templates send the type first, so it can be read without decoding
+# the rest of the frame.
+_TYPE_PREFIX = re.compile(r'\s*\{\s*"type"\s*:\s*"([A-Za-z_]{1,40})"')
+
+
+def peek_type(text):
+    match = _TYPE_PREFIX.match(text)
+    if match is not None:
+        return match.group(1)
+    try:
+        return json.loads(text).get('type')
+    except (ValueError, AttributeError):
+        return None
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimiter:
+    """
+    Token buckets per connection and per user, one per message type.
+
+    A frame has to get a token from both; each check is a couple of dict
+    lookups and some arithmetic.
+    """
+
+    def __init__(self, connection_limits, user_limits, max_users):
+        self.connection_limits = connection_limits
+        self.user_limits = user_limits
+        self.max_users = max_users
+        self.allowed = Counter()
+        self.throttled_connection = Counter()
+        self.throttled_user = Counter()
+        self._users = OrderedDict()
+
+    def kind(self, message_type):
+        return message_type if message_type in self.connection_limits else '*'
+
+    def allow(self, consumer, message_type):
+        kind = self.kind(message_type)
+        now = time.monotonic()
+
+        buckets = consumer.rate_buckets
+        bucket = buckets.get(kind)
+        if bucket is None:
+            bucket = buckets[kind] = TokenBucket(*self.connection_limits[kind], now)
+        if not bucket.take(now):
+            self.throttled_connection[kind] += 1
+            return False
+
+        user_id = getattr(consumer.scope.get('user'), 'id', None)
+        if user_id is not None:
+            user_kind = kind if kind in self.user_limits else '*'
+            key = (user_id, user_kind)
+            bucket = self._users.get(key)
+            if bucket is None:
+                bucket = self._users[key] = TokenBucket(*self.user_limits[user_kind], now)
+                if len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            else:
+                self._users.move_to_end(key)
+            if not bucket.take(now):
+                self.throttled_user[user_kind] += 1
+                return False
+
+        self.allowed[kind] += 1
+        return True
+
+    def stats(self):
+        return {
+            'allowed': dict(self.allowed),
+            'throttled_connection': dict(self.throttled_connection),
+            'throttled_user': dict(self.throttled_user),
+            'users_tracked': len(self._users),
+        }
+
+
+class RateLimitMixin:
+    """Drops websocket frames over the rate limit before receive() sees them."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_buckets = {}
+        self._throttled_kinds = set()
+        # The type the current frame was charged as; receive() drops the
+        # frame if it decodes to another (a repeated "type" key).
+        self.charged_type = None
+
+    async def websocket_receive(self, message):
+        text = message.get('text')
+        if text is not None:
+            message_type = peek_type(text)
+            kind = rate_limiter.kind(message_type)
+            if not rate_limiter.allow(self, message_type):
+                # Tell the client once per run of rejected frames, not per frame.
+                if kind not in self._throttled_kinds:
+                    self._throttled_kinds.add(kind)
+                    await self.send(text_data=json.dumps({
+                        'type': 'error',
+                        'message': 'Rate limit exceeded',
+                        'message_type': message_type if kind != '*' else None
+                    }), droppable=True)
+                return
+            self._throttled_kinds.discard(kind)
+            self.charged_type = message_type
+        await super().websocket_receive(message)
+
+
+def _build_limiter():
+    config = chat_setting('CHAT_RATE_LIMITS', DEFAULTS)
+    return RateLimiter(
+        connection_limits=config['CONNECTION'],
+        user_limits=config['USER'],
+        max_users=config['MAX_USERS'],
+    )
+
+
+rate_limiter = _build_limiter()
+stats.register('rate_limits', rate_limiter.stats)
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import F
+
+from . import stats
+from .broadcast import encode_event
+from .conf import chat_setting
+from .db import read_executor, write_executor
+from .models import MessageReaction, UserReaction
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_ID = MessageReaction._meta.get_field('message_id').max_length
+MAX_EMOJI = MessageReaction._meta.get_field('emoji').max_length
+
+DEFAULTS = {
+    # Seconds between merged delta broadcasts (and batched DB writes).
+    'INTERVAL': 0.5,
+}
+
+
+class ReactionAggregator:
+    """
+    Reaction counters, aggregated in memory between flushes.
+
+    Every INTERVAL each room that received reactions gets one broadcast of
+    the merged deltas ({message_id: {emoji: delta}}), and all deltas are
+    written to MessageReaction in a single transaction. A reaction toggles:
+    a user's second identical reaction is a -1 that takes the first back.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.received = 0
+        self.broadcasts = 0
+        self.flushed_rows = 0
+        # group -> {message_id: {emoji: delta}} not yet broadcast
+        self._room_deltas = {}
+        # (message_id, emoji) -> delta not yet written
+        self._unwritten = {}
+        # (message_id, user_id, emoji) -> reacted, not yet written
+        self._votes = {}
+        self._lock = None
+        self._lock_loop = None
+        self._task = None
+
+    async def add(self, group, message_id, user_id, emoji):
+        """
+        Toggle `user_id`'s `emoji` on a message. The caller checks that the
+        message belongs to `group`.
+        """
+        if not (isinstance(message_id, str) and isinstance(emoji, str)) or user_id is None:
+            return
+        if len(message_id) > MAX_MESSAGE_ID or len(emoji) > MAX_EMOJI:
+            return
+        self.received += 1
+        vote = (message_id, user_id, emoji)
+        reacted = self._votes.get(vote)
+        if reacted is None:
+            # As in counts(): the lock keeps a half-written batch out of the read.
+            async with self._get_lock():
+                reacted = self._votes.get(vote)
+                if reacted is None:
+                    reacted = await read_executor.run(UserReaction.has_reacted, message_id, user_id, emoji)
+        self._votes[vote] = not reacted
+        delta = -1 if reacted else 1
+
+        room = self._room_deltas.setdefault(group, {})
+        message = room.setdefault(message_id, {})
+        message[emoji] = message.get(emoji, 0) + delta
+        key = (message_id, emoji)
+        self._unwritten[key] = self._unwritten.get(key, 0) + delta
+        self._ensure_running()
+
+    async def counts(self, message_ids):
+        """Current counts for the given messages, including unwritten deltas."""
+        if not message_ids:
+            return {}
+        # Holding the lock means no batch is half-way into the database.
+        async with self._get_lock():
+            counts = await read_executor.run(MessageReaction.counts_for, message_ids)
+            wanted = set(message_ids)
+            for (message_id, emoji), delta in self._unwritten.items():
+                if message_id in wanted:
+                    message = counts.setdefault(message_id, {})
+                    message[emoji] = message.get(emoji, 0) + delta
+        return counts
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'broadcasts': self.broadcasts,
+            'flushed_rows': self.flushed_rows,
+            'unwritten': len(self._unwritten),
+        }
+
+    def _get_lock(self):
+        loop = asyncio.get_running_loop()
+        if self._lock_loop is not loop:
+            self._lock, self._lock_loop = asyncio.Lock(), loop
+        return self._lock
+
+    def _ensure_running(self):
+        if (self._task is None or self._task.done()
+                or self._task.get_loop() is not asyncio.get_running_loop()):
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        channel_layer = get_channel_layer()
+        while self._room_deltas or self._unwritten or self._votes:
+            await asyncio.sleep(self.interval)
+
+            room_deltas, self._room_deltas = self._room_deltas, {}
+            for group, deltas in room_deltas.items():
+                self.broadcasts += 1
+                await channel_layer.group_send(group, encode_event({
+                    'type': 'reaction',
+                    'reactions': deltas
+                }))
+
+            async with self._get_lock():
+                unwritten, self._unwritten = self._unwritten, {}
+                votes, self._votes = self._votes, {}
+                if not (unwritten or votes):
+                    continue
+                try:
+                    await write_executor.run(self._write, unwritten, votes)
+                except Exception:
+                    logger.exception('Failed to persist %d reaction counters', len(unwritten))
+                    # Put them back to be retried with the next batch.
+                    for key, delta in unwritten.items():
+                        self._unwritten[key] = self._unwritten.get(key, 0) + delta
+                    for vote, reacted in votes.items():
+                        self._votes.setdefault(vote, reacted)
+                else:
+                    self.flushed_rows += len(unwritten)
+
+    def _write(self, deltas, votes):
+        with transaction.atomic():
+            UserReaction.objects.bulk_create([
+                UserReaction(message_id=message_id, user_id=user_id, emoji=emoji)
+                for (message_id, user_id, emoji), reacted in votes.items() if reacted
+            ], ignore_conflicts=True)
+            for (message_id, user_id, emoji), reacted in votes.items():
+                if not reacted:
+                    UserReaction.objects.filter(message_id=message_id, user_id=user_id, emoji=emoji).delete()
+            for (message_id, emoji), delta in deltas.items():
+                if not delta:
+                    continue
+                reaction, created = MessageReaction.objects.get_or_create(
+                    message_id=message_id, emoji=emoji, defaults={'count': delta}
+                )
+                if not created:
+                    MessageReaction.objects.filter(pk=reaction.pk).update(count=F('count') + delta)
+
+
+def _build_aggregator():
+    config = chat_setting('CHAT_REACTIONS', DEFAULTS)
+    return ReactionAggregator(interval=config['INTERVAL'])
+
+
+reaction_aggregator = _build_aggregator()
+stats.register('reactions', reaction_aggregator.stats)
@@ -0,0 +1,149 @@
+import asyncio
+import json
+import uuid
+
+from .history import history_cache
+from .pagination import MAX_PAGE_SIZE, MAX_RESYNC_PAGES, clamp_page_size, cursor_before
+from .persistence import message_writer
+from .previews import preview_pipeline
+from .reactions import reaction_aggregator
+
+# file_preview broadcasts still waiting on a thumbnail; held here so they
+# are not garbage collected mid-flight.
+_preview_tasks = set()
+
+
+class RoomMessagesMixin:
+    """
+    History, reactions and file messages, shared by both chat consumers.
+
+    The consumer provides `group`, the room's group name (also its
+    history_cache key), and the db_read methods get_last_messages,
+    get_history_page, get_resync_anchor and get_messages_after.
+    """
+
+    async def share_file(self, text_data_json):
+        file_payload = {
+            'type': 'file_message',
+            'file_name': text_data_json['file_name'],
+            'file_url': text_data_json['file_url'],
+            'username': self.user.username,
+            'message_id': str(uuid.uuid4())
+        }
+        preview_name = preview_pipeline.name_for_url(file_payload['file_url'])
+        preview = preview_pipeline.get(preview_name) if preview_name else None
+        if preview is not None:
+            file_payload.update(preview)
+        elif preview_name is not None:
+            file_payload['preview_pending'] = True
+
+        await self.broadcast(self.group, file_payload)
+        if file_payload.get('preview_pending'):
+            task = asyncio.ensure_future(self.broadcast_preview(self.group, file_payload, preview_name))
+            _preview_tasks.add(task)
+            task.add_done_callback(_preview_tasks.discard)
+
+    async def broadcast_preview(self, group, file_payload, preview_name):
+        # Follows a file_message that went out before its thumbnail was ready.
+        preview = await preview_pipeline.wait(preview_name)
+        await self.broadcast(group, dict(
+            preview or {},
+            type='file_preview',
+            file_name=file_payload['file_name'],
+            file_url=file_payload['file_url'],
+            message_id=file_payload['message_id']
+        ))
+
+    async def react(self, message_id, reaction):
+        if await self.has_message(message_id):
+            await reaction_aggregator.add(self.group, message_id, self.user.id, reaction)
+
+    async def fetch_messages(self):
+        messages_json = await history_cache.get(self.group, self.get_last_messages)
+        if messages_json and messages_json[-1].get('id') is None:
+            # The page boundary is still queued; cursor_before needs its id.
+            await message_writer.flush_unsaved(messages_json[-1]['message_id'])
+        content = {
+            'type' : 'fetch_messages',
+            'messages' : messages_json,
+            'next_cursor' : cursor_before(messages_json, history_cache.depth),
+            'reactions' : await self.get_reactions(messages_json)
+        }
+
+        await self.send(text_data=json.dumps(content))
+
+    async def get_reactions(self, messages_json):
+        return await reaction_aggregator.counts(
+            [message['message_id'] for message in messages_json if message.get('message_id')]
+        )
+
+    async def has_message(self, message_id):
+        """
+        Whether `message_id` is a message stored in this room. File messages
+        are not stored, so they take no reactions.
+        """
+        if not isinstance(message_id, str):
+            return False
+        try:
+            message_id = str(uuid.UUID(message_id))
+        except ValueError:
+            return False
+        if await self.get_resync_anchor(message_id) is not None:
+            return True
+        # It may still be queued with the writer (reacting to a new message).
+        if not await message_writer.flush_unsaved(message_id):
+            return False
+        return await self.get_resync_anchor(message_id) is not None
+
+    async def resync(self, last_seen):
+        """
+        Send every message newer than `last_seen`, oldest first, in chunks
+        of at most MAX_PAGE_SIZE. Returns False when last_seen is not a
+        stored message, or is more than MAX_RESYNC_PAGES behind (the client
+        is sent resync_gap), and the client needs fetch_messages instead.
+        """
+        if last_seen is None:
+            return False
+        # The client may have seen last_seen broadcast before it was written.
+        # Only this worker's queue can be flushed; a last_seen still queued
+        # on another worker is not found, and the client gets fetch_messages.
+        await message_writer.flush_unsaved(last_seen)
+        anchor = await self.get_resync_anchor(last_seen)
+        if anchor is None:
+            return False
+
+        pages = []
+        while anchor is not None:
+            if len(pages) == MAX_RESYNC_PAGES:
+                await self.send(text_data=json.dumps({'type': 'resync_gap'}))
+                return False
+            messages_json, anchor = await self.get_messages_after(anchor, MAX_PAGE_SIZE)
+            pages.append(messages_json)
+
+        for i, messages_json in enumerate(pages):
+            await self.send(text_data=json.dumps({
+                'type': 'resync',
+                'messages': messages_json,
+                'reactions': await self.get_reactions(messages_json),
+                'done': i == len(pages) - 1
+            }))
+        return True
+
+    async def fetch_older(self, before, limit):
+        try:
+            messages_json, next_cursor = await self.get_history_page(before, clamp_page_size(limit))
+        except ValueError:
+            await self.send(text_data=json.dumps({'type': 'error', 'message': 'Invalid cursor'}))
+            return
+
+        await self.send(text_data=json.dumps({
+            'type': 'older_messages',
+            'messages': messages_json,
+            'next_cursor': next_cursor
+        }))
+
+    def messages_to_json(self, messages):
+        return [self.message_to_json(message) for message in messages]
+
+    def message_to_json(self, message):
+        return message.to_json()
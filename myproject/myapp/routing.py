@@ -4,6 +4,7 @@ from myapp.consumer import ChatConsumer, PrivateChatConsumer
 websocket_urlpatterns = [
 
     path("ws/chat/", ChatConsumer.as_asgi()),
+    path("ws/chat/<slug:room_name>/", ChatConsumer.as_asgi()),
     path('ws/private-chat/', PrivateChatConsumer.as_asgi())
 
 ]
\ No newline at end of file
@@ -0,0 +1,194 @@
+import base64
+import re
+import time
+
+from django.db import connection
+
+from . import stats
+from .conf import chat_setting
+
+DEFAULTS = {
+    # Matches scored per query, newest first. Ranking is bm25 over these,
+    # so a word in every other message costs the same as a rare one.
+    'MAX_CANDIDATES': 5000,
+}
+
+# Query words used; anything after is ignored.
+MAX_TERMS = 8
+# Shortest last word that is also matched as a prefix ("hel" finds "hello").
+MIN_PREFIX = 3
+
+_WORD = re.compile(r'\w+')
+
+
+class SearchIndex:
+    """
+    SQLite FTS5 index over a message table's content.
+
+    The FTS table is an external-content index: it stores only the
+    inverted index and reads text back from the message table. Triggers
+    keep it in step with every insert, update and delete, including the
+    bulk_create batches from message_writer. Scope columns (room, author)
+    are indexed alongside the text, so a scoped search narrows by posting
+    list instead of filtering every match afterwards.
+    """
+
+    def __init__(self, table, scope_columns):
+        self.table = table
+        self.fts_table = f'{table}_fts'
+        self.scope_columns = scope_columns
+        self.columns = ('content',) + scope_columns
+
+    def create_sql(self):
+        columns = ', '.join(self.columns)
+        new = ', '.join(f'new.{column}' for column in self.columns)
+        old = ', '.join(f'old.{column}' for column in self.columns)
+        fts = self.fts_table
+        return [
+            f"CREATE VIRTUAL TABLE {fts} USING fts5({columns}, content='{self.table}', content_rowid='id', "
+            f"tokenize='unicode61 remove_diacritics 2')",
+            f"CREATE TRIGGER {fts}_insert AFTER INSERT ON {self.table} BEGIN "
+            f"INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new}); END",
+            f"CREATE TRIGGER {fts}_delete AFTER DELETE ON {self.table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old}); END",
+            # Only indexed columns: message_id backfills etc. leave the index alone.
+            f"CREATE TRIGGER {fts}_update AFTER UPDATE OF {columns} ON {self.table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old}); "
+            f"INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new}); END",
+        ]
+
+    def drop_sql(self):
+        fts = self.fts_table
+        return [
+            f'DROP TRIGGER IF EXISTS {fts}_insert',
+            f'DROP TRIGGER IF EXISTS {fts}_delete',
+            f'DROP TRIGGER IF EXISTS {fts}_update',
+            f'DROP TABLE IF EXISTS {fts}',
+        ]
+
+    def rebuild(self, cursor):
+        """Re-index every row of the message table."""
+        cursor.execute(f"INSERT INTO {self.fts_table}({self.fts_table}) VALUES ('rebuild')")
+
+    def optimize(self, cursor):
+        """Merge the index's b-trees into one; worth it after a rebuild."""
+        cursor.execute(f"INSERT INTO {self.fts_table}({self.fts_table}) VALUES ('optimize')")
+
+    def search(self, cursor, query, scope, after, limit, max_candidates):
+        """
+        Row ids matching `query` within `scope` (column -> exact value),
+        best first, as a list of (bm25 score, id). Only the newest
+        `max_candidates` matches are ranked. `after` is the last
+        (score, id) of the previous page, or None.
+        """
+        expression = match_expression(query, scope)
+        if expression is None:
+            return []
+
+        # Only the text counts towards the score.
+        weights = ', '.join(['1.0'] + ['0.0'] * len(self.scope_columns))
+        # The index matches scope values by token; compare exactly as well.
+        exact = ''.join(f' AND m.{column} = %s' for column in scope)
+        # CROSS JOIN keeps the FTS table as the outer loop, so matches come
+        # off its doclist in rowid order and the LIMIT stops the walk.
+        sql = (
+            f'SELECT id, score FROM ('
+            f'SELECT f.rowid AS id, bm25({self.fts_table}, {weights}) AS score '
+            f'FROM {self.fts_table} f CROSS JOIN {self.table} m ON m.id = f.rowid '
+            f'WHERE {self.fts_table} MATCH %s{exact} '
+            f'ORDER BY f.rowid DESC LIMIT %s)'
+        )
+        params = [expression] + list(scope.values()) + [max_candidates]
+        if after is not None:
+            sql += ' WHERE score > %s OR (score = %s AND id > %s)'
+            params += [after[0], after[0], after[1]]
+        sql += ' ORDER BY score, id LIMIT %s'
+        params.append(limit)
+
+        cursor.execute(sql, params)
+        return [(score, pk) for pk, score in cursor.fetchall()]
+
+
+def match_expression(query, scope):
+    """
+    FTS5 query for free text: every word must appear, the last one may be
+    a prefix. Words are quoted, so FTS5 operators typed by a user are
+    searched for literally instead of being parsed. None if there is
+    nothing to search for.
+    """
+    words = _WORD.findall(query or '')[:MAX_TERMS]
+    if not words:
+        return None
+    phrases = [f'"{word}"' for word in words]
+    if len(words[-1]) >= MIN_PREFIX:
+        phrases[-1] += '*'
+    expression = f"content : ({' '.join(phrases)})"
+    for column, value in scope.items():
+        tokens = _WORD.findall(str(value))
+        if tokens:
+            expression += f' AND {column} : "{" ".join(tokens)}"'
+    return expression
+
+
+def encode_cursor(score, pk):
+    return base64.urlsafe_b64encode(f'{score!r}|{pk}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(score, pk) for a cursor made by encode_cursor; ValueError if malformed."""
+    try:
+        score, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return float(score), int(pk)
+    except (AttributeError, TypeError, UnicodeError, ValueError) as exc:
+        raise ValueError('Invalid cursor') from exc
+
+
+config = chat_setting('CHAT_SEARCH', DEFAULTS)
+
+message_index = SearchIndex('myapp_message', ('room', 'author_id'))
+private_message_index = SearchIndex('myapp_privatemessage', ('room_id', 'author_id'))
+INDEXES = (message_index, private_message_index)
+
+_totals = {'queries': 0, 'time_total': 0.0, 'time_max': 0.0}
+
+
+def available():
+    return connection.vendor == 'sqlite'
+
+
+def search_page(index, model, query, scope, cursor, limit):
+    """
+    One page of `model` rows matching `query`, ranked by bm25 and paged by
+    keyset on (score, id). Returns (rows, next_cursor); next_cursor is None
+    on the last page. Scores move as the index grows, so a row can shift
+    between pages while new messages arrive; no row appears twice within
+    one unchanged index. Only the newest MAX_CANDIDATES matches are
+    ranked; older ones are reached by narrowing the query or scope.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    started = time.perf_counter()
+    with connection.cursor() as db_cursor:
+        ranked = index.search(db_cursor, query, scope, after, limit + 1, config['MAX_CANDIDATES'])
+    elapsed = time.perf_counter() - started
+    _totals['queries'] += 1
+    _totals['time_total'] += elapsed
+    _totals['time_max'] = max(_totals['time_max'], elapsed)
+
+    next_cursor = None
+    if len(ranked) > limit:
+        ranked = ranked[:limit]
+        next_cursor = encode_cursor(*ranked[-1])
+    rows = model.objects.select_related('author').in_bulk([pk for _, pk in ranked])
+    return [rows[pk] for _, pk in ranked if pk in rows], next_cursor
+
+
+def search_stats():
+    queries = _totals['queries']
+    return {
+        'queries': queries,
+        'time_avg': _totals['time_total'] / queries if queries else None,
+        'time_max': _totals['time_max'],
+    }
+
+
+stats.register('search', search_stats)
@@ -0,0 +1,92 @@
+import bisect
+import hashlib
+
+from django.core.exceptions import ImproperlyConfigured
+
+from . import stats
+from .conf import chat_setting
+
+DEFAULTS = {
+    # Shard name -> websocket base URL of the worker(s) serving it, e.g.
+    # {"a": "ws://chat-a:8001", "b": "ws://chat-b:8001"}. Empty means a
+    # single deployment that serves every room.
+    'SHARDS': {},
+    # Room name -> shard name, for hot rooms. A shard that rooms are pinned
+    # to serves only those rooms and is left off the hash ring.
+    'PINS': {},
+    # The shard this process serves; None serves every room.
+    'LOCAL_SHARD': None,
+    # Points per shard on the ring; more points spread rooms more evenly.
+    'VNODES': 64,
+}
+
+
+def _hash(key):
+    # Must agree across processes, so not the (randomized) builtin hash().
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class ShardRouter:
+    """
+    Assigns public rooms to shards.
+
+    Pinned rooms go to their shard; every other room is placed on a
+    consistent-hash ring, so adding or removing a shard only moves the
+    rooms on the arcs next to it.
+    """
+
+    def __init__(self, shards, pins, local_shard, vnodes):
+        unknown = {shard for shard in pins.values() if shard not in shards}
+        if local_shard is not None and shards and local_shard not in shards:
+            unknown.add(local_shard)
+        if unknown:
+            raise ImproperlyConfigured(f"Unknown chat shard(s): {', '.join(sorted(unknown))}")
+
+        self.shards = shards
+        self.pins = pins
+        self.local_shard = local_shard
+        self.rejected = 0
+
+        dedicated = set(pins.values())
+        ring_shards = [shard for shard in shards if shard not in dedicated] or list(shards)
+        self._ring = sorted((_hash(f'{shard}#{i}'), shard) for shard in ring_shards for i in range(vnodes))
+        self._points = [point for point, _ in self._ring]
+
+    def shard_for(self, room):
+        if room in self.pins:
+            return self.pins[room]
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._points, _hash(room)) % len(self._ring)
+        return self._ring[index][1]
+
+    def is_local(self, room):
+        if not self.shards or self.local_shard is None:
+            return True
+        return self.shard_for(room) == self.local_shard
+
+    def socket_url(self, room):
+        """Websocket base URL for `room`, or None to use the current host."""
+        return self.shards.get(self.shard_for(room))
+
+    def stats(self):
+        return {
+            'local_shard': self.local_shard,
+            'shards': len(self.shards),
+            'pinned_rooms': len(self.pins),
+            'rejected': self.rejected,
+        }
+
+
+def _build_router():
+    config = chat_setting('CHAT_SHARDING', DEFAULTS)
+    return ShardRouter(
+        shards=config['SHARDS'],
+        pins=config['PINS'],
+        local_shard=config['LOCAL_SHARD'],
+        vnodes=config['VNODES'],
+    )
+
+
+shard_router = _build_router()
+stats.register('sharding', shard_router.stats)
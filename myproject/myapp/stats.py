@@ -0,0 +1,11 @@
+# Components register a zero-argument callable returning a dict of their
+# counters; StatsView (and anything else that wants them) reads a snapshot.
+_providers = {}
+
+
+def register(name, provider):
+    _providers[name] = provider
+
+
+def snapshot():
+    return {name: provider() for name, provider in _providers.items()}
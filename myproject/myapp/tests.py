@@ -1,3 +1,1099 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from myproject.asgi import application
+
+from . import archive, broker, heartbeat, matchmaking, metrics, outbound, profiling, rooms, uploads
+from .announcements import JoinAnnouncer
+from .broadcast import DROPPABLE_TYPES
+from .consumer import PrivateChatConsumer
+from .history import HistoryCache, history_cache
+from .identity import session_users
+from .layers import LocalBrokerChannelLayer
+from .matchmaking import matchmaker
+from .media import MediaApplication
+from .models import (
+    ChunkedUpload, Message, MessageReaction, PrivateChatRoom, PrivateMessage, PrivateRoomConnection,
+)
+from .pagination import (
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, clamp_page_size, cursor_before, decode_cursor, encode_cursor,
+)
+from .persistence import DURABILITY_ACK, DURABILITY_NONE, MessageWriter, message_writer
+from .presence import PresenceRegistry, _write_snapshot, presence
+from .previews import preview_pipeline
+from .ratelimit import rate_limiter
+from .reactions import reaction_aggregator
+from .sharding import ShardRouter
+from .typing_indicators import SOURCE, TypingCoalescer
+
+
+class IsolatedMixin:
+    """Temporary MEDIA_ROOT and archive directory, and empty in-process state."""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, True)
+        self.addCleanup(shutil.rmtree, archive_dir, True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        patcher = mock.patch.object(archive.message_archive, 'directory', archive_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        history_cache._rooms.clear()
+        matchmaker._waiting.clear()
+        matchmaker._matched.clear()
+        rate_limiter._users.clear()
+        session_users._users.clear()
+        session_users.hits = session_users.misses = 0
+        reaction_aggregator.interval = 0.05
+
+
+def session_headers(user):
+    client = Client()
+    client.force_login(user)
+    return [(b'cookie', f'sessionid={client.cookies["sessionid"].value}'.encode())]
+
+
+async def drain(communicator, timeout=0.3):
+    # receive_nothing() never cancels the consumer, unlike a receive that times out.
+    frames = []
+    while not await communicator.receive_nothing(timeout=timeout):
+        frames.append(await communicator.receive_json_from())
+    return frames
+
+
+def of_type(frames, message_type):
+    return [frame for frame in frames if frame.get('type') == message_type]
+
+
+class PaginationTests(IsolatedMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='alice')
+
+    def test_cursor_round_trip(self):
+        now = timezone.now()
+        self.assertEqual(decode_cursor(encode_cursor(now, 42)), (now, 42))
+        # Cursors from before ids were carried still decode.
+        self.assertEqual(decode_cursor(encode_cursor(now)), (now, None))
+        for bad in ('', 'not base64!', encode_cursor(now)[:-4] + 'AAAA'):
+            with self.assertRaises(ValueError):
+                decode_cursor(bad)
+
+    def test_clamp_page_size(self):
+        self.assertEqual(clamp_page_size(0), 1)
+        self.assertEqual(clamp_page_size(MAX_PAGE_SIZE + 1), MAX_PAGE_SIZE)
+        self.assertEqual(clamp_page_size('x'), DEFAULT_PAGE_SIZE)
+        self.assertEqual(clamp_page_size(None), DEFAULT_PAGE_SIZE)
+
+    def test_pages_through_shared_timestamps(self):
+        now = timezone.now()
+        Message.objects.bulk_create(
+            [Message(author=self.user, room='r', content=f'old{i}', timestamp=now - timedelta(seconds=i + 1))
+             for i in range(5)]
+            + [Message(author=self.user, room='r', content=f'tie{i}', timestamp=now) for i in range(25)]
+            + [Message(author=self.user, room='other', content='elsewhere', timestamp=now)]
+        )
+        seen, cursor = [], None
+        while True:
+            rows, cursor = Message.history_page('r', cursor, 10)
+            self.assertLessEqual(len(rows), 10)
+            seen += rows
+            if cursor is None:
+                break
+        self.assertEqual(len(seen), 30)
+        self.assertEqual(len({row.pk for row in seen}), 30)
+        self.assertEqual([row.pk for row in seen],
+                         list(Message.objects.filter(room='r').order_by('-timestamp', '-id').values_list('pk', flat=True)))
+
+    def test_last_messages_break_ties_by_id(self):
+        now = timezone.now()
+        Message.objects.bulk_create([Message(author=self.user, room='r', content=f'tie{i}', timestamp=now)
+                                     for i in range(5)])
+        newest = list(Message.objects.filter(room='r').order_by('-id').values_list('pk', flat=True)[:3])
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual([message.pk for message in Message.last_messages('r', 3)], newest)
+        # Ties are broken in the query, not by whichever order the database scans in.
+        self.assertIn('"timestamp" DESC, "myapp_message"."id" DESC', queries[0]['sql'])
+
+    def test_cursor_before_carries_the_id(self):
+        now = timezone.now()
+        messages_json = [{'time': str(now), 'id': 7}, {'time': str(now), 'id': 5}]
+        self.assertEqual(decode_cursor(cursor_before(messages_json, 2)), (now, 5))
+        # Fewer than a page: nothing older.
+        self.assertIsNone(cursor_before(messages_json, 3))
+        # An unsaved oldest message falls back to the oldest saved one.
+        messages_json[-1]['id'] = None
+        self.assertEqual(decode_cursor(cursor_before(messages_json, 2)), (now, 7))
+
+
+class HistoryCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.loads = []
+
+    def loader(self, key, count=5):
+        async def load():
+            self.loads.append(key)
+            return [{'message': f'{key}{i}'} for i in reversed(range(count))]
+        return load
+
+    async def test_ring_buffer_keeps_the_newest(self):
+        cache = HistoryCache(depth=3, max_rooms=10)
+        self.assertEqual([m['message'] for m in await cache.get('a', self.loader('a'))], ['a4', 'a3', 'a2'])
+        cache.append('a', {'message': 'new'})
+        self.assertEqual([m['message'] for m in await cache.get('a', self.loader('a'))], ['new', 'a4', 'a3'])
+        # Warmed once; the second get is answered from memory.
+        self.assertEqual(self.loads, ['a'])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    async def test_least_recently_used_room_is_evicted(self):
+        cache = HistoryCache(depth=3, max_rooms=2)
+        for key in ('a', 'b', 'a', 'c'):
+            await cache.get(key, self.loader(key))
+        self.assertEqual(list(cache._rooms), ['a', 'c'])
+        self.assertEqual(cache.evictions, 1)
+        # Not kept while cold: appends to an evicted room are not buffered.
+        cache.append('b', {'message': 'lost'})
+        self.assertNotIn('b', cache._rooms)
+
+    async def test_concurrent_misses_share_one_load(self):
+        cache = HistoryCache(depth=3, max_rooms=10)
+        await asyncio.gather(*(cache.get('a', self.loader('a')) for _ in range(5)))
+        self.assertEqual(self.loads, ['a'])
+        self.assertEqual(cache.misses, 5)
+
+    async def test_disabled_reads_through(self):
+        cache = HistoryCache(depth=3, max_rooms=10, enabled=False)
+        cache.append('a', {'message': 'ignored'})
+        for _ in range(2):
+            self.assertEqual(len(await cache.get('a', self.loader('a', 3))), 3)
+        self.assertEqual(self.loads, ['a', 'a'])
+        self.assertEqual(cache.stats()['rooms'], 0)
+
+
+class PresenceTests(SimpleTestCase):
+    async def test_join_and_leave(self):
+        registry = PresenceRegistry(ttl=60, sweep_interval=60, snapshot=False)
+        self.assertTrue(registry.join('tab1', 1, 'room'))
+        self.assertFalse(registry.join('tab2', 1, 'room'))
+        self.assertTrue(registry.join('tab3', 2, 'room'))
+        self.assertEqual((registry.occupancy('room'), registry.connections(1)), (2, 2))
+        self.assertEqual(registry.leave('tab1'), (1, 'room', False))
+        self.assertEqual(registry.leave('tab2'), (1, 'room', True))
+        self.assertIsNone(registry.leave('tab2'))
+        self.assertEqual(registry.members('room'), {2})
+        registry._task.cancel()
+
+    async def test_unrefreshed_leases_expire(self):
+        registry = PresenceRegistry(ttl=0.05, sweep_interval=60, snapshot=False)
+        registry.join('quiet', 1, 'room')
+        registry.join('chatty', 2, 'room')
+        await asyncio.sleep(0.03)
+        registry.touch('chatty')
+        await asyncio.sleep(0.03)
+        self.assertEqual(registry.expire(), 1)
+        self.assertEqual(registry.members('room'), {2})
+        self.assertEqual(registry.stats()['expired'], 1)
+        registry._task.cancel()
+
+
+class PresenceSnapshotTests(TestCase):
+    def test_snapshot_writes_private_members_and_drops_stale_rows(self):
+        alice = User.objects.create(username='alice')
+        bob = User.objects.create(username='bob')
+        room = PrivateChatRoom.objects.create(name='snapshot-room')
+        PrivateRoomConnection.objects.create(user=bob, room=room, seen_at=timezone.now() - timedelta(hours=1))
+
+        written, deleted = _write_snapshot(
+            {(room.name, alice.pk), ('chat-general', bob.pk)}, timezone.now() - timedelta(minutes=5))
+        # Public rooms are not snapshotted.
+        self.assertEqual((written, deleted), (1, 1))
+        self.assertEqual(list(PrivateRoomConnection.objects.values_list('user__username', flat=True)), ['alice'])
+        # Another process sees alice as a member through the snapshot.
+        self.assertTrue(room.has_member(alice))
+        self.assertFalse(room.has_member(bob))
+
+
+class GroupListenerMixin:
+    """A channel in group 'room' of the default layer, and what reaches it."""
+
+    async def listen(self):
+        self.layer = get_channel_layer()
+        self.channel = await self.layer.new_channel()
+        await self.layer.group_add('room', self.channel)
+
+    async def updates(self, seconds=0.1):
+        # Frames sent to the group until none arrives for `seconds`.
+        updates = []
+        while True:
+            try:
+                event = await asyncio.wait_for(self.layer.receive(self.channel), seconds)
+            except asyncio.TimeoutError:
+                return updates
+            updates.append(json.loads(event['text']))
+
+
+class TypingCoalescerTests(GroupListenerMixin, SimpleTestCase):
+    async def test_one_update_per_tick(self):
+        await self.listen()
+        coalescer = TypingCoalescer(tick=0.02, ttl=0.3)
+
+        for _ in range(5):
+            coalescer.typing('room', 'alice')
+        coalescer.typing('room', 'bob')
+        self.assertEqual(await self.updates(0.05), [{'type': 'typing', 'users': ['alice', 'bob'], 'source': SOURCE}])
+        self.assertEqual(coalescer.suppressed, 4)
+
+        # Stopped and started again inside one tick: nothing changed.
+        coalescer.stop_typing('room', 'bob')
+        coalescer.typing('room', 'bob')
+        coalescer.leave('room', 'bob')
+        self.assertEqual([update['users'] for update in await self.updates(0.05)], [['alice']])
+
+        # Never stopped: drops out after TTL.
+        self.assertEqual([update['users'] for update in await self.updates(0.4)], [[]])
+        self.assertEqual(coalescer.stats()['rooms'], 0)
+        await self.layer.group_discard('room', self.channel)
+
+
+class JoinAnnouncerTests(GroupListenerMixin, SimpleTestCase):
+    async def test_one_notice_per_window(self):
+        await self.listen()
+        announcer = JoinAnnouncer(window=0.02, max_names=2)
+        for username in ('ann', 'ben', 'cat', 'dan'):
+            announcer.joined('room', username)
+        announcer.left('room', 'eve')
+        [notice] = await self.updates(0.1)
+        self.assertEqual(notice['message'], 'ann, ben and 2 others have connected. eve has disconnected.')
+        self.assertEqual((notice['joined'], notice['left']), (['ann', 'ben', 'cat', 'dan'], ['eve']))
+
+        # A reconnect inside one window cancels out.
+        announcer.left('room', 'ann')
+        announcer.joined('room', 'ann')
+        self.assertEqual(await self.updates(0.1), [])
+        self.assertEqual(announcer.stats()['cancelled'], 2)
+        self.assertEqual(announcer.announcements, 1)
+        await self.layer.group_discard('room', self.channel)
+
+    def test_describe(self):
+        announcer = JoinAnnouncer(window=1, max_names=3)
+        self.assertEqual(announcer.describe(['ann'], []), 'ann has connected.')
+        self.assertEqual(announcer.describe([], ['ann', 'ben']), 'ann and ben have disconnected.')
+        self.assertEqual(announcer.describe(['ann', 'ben', 'cat'], []), 'ann, ben and cat have connected.')
+
+
+class MessageWriterTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='alice')
+
+    def message(self, content):
+        return Message(room='r', author=self.user, content=content)
+
+    async def test_none_returns_before_the_write(self):
+        writer = MessageWriter(batch_size=100, flush_interval=60, durability=DURABILITY_NONE)
+        message = self.message('queued')
+        serialized = message.to_json()
+        await writer.save(message, serialized, room='r')
+        self.assertEqual(writer.pending, 1)
+        self.assertFalse(await Message.objects.filter(content='queued').aexists())
+
+        await writer.flush()
+        self.assertEqual(serialized['id'], (await Message.objects.aget(content='queued')).pk)
+        self.assertEqual(writer.stats()['flushed_messages'], 1)
+
+    async def test_ack_returns_once_committed(self):
+        writer = MessageWriter(batch_size=100, flush_interval=0.01, durability=DURABILITY_ACK)
+        await asyncio.gather(*(writer.save(self.message(f'm{i}')) for i in range(3)))
+        self.assertEqual(await Message.objects.filter(room='r').acount(), 3)
+        # One batch for all three.
+        self.assertEqual(writer.flushed_batches, 1)
+
+    async def test_flush_unsaved_only_waits_for_queued_messages(self):
+        writer = MessageWriter(batch_size=100, flush_interval=60, durability=DURABILITY_NONE)
+        message = self.message('queued')
+        await writer.save(message, room='r')
+        self.assertFalse(await writer.flush_unsaved(str(uuid.uuid4()), room='elsewhere'))
+        self.assertEqual(writer.pending, 1)
+        self.assertTrue(await writer.flush_unsaved(room='r'))
+        self.assertEqual(writer.pending, 0)
+        self.assertFalse(await writer.flush_unsaved(str(message.message_id), room='r'))
+
+    def test_flush_sync_writes_what_is_left_at_shutdown(self):
+        writer = MessageWriter(batch_size=100, flush_interval=60, durability=DURABILITY_NONE)
+        async_to_sync(writer.save)(self.message('left over'))
+        self.assertFalse(Message.objects.filter(content='left over').exists())
+        writer.flush_sync()
+        self.assertTrue(Message.objects.filter(content='left over').exists())
+        self.assertEqual(writer.pending, 0)
+
+
+class MatchmakerUnitTests(SimpleTestCase):
+    def setUp(self):
+        matchmaker._waiting.clear()
+        matchmaker._matched.clear()
+
+    def test_pairs_in_arrival_order(self):
+        self.assertIsNone(matchmaker.pair(1, 'one')[0])
+        # Never with yourself, from another tab.
+        self.assertIsNone(matchmaker.pair(1, 'one-again')[0])
+        partner, ticket = matchmaker.pair(2, 'two')
+        self.assertIsNone(ticket)
+        self.assertEqual(partner.channel_name, 'one')
+        self.assertEqual(partner.room_name, 'private_chat_1_2')
+        self.assertEqual(matchmaker.pair(3, 'three')[0].channel_name, 'one-again')
+
+    def test_leave_abandons_the_ticket(self):
+        matchmaker.pair(1, 'one')
+        matchmaker.leave('one')
+        self.assertEqual(matchmaker.depth, 0)
+        self.assertIsNone(matchmaker.pair(2, 'two')[0])
+
+        matchmaker.pair(3, 'three')
+        self.assertTrue(matchmaker.confirm('two'))
+        self.assertEqual(matchmaker.leave('two'), 'private_chat_2_3')
+
+    def test_confirm_fails_once_the_ticket_is_gone(self):
+        matchmaker.pair(1, 'one')
+        matchmaker.pair(2, 'two')
+        # Left before the partner confirmed: nobody to tell, the partner pairs again.
+        self.assertIsNone(matchmaker.leave('one'))
+        self.assertFalse(matchmaker.confirm('one'))
+
+        matchmaker.pair(3, 'three')
+        matchmaker.pair(4, 'four')
+        self.assertTrue(matchmaker.confirm('three'))
+        # Once match_found arrives there is nobody to tell on leaving.
+        matchmaker.joined('three')
+        self.assertIsNone(matchmaker.leave('three'))
+
+    def test_anonymous_user_leaves_queue_alone(self):
+        matchmaker.pair(1, 'one')
+        with self.assertRaises(ValueError):
+            matchmaker.pair(None, 'anonymous')
+        self.assertEqual(matchmaker.depth, 1)
+
+
+class BrokerTests(SimpleTestCase):
+    @contextlib.asynccontextmanager
+    async def workers(self):
+        """Two workers' channel layers, each with its own broker connection."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        path = os.path.join(directory, 'broker.sock')
+        ready = asyncio.Event()
+        server = asyncio.ensure_future(broker.serve(path, ready=ready.set))
+        await ready.wait()
+        layers = [LocalBrokerChannelLayer(path) for _ in range(2)]
+        try:
+            yield layers
+        finally:
+            for layer in layers:
+                await layer.close()
+            # Let the broker see the connections close before it stops.
+            await asyncio.sleep(0.01)
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+
+    async def test_channels_and_groups_span_workers(self):
+        async with self.workers() as (one, two):
+            channel = await two.new_channel()
+            await one.send(channel, {'type': 'hello'})
+            self.assertEqual(await two.receive(channel), {'type': 'hello'})
+
+            channels = [await layer.new_channel() for layer in (one, two)]
+            for layer, member in zip((one, two), channels):
+                await layer.group_add('room', member)
+            await one.group_send('room', {'type': 'chat_message', 'text': 'hi'})
+            for layer, member in zip((one, two), channels):
+                self.assertEqual((await layer.receive(member))['text'], 'hi')
+
+    async def test_users_on_different_workers_are_paired(self):
+        async with self.workers() as (one, two):
+            self.assertIsNone(await matchmaking.pair(one, 1, 'alice'))
+            partner = await matchmaking.pair(two, 2, 'bob')
+            self.assertEqual((partner.channel_name, partner.room_name), ('alice', 'private_chat_1_2'))
+            self.assertTrue(await matchmaking.confirm(two, 'alice'))
+            # Gone before match_found: the partner's room is returned, to tell it.
+            self.assertEqual(await matchmaking.leave(one, 'alice'), 'private_chat_1_2')
+
+            self.assertIsNone(await matchmaking.pair(one, 3, 'carol'))
+            self.assertIsNone(await matchmaking.leave(two, 'carol'))
+            self.assertIsNone(await matchmaking.pair(two, 4, 'dave'))
+            with self.assertRaises(ValueError):
+                await matchmaking.pair(one, None, 'anonymous')
+            # The worker process's own queue is not used.
+            self.assertEqual(matchmaker.depth, 0)
+
+
+class PrivateChatTests(IsolatedMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.headers = {user: session_headers(user) for user in (self.alice, self.bob)}
+
+    async def test_pairs_two_users(self):
+        first = WebsocketCommunicator(application, '/ws/private-chat/', headers=self.headers[self.alice])
+        self.assertTrue((await first.connect())[0])
+        self.assertEqual(of_type(await drain(first), 'waiting'), [{'type': 'waiting'}])
+
+        second = WebsocketCommunicator(application, '/ws/private-chat/', headers=self.headers[self.bob])
+        self.assertTrue((await second.connect())[0])
+        # Each side joins the room and announces itself there; the partner
+        # may not have joined yet when that goes out.
+        for communicator, user in ((first, self.alice), (second, self.bob)):
+            notices = [frame['message'] for frame in await drain(communicator) if frame.get('username') == 'System']
+            self.assertIn(f'{user.username} has connected.', notices)
+        self.assertEqual(matchmaker.depth, 0)
+        room_name = f'private_chat_{self.alice.pk}_{self.bob.pk}'
+        self.assertEqual(presence.members(room_name), {self.alice.pk, self.bob.pk})
+
+        await first.disconnect()
+        self.assertIn('alice has disconnected.', [frame['message'] for frame in await drain(second)])
+        await second.disconnect()
+
+    async def test_partner_gone_while_the_room_is_created(self):
+        alice = WebsocketCommunicator(application, '/ws/private-chat/', headers=self.headers[self.alice])
+        await alice.connect()
+        await drain(alice)
+        create_room = PrivateChatConsumer.get_or_create_room
+
+        async def alice_leaves_first(consumer, room_name):
+            await alice.disconnect()
+            return await create_room(consumer, room_name)
+
+        with mock.patch.object(PrivateChatConsumer, 'get_or_create_room', alice_leaves_first):
+            bob = WebsocketCommunicator(application, '/ws/private-chat/', headers=self.headers[self.bob])
+            await bob.connect()
+            self.assertEqual(of_type(await drain(bob), 'waiting'), [{'type': 'waiting'}])
+        self.assertEqual(matchmaker.depth, 1)
+        await bob.disconnect()
+
+    async def test_abandoned_wait_leaves_the_queue(self):
+        communicator = WebsocketCommunicator(application, '/ws/private-chat/', headers=self.headers[self.alice])
+        await communicator.connect()
+        await drain(communicator)
+        self.assertEqual(matchmaker.depth, 1)
+        await communicator.disconnect()
+        self.assertEqual(matchmaker.depth, 0)
+
+    async def test_anonymous_user_is_rejected(self):
+        communicator = WebsocketCommunicator(application, '/ws/private-chat/')
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertEqual(matchmaker.depth, 0)
+
+
+class ChatConsumerTests(IsolatedMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.headers = {user: session_headers(user) for user in (self.alice, self.bob)}
+
+    async def connect(self, user, path='/ws/chat/'):
+        communicator = WebsocketCommunicator(application, path, headers=self.headers[user])
+        self.assertTrue((await communicator.connect())[0])
+        await drain(communicator)
+        return communicator
+
+    async def test_rate_limit_rejects_a_burst(self):
+        communicator = await self.connect(self.alice)
+        burst = rate_limiter.connection_limits['chat_message'][1]
+        for i in range(burst + 3):
+            await communicator.send_json_to({'type': 'chat_message', 'message': f'm{i}', 'time': ''})
+        frames = await drain(communicator)
+        self.assertEqual(len([frame for frame in of_type(frames, 'chat_message') if frame['username'] == 'alice']),
+                         burst)
+        # Told once per run of rejected frames.
+        self.assertEqual(of_type(frames, 'error'),
+                         [{'type': 'error', 'message': 'Rate limit exceeded', 'message_type': 'chat_message'}])
+        await message_writer.flush()
+        await communicator.disconnect()
+
+    async def test_repeated_type_key_is_dropped(self):
+        communicator = await self.connect(self.alice)
+        await communicator.send_to(text_data='{"type": "typing", "type": "chat_message", "message": "x", "time": ""}')
+        self.assertEqual(of_type(await drain(communicator), 'chat_message'), [])
+        self.assertFalse(await Message.objects.filter(content='x').aexists())
+        await communicator.disconnect()
+
+    async def test_reaction_toggles_and_stays_in_room(self):
+        elsewhere = await Message.objects.acreate(author=self.bob, room='other', content='x')
+        alice = await self.connect(self.alice)
+        await alice.send_json_to({'type': 'chat_message', 'message': 'hi', 'time': ''})
+        message_id = of_type(await drain(alice), 'chat_message')[-1]['message_id']
+
+        def react(target):
+            return alice.send_json_to({'type': 'reaction', 'reaction': '👍', 'message_id': str(target)})
+
+        await react(elsewhere.message_id)
+        # Not a UUID, or a file message (never stored): ignored, socket stays up.
+        await react('not-a-uuid')
+        await alice.send_json_to({'type': 'file_message', 'file_name': 'a.txt', 'file_url': '/media/a.txt'})
+        file_id = of_type(await drain(alice), 'file_message')[0]['message_id']
+        await react(file_id)
+        await react(message_id)
+        self.assertEqual(of_type(await drain(alice), 'reaction'),
+                         [{'type': 'reaction', 'reactions': {message_id: {'👍': 1}}}])
+        await react(message_id)
+        self.assertEqual(of_type(await drain(alice), 'reaction'),
+                         [{'type': 'reaction', 'reactions': {message_id: {'👍': -1}}}])
+        await alice.disconnect()
+
+        self.assertEqual(await reaction_aggregator.counts([message_id, file_id, str(elsewhere.message_id)]), {})
+        self.assertFalse(await MessageReaction.objects.filter(message_id=str(elsewhere.message_id)).aexists())
+
+    async def test_file_preview_follows_file_message(self):
+        ready = asyncio.Event()
+
+        async def wait(name):
+            await ready.wait()
+            return {'size': 3, 'thumbnail_url': '/media/t.jpg'}
+
+        alice = await self.connect(self.alice)
+        with mock.patch.object(preview_pipeline, 'name_for_url', return_value='cas/ab/a.png'), \
+                mock.patch.object(preview_pipeline, 'get', return_value=None), \
+                mock.patch.object(preview_pipeline, 'wait', wait):
+            await alice.send_json_to({'type': 'file_message', 'file_name': 'a.png', 'file_url': '/media/a.png'})
+            file_message, = of_type(await drain(alice), 'file_message')
+            self.assertTrue(file_message['preview_pending'])
+            self.assertEqual(len(rooms._preview_tasks), 1)
+            ready.set()
+            frames = await drain(alice)
+
+        self.assertEqual(of_type(frames, 'file_preview'), [{
+            'type': 'file_preview', 'size': 3, 'thumbnail_url': '/media/t.jpg', 'file_name': 'a.png',
+            'file_url': '/media/a.png', 'message_id': file_message['message_id']
+        }])
+        self.assertEqual(rooms._preview_tasks, set())
+        await alice.disconnect()
+
+    async def test_file_message_carries_a_ready_preview(self):
+        alice = await self.connect(self.alice)
+        with mock.patch.object(preview_pipeline, 'name_for_url', return_value='cas/ab/a.png'), \
+                mock.patch.object(preview_pipeline, 'get', return_value={'size': 3, 'thumbnail_url': None}):
+            await alice.send_json_to({'type': 'file_message', 'file_name': 'a.png', 'file_url': '/media/a.png'})
+            frames = await drain(alice)
+        file_message, = of_type(frames, 'file_message')
+        self.assertEqual((file_message['size'], file_message.get('preview_pending')), (3, None))
+        self.assertEqual(of_type(frames, 'file_preview'), [])
+        await alice.disconnect()
+
+    @mock.patch('myapp.rooms.MAX_RESYNC_PAGES', 2)
+    @mock.patch('myapp.rooms.MAX_PAGE_SIZE', 5)
+    async def test_resync_is_capped(self):
+        now = timezone.now()
+        messages = await Message.objects.abulk_create(
+            [Message(author=self.alice, room='general', content=f'm{i}', timestamp=now + timedelta(seconds=i))
+             for i in range(12)])
+
+        async def reconnect(last_seen):
+            communicator = WebsocketCommunicator(
+                application, f'/ws/chat/?last_seen={last_seen.message_id}', headers=self.headers[self.bob])
+            await communicator.connect()
+            frames = await drain(communicator)
+            await communicator.disconnect()
+            return frames
+
+        frames = await reconnect(messages[1])
+        self.assertEqual([frame['done'] for frame in of_type(frames, 'resync')], [False, True])
+        self.assertEqual(of_type(frames, 'fetch_messages'), [])
+        # One message more than two pages behind: the latest page instead.
+        frames = await reconnect(messages[0])
+        self.assertEqual([frame['type'] for frame in frames if frame['type'] != 'chat_message'],
+                         ['resync_gap', 'fetch_messages'])
+
+    async def test_history_on_connect_has_ids(self):
+        alice = await self.connect(self.alice)
+        for i in range(history_cache.depth):
+            await alice.send_json_to({'type': 'chat_message', 'message': f'm{i}', 'time': ''})
+        await drain(alice)
+        await alice.disconnect()
+
+        bob = WebsocketCommunicator(application, '/ws/chat/', headers=self.headers[self.bob])
+        await bob.connect()
+        history = [frame for frame in await drain(bob) if 'messages' in frame][0]
+        self.assertTrue(all(message['id'] for message in history['messages']))
+        oldest = history['messages'][-1]
+        self.assertEqual(decode_cursor(history['next_cursor'])[1], oldest['id'])
+        await bob.disconnect()
+
+
+class IdentityTests(IsolatedMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(User.objects.create(username='alice'))
+        self.session_key = self.client.session.session_key
+        self.headers = [(b'cookie', f'sessionid={self.session_key}'.encode())]
+
+    async def test_reconnect_reuses_the_session_user(self):
+        for _ in range(2):
+            communicator = WebsocketCommunicator(application, '/ws/chat/', headers=self.headers)
+            self.assertTrue((await communicator.connect())[0])
+            await drain(communicator)
+            await communicator.disconnect()
+        self.assertEqual((session_users.misses, session_users.hits), (1, 1))
+        self.assertEqual(session_users.get(self.session_key).username, 'alice')
+
+    def test_logout_forgets_the_session(self):
+        user = User.objects.get(username='alice')
+        session_users.put(self.session_key, user)
+        self.client.get('/auth/logout')
+        self.assertIsNone(session_users.get(self.session_key))
+
+    async def test_anonymous_user_is_rejected(self):
+        communicator = WebsocketCommunicator(application, '/ws/chat/')
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertEqual(presence.members('chat-general'), set())
+
+
+class _SlowSocket:
+    """Stands in for the server: send() waits until the client is ready."""
+
+    def __init__(self):
+        self.ready = asyncio.Event()
+        self.sent = []
+        self.close_code = None
+
+    async def send(self, text_data=None, bytes_data=None):
+        await self.ready.wait()
+        self.sent.append(text_data)
+
+    async def close(self, code=None, reason=None):
+        self.close_code = code
+
+
+class _QueuedSocket(outbound.OutboundQueueMixin, _SlowSocket):
+    pass
+
+
+@mock.patch.dict(outbound._config, MAX_FRAMES=4, HIGH_WATER=2, EVICT_AFTER=60)
+class OutboundQueueTests(SimpleTestCase):
+    async def test_drops_droppable_frames_then_evicts(self):
+        socket = _QueuedSocket()
+        await socket.send('first')
+        await asyncio.sleep(0)
+        # The writer now waits on 'first'; the rest queue up.
+        await socket.send('typing', droppable=True)
+        for text in ('a', 'b', 'c'):
+            await socket.send(text)
+        await socket.send('d')
+        self.assertEqual([frame['text_data'] for frame, _ in socket.outbound], ['a', 'b', 'c', 'd'])
+        await socket.send('typing', droppable=True)
+        self.assertEqual(socket.outbound_dropped, 2)
+        self.assertFalse(socket.outbound_evicted)
+
+        # Full of frames that can't be dropped.
+        await socket.send('e')
+        self.assertTrue(socket.outbound_evicted)
+        socket.ready.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(socket.sent, ['first'])
+        self.assertEqual(socket.close_code, outbound.EVICTED_CLOSE_CODE)
+
+    async def test_evicts_after_staying_over_high_water(self):
+        socket = _QueuedSocket()
+        await socket.send('first')
+        await asyncio.sleep(0)
+        for text in ('a', 'b', 'c'):
+            await socket.send(text)
+        self.assertIsNotNone(socket._over_since)
+        socket._over_since -= outbound._config['EVICT_AFTER'] + 1
+        await socket.send('d')
+        self.assertTrue(socket.outbound_evicted)
+        socket.ready.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(socket.close_code, outbound.EVICTED_CLOSE_CODE)
+
+    def test_reactions_are_not_droppable(self):
+        # Reaction frames carry deltas; dropping one corrupts the counts.
+        self.assertNotIn('reaction', DROPPABLE_TYPES)
+
+
+SHARDS = {'a': 'ws://chat-a', 'b': 'ws://chat-b', 'c': 'ws://chat-c'}
+
+
+class ShardRouterTests(SimpleTestCase):
+    def test_adding_a_shard_moves_only_some_rooms(self):
+        rooms = [f'room{i}' for i in range(300)]
+        two = ShardRouter({'a': 'ws://chat-a', 'b': 'ws://chat-b'}, {}, None, 64)
+        three = ShardRouter(SHARDS, {}, None, 64)
+        moved = [room for room in rooms if two.shard_for(room) != three.shard_for(room)]
+        # Only to the new shard, and roughly its share.
+        self.assertEqual({three.shard_for(room) for room in moved}, {'c'})
+        self.assertLess(len(moved), len(rooms) / 2)
+        self.assertEqual(len({three.shard_for(room) for room in rooms}), 3)
+
+    def test_pinned_rooms_get_a_dedicated_shard(self):
+        router = ShardRouter(SHARDS, {'hot': 'c'}, 'c', 64)
+        self.assertEqual(router.shard_for('hot'), 'c')
+        self.assertTrue(router.is_local('hot'))
+        self.assertNotIn('c', {router.shard_for(f'room{i}') for i in range(100)})
+        self.assertEqual(router.socket_url('hot'), 'ws://chat-c')
+
+    def test_unsharded_serves_everything(self):
+        router = ShardRouter({}, {}, None, 64)
+        self.assertTrue(router.is_local('any'))
+        self.assertIsNone(router.socket_url('any'))
+
+    def test_unknown_shards_are_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            ShardRouter(SHARDS, {'hot': 'z'}, None, 64)
+        with self.assertRaises(ImproperlyConfigured):
+            ShardRouter(SHARDS, {}, 'z', 64)
+
+
+class ShardRedirectTests(IsolatedMixin, TransactionTestCase):
+    async def test_room_on_another_shard_is_redirected(self):
+        router = ShardRouter(SHARDS, {'elsewhere': 'b'}, 'a', 64)
+        headers = await sync_to_async(session_headers)(await User.objects.acreate(username='alice'))
+        with mock.patch('myapp.consumer.shard_router', router):
+            communicator = WebsocketCommunicator(application, '/ws/chat/elsewhere/', headers=headers)
+            self.assertTrue((await communicator.connect())[0])
+            self.assertEqual(await communicator.receive_json_from(), {'type': 'redirect', 'url': 'ws://chat-b'})
+            self.assertEqual((await communicator.receive_output())['code'], 4001)
+        self.assertEqual(router.rejected, 1)
+        self.assertEqual(presence.occupancy('chat-elsewhere'), 0)
+
+
+class ProfilingViewTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create(username='admin', is_staff=True))
+        slow_log = profiling.slow_log
+        self.addCleanup(setattr, slow_log, 'enabled', slow_log.enabled)
+        self.addCleanup(setattr, slow_log, 'threshold_ms', slow_log.threshold_ms)
+        self.addCleanup(profiling.profiler.stop)
+
+    def test_staff_only(self):
+        self.client.force_login(User.objects.create(username='alice'))
+        self.assertEqual(self.client.get('/profiling/').status_code, 403)
+
+    def test_slow_log_flag_parses_strings(self):
+        for value, enabled in (('false', False), ('1', True), ('off', False), ('true', True)):
+            response = self.client.post('/profiling/', {'slow_log': value})
+            self.assertEqual(response.json()['slow_log']['enabled'], enabled)
+        response = self.client.post('/profiling/', {'slow_log': False}, content_type='application/json')
+        self.assertFalse(response.json()['slow_log']['enabled'])
+        self.assertEqual(self.client.post('/profiling/', {'slow_log': 'maybe'}).status_code, 400)
+        self.assertEqual(self.client.post('/profiling/', {'threshold_ms': '-1'}).status_code, 400)
+
+    def test_clear_slow_log(self):
+        profiling.slow_log.entries.append({'event': 'x'})
+        self.client.post('/profiling/', {'clear_slow_log': 'false', 'threshold_ms': '250'})
+        self.assertEqual(len(profiling.slow_log.entries), 1)
+        self.assertEqual(profiling.slow_log.threshold_ms, 250)
+        self.client.post('/profiling/', {'clear_slow_log': 'true'})
+        self.assertEqual(len(profiling.slow_log.entries), 0)
+
+    def test_profile_and_download(self):
+        response = self.client.post('/profiling/', {'profiler': 'start', 'interval': '0.001', 'seconds': '5'})
+        self.assertTrue(response.json()['profiler']['running'])
+        self.assertEqual(self.client.post('/profiling/', {'profiler': 'start'}).status_code, 409)
+        time.sleep(0.05)
+        response = self.client.post('/profiling/', {'profiler': 'stop'})
+        self.assertFalse(response.json()['profiler']['running'])
+        self.assertGreater(response.json()['profiler']['samples'], 0)
+
+        response = self.client.get('/profiling/', {'folded': '1'})
+        self.assertEqual(response['Content-Type'], 'text/plain; charset=utf-8')
+        line = response.content.decode().splitlines()[0]
+        stack, count = line.rsplit(' ', 1)
+        self.assertIn(';', stack)
+        self.assertGreater(int(count), 0)
+
+
+class MetricsTests(TestCase):
+    def scrape(self, **headers):
+        response = self.client.get('/metrics/', **headers)
+        self.assertEqual(response.status_code, 200)
+        return dict(line.rsplit(' ', 1) for line in response.content.decode().splitlines()
+                    if not line.startswith('#'))
+
+    def test_staff_or_token_only(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 403)
+        with mock.patch.dict(metrics.config, TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.scrape(HTTP_AUTHORIZATION='Bearer secret')
+        self.client.force_login(User.objects.create(username='admin', is_staff=True))
+        self.scrape()
+
+    def test_render(self):
+        self.client.force_login(User.objects.create(username='admin', is_staff=True))
+        pong = 'chat_frames_received_total{type="pong"}'
+        bucket = 'chat_receive_seconds_bucket{{type="pong",le="{}"}}'
+        before = self.scrape()
+        metrics.frames_received.labels('pong').inc(2)
+        metrics.receive_seconds.labels('pong').observe(0.003)
+        samples = self.scrape()
+
+        def added(name):
+            return float(samples[name]) - float(before[name])
+
+        self.assertEqual(added(pong), 2)
+        # Buckets are cumulative: 3ms lands in le=0.005 and every bucket above it.
+        self.assertEqual([added(bucket.format(bound)) for bound in ('0.0025', '0.005', '10', '+Inf')],
+                         [0, 1, 1, 1])
+        self.assertEqual(samples[bucket.format('+Inf')], samples['chat_receive_seconds_count{type="pong"}'])
+        # Counted by the middleware on the first scrape.
+        self.assertGreaterEqual(float(samples['chat_http_requests_total{view="metrics",status="200"}']), 1)
+        self.assertIn('chat_stats_persistence_pending', samples)
+
+
+class HeartbeatTests(IsolatedMixin, TransactionTestCase):
+    async def test_quiet_connections_are_pinged_then_reaped(self):
+        headers = await sync_to_async(session_headers)(await User.objects.acreate(username='alice'))
+        before = set(heartbeat._connections)
+        communicator = WebsocketCommunicator(application, '/ws/chat/', headers=headers)
+        await communicator.connect()
+        await drain(communicator)
+        [consumer] = set(heartbeat._connections) - before
+        reaper = heartbeat.reaper
+        pings, pongs, reaped = reaper.pings, reaper.pongs, reaper.reaped
+
+        consumer.heard_at -= reaper.interval
+        await reaper.sweep()
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'ping'})
+        await communicator.send_json_to({'type': 'pong'})
+        await drain(communicator, 0.1)
+        self.assertEqual((reaper.pings - pings, reaper.pongs - pongs), (1, 1))
+        self.assertLess(time.monotonic() - consumer.heard_at, reaper.interval)
+
+        consumer.heard_at -= reaper.idle_timeout
+        await reaper.sweep()
+        self.assertEqual(reaper.reaped - reaped, 1)
+        # disconnect() has run: out of presence, and closed.
+        self.assertEqual(presence.occupancy('chat-general'), 0)
+        self.assertEqual((await communicator.receive_output())['code'], heartbeat.IDLE_CLOSE_CODE)
+        self.assertNotIn(consumer, heartbeat._connections)
+
+
+async def _fallback(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 299, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+class MediaTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        self.app = MediaApplication(_fallback, root=self.root, url='/media/')
+        self.name = f'cas/aa/{"a" * 64}.txt'
+        self.body = b'0123456789' * 100
+        for name, body in ((self.name, self.body), ('uploads/partial/x.part', b'secret')):
+            os.makedirs(os.path.dirname(os.path.join(self.root, name)), exist_ok=True)
+            with open(os.path.join(self.root, name), 'wb') as file:
+                file.write(body)
+
+    async def get(self, path, **headers):
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': path,
+            'headers': [(key.replace('_', '-').encode(), value.encode()) for key, value in headers.items()],
+        }
+        await self.app(scope, None, send)
+        response_headers = dict(messages[0]['headers'])
+        return messages[0]['status'], response_headers, b''.join(message.get('body', b'') for message in messages[1:])
+
+    async def test_whole_file_and_ranges(self):
+        url = f'/media/{self.name}'
+        status, headers, body = await self.get(url)
+        self.assertEqual((status, body), (200, self.body))
+        self.assertIn(b'immutable', headers[b'cache-control'])
+
+        status, headers, body = await self.get(url, range='bytes=5-9')
+        self.assertEqual((status, body, headers[b'content-range']), (206, b'56789', b'bytes 5-9/1000'))
+        status, _, body = await self.get(url, range='bytes=-3')
+        self.assertEqual((status, body), (206, b'789'))
+        status, headers, _ = await self.get(url, range='bytes=1000-')
+        self.assertEqual((status, headers[b'content-range']), (416, b'bytes */1000'))
+
+    async def test_revalidation(self):
+        url = f'/media/{self.name}'
+        _, headers, _ = await self.get(url)
+        status, _, body = await self.get(url, if_none_match=headers[b'etag'].decode())
+        self.assertEqual((status, body), (304, b''))
+        status, _, _ = await self.get(url, if_modified_since=headers[b'last-modified'].decode())
+        self.assertEqual(status, 304)
+        status, _, _ = await self.get(url, range='bytes=0-1', if_range='"stale"')
+        self.assertEqual(status, 200)
+
+    async def test_private_and_outside_paths_are_not_served(self):
+        for path in ('/media/uploads/partial/x.part', '/media/./uploads/partial/x.part',
+                     '/media/cas/../uploads/partial/x.part', '/media/uploads//partial/x.part',
+                     '/media/../etc/passwd', '/media/cas/aa/missing.txt'):
+            status, _, body = await self.get(path)
+            self.assertEqual(status, 404, path)
+            self.assertNotEqual(body, b'secret')
+        self.assertEqual((await self.get('/elsewhere/'))[0], 299)
+
+
+class ChunkedUploadTests(IsolatedMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='alice')
+        self.client.force_login(self.user)
+        self.data = os.urandom(250000)
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+
+    def start(self, **fields):
+        response = self.client.post('/upload/chunked/', dict({'filename': 'photo.jpg', 'size': len(self.data)}, **fields),
+                                    content_type='application/json')
+        return response
+
+    def put(self, upload_id, offset, data):
+        return self.client.put(f'/upload/chunked/{upload_id}/', data, content_type='application/octet-stream',
+                               headers={'Upload-Offset': str(offset)})
+
+    def test_offsets_resume_and_complete(self):
+        upload_id = self.start(sha256=self.sha256).json()['upload_id']
+        self.assertEqual(self.put(upload_id, 0, self.data[:100000]).json()['offset'], 100000)
+        # A retried chunk is refused with the offset to resume from.
+        response = self.put(upload_id, 0, self.data[:100000])
+        self.assertEqual((response.status_code, response.json()['offset']), (409, 100000))
+        self.assertEqual(self.put(upload_id, 100000, b'x' * 200000).status_code, 413)
+
+        # After a restart the running hash is rebuilt from disk.
+        uploads.hashers._hashers.clear()
+        self.assertEqual(self.client.get(f'/upload/chunked/{upload_id}/').json()['offset'], 100000)
+        self.put(upload_id, 100000, self.data[100000:200000])
+        response = self.put(upload_id, 200000, self.data[200000:]).json()
+        self.assertTrue(response['complete'])
+        self.assertEqual(response['file_url'], f'/media/cas/{self.sha256[:2]}/{self.sha256}.jpg')
+        with open(uploads.storage.path(f'cas/{self.sha256[:2]}/{self.sha256}.jpg'), 'rb') as file:
+            self.assertEqual(file.read(), self.data)
+        self.assertFalse(os.path.exists(uploads.partial_path(upload_id)))
+
+    def test_known_content_is_not_uploaded_again(self):
+        upload_id = self.start(sha256=self.sha256).json()['upload_id']
+        self.put(upload_id, 0, self.data)
+        response = self.start(filename='again.jpeg', sha256=self.sha256)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'complete': True, 'file_url': f'/media/cas/{self.sha256[:2]}/{self.sha256}.jpg'})
+
+    def test_checksum_mismatch_discards_the_upload(self):
+        upload_id = self.start(sha256='0' * 64).json()['upload_id']
+        self.assertEqual(self.put(upload_id, 0, self.data).status_code, 400)
+        self.assertFalse(ChunkedUpload.objects.exists())
+        self.assertFalse(os.path.exists(uploads.partial_path(upload_id)))
+
+    def test_clean_uploads_removes_abandoned_partials(self):
+        stale = self.start().json()['upload_id']
+        fresh = self.start().json()['upload_id']
+        self.put(stale, 0, self.data[:1000])
+        day_ago = time.time() - 25 * 3600
+        os.utime(uploads.partial_path(stale), (day_ago, day_ago))
+
+        call_command('clean_uploads', stdout=open(os.devnull, 'w'))
+        self.assertEqual([str(pk) for pk in ChunkedUpload.objects.values_list('pk', flat=True)], [fresh])
+        self.assertFalse(os.path.exists(uploads.partial_path(stale)))
+        self.assertEqual(self.put(stale, 1000, b'x').status_code, 404)
+
+
+class ArchiveTests(IsolatedMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='alice')
+        now = timezone.now()
+        Message.objects.bulk_create([
+            Message(author=self.user, room='r', content=f'm{i}', timestamp=now - timedelta(days=200 - i))
+            for i in range(120)
+        ])
+        self.expected = list(Message.objects.filter(room='r').order_by('-timestamp', '-id')
+                             .values_list('pk', 'content'))
+
+    def test_round_trip(self):
+        cutoff = timezone.now() - timedelta(days=100)
+        old = Message.objects.filter(timestamp__lt=cutoff).count()
+        self.assertEqual(archive.archive_messages(cutoff), old)
+        self.assertEqual(Message.objects.count(), 120 - old)
+
+        seen, cursor = [], None
+        while True:
+            rows, cursor = Message.history_page('r', cursor, 25)
+            seen += [(row.pk, row.to_json()['message']) for row in rows]
+            if cursor is None:
+                break
+        self.assertEqual(seen, self.expected)
+        self.assertEqual(archive.verify(), [])
+
+    def test_verify_finds_corruption(self):
+        archive.archive_messages(timezone.now())
+        paths = archive.list_segments(archive.message_archive.room_directory(archive.PUBLIC, 'r'))
+        self.assertTrue(paths)
+        archive.message_archive._segments.clear()
+        with open(paths[0], 'r+b') as segment:
+            segment.seek(40)
+            byte = segment.read(1)
+            segment.seek(40)
+            segment.write(bytes([byte[0] ^ 0xFF]))
+        self.assertTrue(archive.verify())
+
+
+class SearchTests(IsolatedMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        Message.objects.create(author=self.alice, room='one', content='the harbour at dawn')
+        Message.objects.create(author=self.bob, room='one', content='harbour lights')
+        Message.objects.create(author=self.alice, room='two', content='harbour again')
+        self.room = PrivateChatRoom.objects.create(name='private_chat_x')
+        PrivateMessage.objects.create(author=self.alice, room=self.room, content='secret harbour')
+        self.client.force_login(self.bob)
+
+    def search(self, **params):
+        return self.client.get('/search/', params)
+
+    def test_public_scopes(self):
+        results = self.search(q='harbour').json()['results']
+        self.assertEqual(len(results), 3)
+        self.assertNotIn('secret harbour', [result['message'] for result in results])
+        self.assertEqual({result['room'] for result in self.search(q='harbour', chatroom='one').json()['results']},
+                         {'one'})
+        self.assertEqual([result['message'] for result in self.search(q='harbour', author='bob').json()['results']],
+                         ['harbour lights'])
+        self.assertEqual(len(self.search(q='harb').json()['results']), 3)
+
+    def test_private_room_needs_membership(self):
+        self.assertEqual(self.search(q='harbour', room=self.room.name).status_code, 403)
+        self.client.force_login(self.alice)
+        results = self.search(q='harbour', room=self.room.name).json()['results']
+        self.assertEqual([result['message'] for result in results], ['secret harbour'])
+
+    def test_paging(self):
+        first = self.search(q='harbour', limit=2).json()
+        self.assertEqual(len(first['results']), 2)
+        rest = self.search(q='harbour', limit=2, cursor=first['next_cursor']).json()
+        self.assertIsNone(rest['next_cursor'])
+        self.assertEqual(len({result['message_id'] for result in first['results'] + rest['results']}), 3)
+        self.assertEqual(self.search(q='harbour', cursor='bogus').status_code, 400)
@@ -0,0 +1,114 @@
+import asyncio
+import time
+import uuid
+
+from channels.layers import get_channel_layer
+
+from . import stats
+from .broadcast import encode_event
+from .conf import chat_setting
+
+DEFAULTS = {
+    # Seconds between aggregated "who is typing" updates per room.
+    'TICK': 0.5,
+    # A user who stops sending `typing` without a `stop_typing` drops out
+    # of the list after this many seconds.
+    'TTL': 5.0,
+}
+
+# Each worker process only sees its own connections, so updates are tagged
+# with their source and clients show the union across sources.
+SOURCE = uuid.uuid4().hex
+
+
+class TypingCoalescer:
+    """
+    Per-room typing state, broadcast as one update per room per tick.
+
+    Repeated `typing` frames only refresh a deadline, and a typing/stop
+    flap inside one tick produces nothing at all: a room is broadcast only
+    when its set of typers differs from what was last announced.
+    """
+
+    def __init__(self, tick, ttl):
+        self.tick = tick
+        self.ttl = ttl
+        self.frames = 0
+        self.suppressed = 0
+        self.updates = 0
+        # group -> {username: expires_at}
+        self._typing = {}
+        # group -> tuple of usernames last broadcast
+        self._announced = {}
+        self._task = None
+
+    def typing(self, group, username):
+        self.frames += 1
+        room = self._typing.setdefault(group, {})
+        if username in room:
+            self.suppressed += 1
+        room[username] = time.monotonic() + self.ttl
+        self._ensure_running()
+
+    def stop_typing(self, group, username):
+        self.frames += 1
+        room = self._typing.get(group)
+        if not room or room.pop(username, None) is None:
+            self.suppressed += 1
+            return
+        self._ensure_running()
+
+    def leave(self, group, username):
+        # A disconnect; not a client frame, so it isn't counted.
+        room = self._typing.get(group)
+        if room and room.pop(username, None) is not None:
+            self._ensure_running()
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'suppressed': self.suppressed,
+            'updates': self.updates,
+            'rooms': len(self._typing),
+        }
+
+    def _ensure_running(self):
+        if (self._task is None or self._task.done()
+                or self._task.get_loop() is not asyncio.get_running_loop()):
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        channel_layer = get_channel_layer()
+        while self._typing or self._announced:
+            await asyncio.sleep(self.tick)
+            now = time.monotonic()
+            for group in set(self._typing) | set(self._announced):
+                room = self._typing.get(group, {})
+                for username, expires_at in list(room.items()):
+                    if expires_at < now:
+                        del room[username]
+                if not room:
+                    self._typing.pop(group, None)
+
+                users = tuple(sorted(room))
+                if users == self._announced.get(group, ()):
+                    continue
+                if users:
+                    self._announced[group] = users
+                else:
+                    self._announced.pop(group, None)
+                self.updates += 1
+                await channel_layer.group_send(group, encode_event({
+                    'type': 'typing',
+                    'users': list(users),
+                    'source': SOURCE
+                }))
+
+
+def _build_coalescer():
+    config = chat_setting('CHAT_TYPING', DEFAULTS)
+    return TypingCoalescer(tick=config['TICK'], ttl=config['TTL'])
+
+
+typing_coalescer = _build_coalescer()
+stats.register('typing', typing_coalescer.stats)
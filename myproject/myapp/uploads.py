@@ -0,0 +1,192 @@
+import fcntl
+import hashlib
+import os
+import re
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from django.core.files.storage import FileSystemStorage
+
+from .conf import chat_setting
+
+DEFAULTS = {
+    # Largest body accepted for one PUT of a chunked upload.
+    'MAX_CHUNK_SIZE': 8 * 1024 * 1024,
+    'MAX_FILE_SIZE': 100 * 1024 * 1024,
+    # Unfinished uploads with no chunk received for this long are removed
+    # by `manage.py clean_uploads`.
+    'ABANDONED_AFTER_HOURS': 24,
+}
+
+CAS_DIR = 'cas'
+PARTIAL_DIR = 'uploads/partial'
+READ_SIZE = 64 * 1024
+
+_EXTENSION = re.compile(r'^\.[a-z0-9]{1,10}$')
+_ALIASES = {'.jpeg': '.jpg'}
+
+config = chat_setting('CHAT_UPLOADS', DEFAULTS)
+storage = FileSystemStorage()
+
+
+def cas_name(sha256, filename):
+    """
+    Storage name for content with digest `sha256`: cas/ab/<sha256><ext>.
+    The extension is kept so URLs still say what the file is.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    extension = _ALIASES.get(extension, extension)
+    if not _EXTENSION.match(extension):
+        extension = ''
+    return f'{CAS_DIR}/{sha256[:2]}/{sha256}{extension}'
+
+
+def cas_url(name):
+    return storage.url(name)
+
+
+def cas_exists(name):
+    return storage.exists(name)
+
+
+def cas_commit(path, name):
+    """Move the finished file at `path` into the store as `name`."""
+    target = storage.path(name)
+    if os.path.exists(target):
+        # Same content is already there.
+        os.remove(path)
+        return
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(path, target)
+
+
+def store_file(uploaded_file):
+    """Store an UploadedFile by content; returns its storage name."""
+    hasher = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        hasher.update(chunk)
+    name = cas_name(hasher.hexdigest(), uploaded_file.name)
+    if cas_exists(name):
+        return name
+
+    directory = storage.path(CAS_DIR)
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as out:
+        for chunk in uploaded_file.chunks():
+            out.write(chunk)
+    cas_commit(path, name)
+    return name
+
+
+def partial_path(upload_id):
+    return storage.path(f'{PARTIAL_DIR}/{upload_id}.part')
+
+
+def open_partial(upload_id, blocking=True):
+    """
+    Open an upload's partial file for writing and take an exclusive lock
+    on it, held until the file is closed. This is what serializes PUTs
+    for one upload, across worker processes too. Returns None if the file
+    is gone, or (when not blocking) if someone else holds the lock.
+    """
+    try:
+        partial = open(partial_path(upload_id), 'r+b')
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(partial, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        partial.close()
+        return None
+    return partial
+
+
+def clean_partials(max_age):
+    """
+    Delete unfinished uploads that have not received a chunk for `max_age`
+    seconds: their partial file and their ChunkedUpload row. Partial files
+    without a row are removed too. Returns how many files were removed.
+    """
+    from .models import ChunkedUpload
+
+    directory = storage.path(PARTIAL_DIR)
+    cutoff = time.time() - max_age
+    removed = 0
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        stem, extension = os.path.splitext(name)
+        if extension != '.part':
+            continue
+        try:
+            upload_id = uuid.UUID(stem)
+        except ValueError:
+            continue
+        try:
+            if os.path.getmtime(os.path.join(directory, name)) >= cutoff:
+                continue
+        except FileNotFoundError:
+            continue
+        # Skip uploads a PUT is writing to right now.
+        partial = open_partial(upload_id, blocking=False)
+        if partial is None:
+            continue
+        with partial:
+            ChunkedUpload.objects.filter(pk=upload_id, file='').delete()
+            os.remove(partial.name)
+        hashers.discard(upload_id)
+        removed += 1
+
+    # Rows whose partial file is already gone.
+    cutoff_date = datetime.fromtimestamp(cutoff, tz=timezone.utc)
+    for upload_id in ChunkedUpload.objects.filter(file='', created_at__lt=cutoff_date).values_list('pk', flat=True):
+        if not os.path.exists(partial_path(upload_id)):
+            ChunkedUpload.objects.filter(pk=upload_id, file='').delete()
+    return removed
+
+
+class HasherCache:
+    """
+    Running sha256 of in-progress uploads, so each chunk is hashed once.
+
+    hashlib state can't be stored in the database; after a restart (or an
+    eviction) the hash is rebuilt once from the bytes already on disk.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._hashers = OrderedDict()
+
+    def get(self, upload_id, offset):
+        entry = self._hashers.pop(upload_id, None)
+        if entry is not None and entry[0] == offset:
+            return entry[1]
+
+        hasher = hashlib.sha256()
+        remaining = offset
+        with open(partial_path(upload_id), 'rb') as partial:
+            while remaining:
+                data = partial.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                hasher.update(data)
+                remaining -= len(data)
+        return hasher
+
+    def put(self, upload_id, offset, hasher):
+        self._hashers[upload_id] = (offset, hasher)
+        self._hashers.move_to_end(upload_id)
+        while len(self._hashers) > self.max_entries:
+            self._hashers.popitem(last=False)
+
+    def discard(self, upload_id):
+        self._hashers.pop(upload_id, None)
+
+
+hashers = HasherCache()
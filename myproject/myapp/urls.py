@@ -8,7 +8,15 @@ urlpatterns = [
     path('auth/logout', views.logout_view, name='logout'),
     path('choice/', views.choice, name='choice'),
     path('chatroom/', views.chatroom, name='chatroom'),
+    path('chatroom/<slug:room_name>/', views.chatroom, name='chatroom_room'),
     path('private-chat/', views.private_chat, name='private_chat'),
-    path('upload/', views.FileUploadView.as_view(), name='file-upload')
+    path('upload/', views.FileUploadView.as_view(), name='file-upload'),
+    path('upload/chunked/', views.ChunkedUploadView.as_view(), name='chunked-upload'),
+    path('upload/chunked/<uuid:upload_id>/', views.ChunkedUploadDetailView.as_view(), name='chunked-upload-detail'),
+    path('history/', views.MessageHistoryView.as_view(), name='message-history'),
+    path('search/', views.MessageSearchView.as_view(), name='message-search'),
+    path('stats/', views.StatsView.as_view(), name='stats'),
+    path('metrics/', views.metrics_view, name='metrics'),
+    path('profiling/', views.ProfilingView.as_view(), name='profiling')
     
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
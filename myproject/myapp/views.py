@@ -1,15 +1,28 @@
+import hmac
+import os
+import re
+from django.http import HttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.middleware.csrf import get_token
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import logout, login as auth_login, authenticate
-from django.core.files.storage import FileSystemStorage
 from .forms import CustomUserCreationForm
-from .models import PrivateChatRoom
+from .identity import session_users
+from .models import DEFAULT_ROOM, ChunkedUpload, PrivateChatRoom, Message, PrivateMessage
+from .pagination import clamp_page_size
+from .previews import preview_pipeline
+from .sharding import shard_router
+from . import uploads
+from . import metrics
+from . import profiling
+from . import search
+from . import stats
 
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 
 class FileUploadView(APIView):
     parser_classes = (MultiPartParser, FormParser)
@@ -17,14 +30,294 @@ class FileUploadView(APIView):
     def post(self, request, *args, **kwargs):
         file = request.FILES.get('file')
         if file:
-            fs = FileSystemStorage()
-            filename = fs.save(file.name, file)
-            file_url = fs.url(filename)
+            name = uploads.store_file(file)
+            preview_pipeline.submit(name)
+            file_url = uploads.cas_url(name)
             return Response({'file_url': file_url, 'csrf_token': get_token(request)})
         else:
             return Response({'error': 'No file found'}, status=400)
 
 
+SHA256 = re.compile(r'^[0-9a-f]{64}$')
+
+
+class ChunkedUploadView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        filename = request.data.get('filename')
+        sha256 = str(request.data.get('sha256') or '').lower()
+        try:
+            size = int(request.data.get('size'))
+        except (TypeError, ValueError):
+            return Response({'error': 'Invalid size'}, status=400)
+
+        if not isinstance(filename, str) or not 0 < len(filename) <= 255:
+            return Response({'error': 'Invalid filename'}, status=400)
+        if not 0 < size <= uploads.config['MAX_FILE_SIZE']:
+            return Response({'error': 'Invalid size'}, status=400)
+        if sha256 and not SHA256.match(sha256):
+            return Response({'error': 'Invalid sha256'}, status=400)
+
+        if sha256:
+            name = uploads.cas_name(sha256, filename)
+            if uploads.cas_exists(name):
+                # Already stored: nothing to send.
+                preview_pipeline.submit(name)
+                return Response({'complete': True, 'file_url': uploads.cas_url(name)})
+
+        upload = ChunkedUpload.objects.create(user=request.user, filename=filename, size=size, sha256=sha256)
+        path = uploads.partial_path(upload.pk)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'wb').close()
+
+        content = upload.to_json()
+        content['chunk_size'] = uploads.config['MAX_CHUNK_SIZE']
+        return Response(content, status=201)
+
+
+class ChunkedUploadDetailView(APIView):
+    permission_classes = (IsAuthenticated,)
+    # PUT bodies are raw bytes, read from the stream in put().
+    parser_classes = ()
+
+    def get(self, request, upload_id, *args, **kwargs):
+        upload = get_object_or_404(ChunkedUpload, pk=upload_id, user=request.user)
+        return Response(upload.to_json())
+
+    def put(self, request, upload_id, *args, **kwargs):
+        upload = get_object_or_404(ChunkedUpload, pk=upload_id, user=request.user)
+        if upload.file:
+            return Response(upload.to_json())
+
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            length = int(request.headers.get('Content-Length') or 0)
+        except (KeyError, ValueError):
+            return Response({'error': 'Upload-Offset header required'}, status=400)
+
+        partial = uploads.open_partial(upload.pk)
+        if partial is None:
+            return Response({'error': 'Upload expired'}, status=404)
+        with partial:
+            # A retried or concurrent PUT may have moved the upload on (or
+            # finished it) while this one waited for the lock.
+            try:
+                upload.refresh_from_db()
+            except ChunkedUpload.DoesNotExist:
+                return Response({'error': 'Upload expired'}, status=404)
+            return self.write_chunk(request, upload, partial, offset, length)
+
+    def write_chunk(self, request, upload, partial, offset, length):
+        if upload.file:
+            return Response(upload.to_json())
+        if offset != upload.offset:
+            return Response({'error': 'Offset mismatch', 'offset': upload.offset}, status=409)
+        if length > uploads.config['MAX_CHUNK_SIZE'] or offset + length > upload.size:
+            return Response({'error': 'Chunk too large', 'offset': upload.offset}, status=413)
+
+        path = partial.name
+        hasher = uploads.hashers.get(upload.pk, offset)
+        remaining = length
+        # Drop anything past the last acknowledged offset.
+        partial.seek(offset)
+        partial.truncate()
+        while remaining and request.stream is not None:
+            data = request.stream.read(min(uploads.READ_SIZE, remaining))
+            if not data:
+                break
+            partial.write(data)
+            hasher.update(data)
+            remaining -= len(data)
+        if remaining:
+            partial.truncate(offset)
+            uploads.hashers.discard(upload.pk)
+            return Response({'error': 'Incomplete chunk', 'offset': upload.offset}, status=400)
+        partial.flush()
+
+        upload.offset = offset + length
+        if upload.offset < upload.size:
+            uploads.hashers.put(upload.pk, upload.offset, hasher)
+            upload.save(update_fields=['offset'])
+            return Response(upload.to_json())
+
+        digest = hasher.hexdigest()
+        uploads.hashers.discard(upload.pk)
+        if upload.sha256 and upload.sha256 != digest:
+            os.remove(path)
+            upload.delete()
+            return Response({'error': 'Checksum mismatch'}, status=400)
+
+        name = uploads.cas_name(digest, upload.filename)
+        uploads.cas_commit(path, name)
+        preview_pipeline.submit(name)
+        upload.sha256 = digest
+        upload.file = name
+        upload.save(update_fields=['offset', 'sha256', 'file'])
+        return Response(upload.to_json())
+
+
+class MessageHistoryView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        before = request.query_params.get('before')
+        limit = clamp_page_size(request.query_params.get('limit'))
+        room_name = request.query_params.get('room')
+
+        try:
+            if room_name:
+                room = get_object_or_404(PrivateChatRoom, name=room_name)
+                if not room.has_member(request.user):
+                    return Response({'error': 'Not a member of this room'}, status=403)
+                messages, next_cursor = PrivateMessage.history_page(room, before, limit)
+            else:
+                chatroom = request.query_params.get('chatroom', DEFAULT_ROOM)
+                messages, next_cursor = Message.history_page(chatroom, before, limit)
+        except ValueError:
+            return Response({'error': 'Invalid cursor'}, status=400)
+
+        return Response({
+            'messages': [message.to_json() for message in messages],
+            'next_cursor': next_cursor
+        })
+
+
+class MessageSearchView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        if not search.available():
+            return Response({'error': 'Search is not available'}, status=501)
+
+        query = request.query_params.get('q', '')
+        cursor = request.query_params.get('cursor')
+        limit = clamp_page_size(request.query_params.get('limit'))
+        room_name = request.query_params.get('room')
+        author_name = request.query_params.get('author')
+
+        scope = {}
+        if author_name:
+            author = User.objects.filter(username=author_name).only('id').first()
+            if author is None:
+                return Response({'results': [], 'next_cursor': None})
+            scope['author_id'] = author.id
+
+        try:
+            if room_name:
+                room = get_object_or_404(PrivateChatRoom, name=room_name)
+                if not room.has_member(request.user):
+                    return Response({'error': 'Not a member of this room'}, status=403)
+                scope['room_id'] = room.id
+                messages, next_cursor = search.search_page(
+                    search.private_message_index, PrivateMessage, query, scope, cursor, limit)
+                results = [message.to_json() for message in messages]
+            else:
+                chatroom = request.query_params.get('chatroom')
+                if chatroom:
+                    scope['room'] = chatroom
+                messages, next_cursor = search.search_page(
+                    search.message_index, Message, query, scope, cursor, limit)
+                results = [dict(message.to_json(), room=message.room) for message in messages]
+        except ValueError:
+            return Response({'error': 'Invalid cursor'}, status=400)
+
+        return Response({'results': results, 'next_cursor': next_cursor})
+
+
+class StatsView(APIView):
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        return Response(stats.snapshot())
+
+
+class ProfilingView(APIView):
+    """
+    Runtime control of this worker's profiler and slow-handler log.
+
+    GET returns their status, or the last profile in folded-stack form
+    with ?folded=1. POST takes any of: profiler ("start"/"stop"),
+    interval and seconds (for start), slow_log (true/false),
+    threshold_ms, clear_slow_log.
+    """
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        if request.query_params.get('folded'):
+            response = HttpResponse(profiling.profiler.folded(), content_type='text/plain; charset=utf-8')
+            response['Content-Disposition'] = 'attachment; filename="profile.folded"'
+            return response
+        return Response(self.status())
+
+    def post(self, request, *args, **kwargs):
+        data = request.data
+        try:
+            interval = self.positive(data, 'interval')
+            seconds = self.positive(data, 'seconds')
+            threshold_ms = self.positive(data, 'threshold_ms')
+            slow_log = self.flag(data, 'slow_log')
+            clear_slow_log = self.flag(data, 'clear_slow_log')
+        except ValueError as exc:
+            return Response({'error': str(exc)}, status=400)
+
+        action = data.get('profiler')
+        if action == 'start':
+            if not profiling.profiler.start(interval=interval, seconds=seconds):
+                return Response({'error': 'Profiler is already running'}, status=409)
+        elif action == 'stop':
+            profiling.profiler.stop()
+        elif action is not None:
+            return Response({'error': 'profiler must be "start" or "stop"'}, status=400)
+
+        if threshold_ms is not None:
+            profiling.slow_log.threshold_ms = threshold_ms
+        if slow_log is not None:
+            profiling.slow_log.enabled = slow_log
+        if clear_slow_log:
+            profiling.slow_log.entries.clear()
+        return Response(self.status())
+
+    @staticmethod
+    def positive(data, name):
+        value = data.get(name)
+        if value is None:
+            return None
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            value = 0
+        if not value > 0:
+            raise ValueError(f'{name} must be a positive number')
+        return value
+
+    @staticmethod
+    def flag(data, name):
+        # JSON sends booleans, forms send strings; "false" must not be truthy.
+        value = data.get(name)
+        if value is None or isinstance(value, bool):
+            return value
+        value = str(value).strip().lower()
+        if value in ('true', '1', 'yes', 'on'):
+            return True
+        if value in ('false', '0', 'no', 'off'):
+            return False
+        raise ValueError(f'{name} must be true or false')
+
+    @staticmethod
+    def status():
+        return {'profiler': profiling.profiler.status(), 'slow_log': profiling.slow_log.status()}
+
+
+def metrics_view(request):
+    token = metrics.config['TOKEN']
+    authorized = request.user.is_staff or bool(token and hmac.compare_digest(
+        request.headers.get('Authorization', ''), f'Bearer {token}'))
+    if not authorized:
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 
 def login(request):
     if request.method == 'POST':
@@ -39,6 +332,8 @@ def login(request):
     return render(request, 'login.html', {'form': form})
 
 def logout_view(request):
+    # Before logout(), which flushes the session and its key.
+    session_users.invalidate(request.session.session_key)
     logout(request)
     return redirect('login')
     
@@ -48,10 +343,14 @@ def choice(request):
         return redirect('login')
     return render(request, 'choice.html')
 
-def chatroom(request):
+def chatroom(request, room_name=DEFAULT_ROOM):
     if not request.user.is_authenticated:
         return redirect('login')
-    return render(request, 'chatroom.html')
+    return render(request, 'chatroom.html', {
+        'room_name': room_name,
+        # Rooms on another shard are served by that shard's workers.
+        'socket_base': shard_router.socket_url(room_name) or ''
+    })
 
 def private_chat(request):
     if not request.user.is_authenticated:
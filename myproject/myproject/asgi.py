@@ -1,8 +1,9 @@
 import os
 from channels.routing import ProtocolTypeRouter, URLRouter
 from myapp import routing
-from channels.auth import AuthMiddlewareStack
 from django.core.asgi import get_asgi_application
+from myapp.identity import CachedAuthMiddlewareStack
+from myapp.media import MediaApplication
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myproject.settings')
 
@@ -10,8 +11,9 @@ application = ProtocolTypeRouter(
 
     {
 
-        "http" : get_asgi_application(),
-        "websocket" : AuthMiddlewareStack(
+        # Uploaded media is answered here; everything else goes to Django.
+        "http" : MediaApplication(get_asgi_application()),
+        "websocket" : CachedAuthMiddlewareStack(
 
             URLRouter(
                 routing.websocket_urlpatterns
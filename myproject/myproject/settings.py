@@ -45,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'myapp.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -89,6 +90,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Keep each DB thread's connection open between calls.
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
@@ -154,5 +158,228 @@ CHANNEL_LAYERS = {
 
 }
 
+# To run several Daphne workers on one host, point CHAT_CHANNEL_BROKER at a
+# socket path and start `manage.py runbroker` next to the workers. The
+# broker also keeps the private chat queue. Presence and join notices stay
+# per worker: a user connected through two workers is announced by each.
+if os.environ.get('CHAT_CHANNEL_BROKER'):
+    CHANNEL_LAYERS["default"] = {
+
+        "BACKEND" : "myapp.layers.LocalBrokerChannelLayer",
+        "CONFIG" : {
+            "path" : os.environ['CHAT_CHANNEL_BROKER'],
+            "capacity" : 100,
+            "expiry" : 60,
+        }
+
+    }
+
 LOGIN_REDIRECT_URL = 'chatroom'
 LOGOUT_REDIRECT_URL = 'register'
+
+# Chat messages are written behind the broadcast in batches.
+# DURABILITY 'none' broadcasts immediately and persists in the background,
+# 'ack' broadcasts a message only once its batch is committed (each message
+# then waits up to FLUSH_INTERVAL seconds).
+CHAT_PERSISTENCE = {
+
+    "BATCH_SIZE" : 100,
+    "FLUSH_INTERVAL" : 0.1,
+    "DURABILITY" : "none"
+
+}
+
+# Thread pools for ORM calls made from consumers. Reads run in parallel;
+# WRITE_WORKERS None means a single writer on SQLite.
+CHAT_DB_EXECUTOR = {
+
+    "READ_WORKERS" : 4,
+    "WRITE_WORKERS" : None
+
+}
+
+# Recent history served on connect from an in-process ring buffer per room.
+# ENABLED None turns the buffer off when workers share CHAT_CHANNEL_BROKER.
+CHAT_HISTORY = {
+
+    "DEPTH" : 10,
+    "MAX_ROOMS" : 1000,
+    "ENABLED" : None
+
+}
+
+# Typing indicators are aggregated per room and broadcast once per TICK.
+CHAT_TYPING = {
+
+    "TICK" : 0.5,
+    "TTL" : 5.0
+
+}
+
+
+# Reactions are counted in memory and flushed (broadcast + saved) every INTERVAL seconds.
+CHAT_REACTIONS = {
+
+    "INTERVAL" : 0.5
+
+}
+
+
+# Public rooms are spread over shards by consistent hashing. Each shard's
+# workers set CHAT_SHARD; hot rooms can be pinned to a dedicated shard.
+CHAT_SHARDING = {
+
+    "SHARDS" : {},
+    "PINS" : {},
+    "LOCAL_SHARD" : os.environ.get('CHAT_SHARD'),
+    "VNODES" : 64
+
+}
+
+
+# Each connection buffers at most MAX_FRAMES outgoing frames; typing
+# frames are dropped first, and a connection stuck above HIGH_WATER for
+# EVICT_AFTER seconds is disconnected. Daphne buffers every frame itself
+# and never makes the queue wait, so these only apply under servers whose
+# send waits for the client (uvicorn).
+CHAT_OUTBOUND = {
+
+    "MAX_FRAMES" : 256,
+    "HIGH_WATER" : 192,
+    "EVICT_AFTER" : 5.0
+
+}
+
+
+# Token buckets for incoming websocket frames: [tokens per second, burst]
+# per message type, per connection and per user. '*' covers other types.
+CHAT_RATE_LIMITS = {
+
+    "CONNECTION" : {
+        "chat_message" : [2, 10],
+        "file_message" : [0.5, 3],
+        "reaction" : [5, 20],
+        "typing" : [2, 10],
+        "stop_typing" : [2, 10],
+        "fetch_older" : [2, 5],
+        "*" : [10, 20],
+    },
+    "USER" : {
+        "chat_message" : [5, 20],
+        "file_message" : [1, 5],
+        "reaction" : [10, 40],
+        "typing" : [4, 20],
+        "stop_typing" : [4, 20],
+        "fetch_older" : [4, 10],
+        "*" : [20, 40],
+    },
+    "MAX_USERS" : 10000
+
+}
+
+
+# Uploads are stored by content hash under MEDIA_ROOT/cas/. Chunked uploads
+# send at most MAX_CHUNK_SIZE bytes per request; `manage.py clean_uploads`
+# removes those left unfinished for ABANDONED_AFTER_HOURS.
+CHAT_UPLOADS = {
+
+    "MAX_CHUNK_SIZE" : 8 * 1024 * 1024,
+    "MAX_FILE_SIZE" : 100 * 1024 * 1024,
+    "ABANDONED_AFTER_HOURS" : 24
+
+}
+
+
+# Thumbnails (longest side MAX_SIZE px) and metadata for uploads are made
+# in a pool of WORKERS processes. Pillow is needed for thumbnails.
+CHAT_PREVIEWS = {
+
+    "WORKERS" : 2,
+    "MAX_SIZE" : 320,
+    "CACHE_SIZE" : 1000
+
+}
+
+# Files under MEDIA_URL are served by myapp.media ahead of Django; cas/
+# files are cached by clients for IMMUTABLE_MAX_AGE seconds.
+CHAT_MEDIA = {
+
+    "CHUNK_SIZE" : 64 * 1024,
+    "IMMUTABLE_MAX_AGE" : 365 * 24 * 60 * 60
+
+}
+
+# Message search (SQLite FTS5) ranks only the newest MAX_CANDIDATES matches
+# of a query, which bounds the cost of very common words.
+CHAT_SEARCH = {
+
+    "MAX_CANDIDATES" : 5000
+
+}
+
+# `manage.py archive` moves messages older than MAX_AGE_DAYS into compressed
+# segment files under DIR (default BASE_DIR/archive); history reads fall
+# back to them once the database runs out.
+CHAT_ARCHIVE = {
+
+    "MAX_AGE_DAYS" : 90,
+    "BLOCK_MESSAGES" : 256,
+    "SEGMENT_MESSAGES" : 50000
+
+}
+
+# Websocket handshakes reuse a session's resolved user for TTL seconds
+# (per process, at most MAX_SESSIONS); logging out drops it at once.
+CHAT_IDENTITY = {
+
+    "TTL" : 60,
+    "MAX_SESSIONS" : 10000
+
+}
+
+# Presence is kept in memory per process. Connections not heard from for
+# TTL seconds are dropped; private room members are snapshotted to
+# PrivateRoomConnection every SWEEP_INTERVAL seconds when SNAPSHOT is on.
+CHAT_PRESENCE = {
+
+    "TTL" : 300,
+    "SWEEP_INTERVAL" : 30,
+    "SNAPSHOT" : True
+
+}
+
+# Public rooms hear about joins and leaves at most once per WINDOW seconds,
+# naming up to MAX_NAMES users ("a, b, c and 120 others have connected.").
+CHAT_ANNOUNCEMENTS = {
+
+    "WINDOW" : 1.0,
+    "MAX_NAMES" : 3
+
+}
+
+# Quiet websockets get a ping every INTERVAL seconds; one that sends
+# nothing, not even a pong, for IDLE_TIMEOUT seconds is closed and cleaned up.
+CHAT_HEARTBEAT = {
+
+    "INTERVAL" : 20,
+    "IDLE_TIMEOUT" : 60
+
+}
+
+# /metrics/ serves Prometheus text to staff users, or to anyone sending
+# "Authorization: Bearer <TOKEN>" when a TOKEN is set.
+CHAT_METRICS = {
+
+    "TOKEN" : os.environ.get('CHAT_METRICS_TOKEN')
+
+}
+
+# Staff can start a sampling profiler (folded stacks for flame graphs) and
+# a slow-handler log with per-stage timings at /profiling/; SLOW_LOG turns
+# the log on from startup for handlers over THRESHOLD_MS.
+CHAT_PROFILING = {
+
+    "SLOW_LOG" : False,
+    "THRESHOLD_MS" : 100
+
+}
@@ -0,0 +1,68 @@
+// Resumable, content-addressed uploads against /upload/chunked/.
+// uploadFile(file, csrfToken) resolves to the stored file's URL.
+(function () {
+    const CHUNK_SIZE = 1024 * 1024;
+    const MAX_RETRIES = 5;
+    const RETRY_DELAY = 1000;
+
+    async function sha256Hex(file) {
+        // Lets the server skip the upload entirely when it already has the
+        // file. Not available outside secure contexts; the server hashes anyway.
+        if (!window.crypto || !crypto.subtle) return '';
+        const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        return [...new Uint8Array(digest)].map(b => b.toString(16).padStart(2, '0')).join('');
+    }
+
+    async function request(url, options, csrfToken) {
+        options.headers = Object.assign({ 'X-CSRFToken': csrfToken }, options.headers);
+        const response = await fetch(url, options);
+        return { ok: response.ok, data: await response.json() };
+    }
+
+    function sleep(ms) {
+        return new Promise(resolve => setTimeout(resolve, ms));
+    }
+
+    async function uploadFile(file, csrfToken) {
+        const start = await request('/upload/chunked/', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename: file.name, size: file.size, sha256: await sha256Hex(file) })
+        }, csrfToken);
+        if (!start.ok) throw new Error(start.data.error);
+        if (start.data.complete) return start.data.file_url;
+
+        const url = `/upload/chunked/${start.data.upload_id}/`;
+        const chunkSize = Math.min(start.data.chunk_size, CHUNK_SIZE);
+        let offset = start.data.offset;
+        let retries = 0;
+
+        while (true) {
+            let result;
+            try {
+                result = await request(url, {
+                    method: 'PUT',
+                    headers: { 'Upload-Offset': String(offset), 'Content-Type': 'application/octet-stream' },
+                    body: file.slice(offset, offset + chunkSize)
+                }, csrfToken);
+            } catch (error) {
+                // Connection dropped: ask the server how far it got and resume there.
+                if (++retries > MAX_RETRIES) throw error;
+                await sleep(RETRY_DELAY * retries);
+                try {
+                    offset = (await request(url, { method: 'GET' }, csrfToken)).data.offset;
+                } catch (ignored) {}
+                continue;
+            }
+
+            if (result.data.complete) return result.data.file_url;
+            if (!result.ok && (++retries > MAX_RETRIES || result.data.offset === undefined)) {
+                throw new Error(result.data.error || 'Upload failed');
+            }
+            if (result.ok) retries = 0;
+            offset = result.data.offset;
+        }
+    }
+
+    window.uploadFile = uploadFile;
+})();